@@ -11,6 +11,7 @@ app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
 # Initialize extensions
 from models import db, login_manager
+from utils.timezone_helper import format_datetime_for_user
 db.init_app(app)
 login_manager.init_app(app)
 login_manager.login_view = 'main.login'
@@ -22,35 +23,62 @@ def load_user(user_id):
     return User.query.get(int(user_id))
 
 # Template filters
-@app.template_filter('user_timezone')
-def user_timezone_filter(utc_datetime):
+def _format_for_user(utc_datetime, format_str):
     if not utc_datetime:
         return ''
     try:
-        from utils.timezone_helper import convert_utc_to_user_timezone
-        return convert_utc_to_user_timezone(utc_datetime).strftime('%Y-%m-%d %H:%M:%S')
-    except:
-        return utc_datetime.strftime('%Y-%m-%d %H:%M:%S') if utc_datetime else ''
+        return format_datetime_for_user(utc_datetime, format_str)
+    except (AttributeError, TypeError, ValueError):
+        return utc_datetime.strftime(format_str)
+
+@app.template_filter('user_timezone')
+def user_timezone_filter(utc_datetime):
+    return _format_for_user(utc_datetime, '%Y-%m-%d %H:%M:%S')
 
 @app.template_filter('user_time')
 def user_time_filter(utc_datetime):
-    if not utc_datetime:
-        return ''
-    try:
-        from utils.timezone_helper import convert_utc_to_user_timezone
-        return convert_utc_to_user_timezone(utc_datetime).strftime('%H:%M:%S')
-    except:
-        return utc_datetime.strftime('%H:%M:%S') if utc_datetime else ''
+    return _format_for_user(utc_datetime, '%H:%M:%S')
 
 @app.template_filter('user_date')
 def user_date_filter(utc_datetime):
-    if not utc_datetime:
-        return ''
-    try:
-        from utils.timezone_helper import convert_utc_to_user_timezone
-        return convert_utc_to_user_timezone(utc_datetime).strftime('%Y-%m-%d')
-    except:
-        return utc_datetime.strftime('%Y-%m-%d') if utc_datetime else ''
+    return _format_for_user(utc_datetime, '%Y-%m-%d')
+
+@app.cli.command('auto-checkout')
+def auto_checkout_command():
+    """Clock out timesheet entries open past their threshold (for cron)"""
+    from utils.auto_checkout import sweep_auto_checkouts
+    print(f"Auto-checked out {len(sweep_auto_checkouts())} entries")
+
+@app.cli.command('rollup-backfill')
+def rollup_backfill_command():
+    """Rebuild the daily work rollup from the whole timesheet history"""
+    from utils.work_rollup import backfill_work_rollup
+    print(f"Wrote {backfill_work_rollup()} daily work rollup rows")
+
+@app.cli.command('duration-backfill')
+def duration_backfill_command():
+    """Store durations of timesheet entries and breaks closed before they were persisted"""
+    from utils.timesheet import backfill_durations
+    breaks, entries = backfill_durations()
+    print(f"Stored durations of {breaks} breaks and {entries} timesheet entries")
+
+@app.cli.command('apply-punches')
+def apply_punches_command():
+    """Fold every queued punch into timesheets (when the background applier is disabled)"""
+    from utils.punch_queue import drain_punch_queue
+    print(f"Applied {drain_punch_queue()} punches")
+
+@app.cli.command('flush-presence')
+def flush_presence_command():
+    """Write pending status and task changes to UserStatus (when the background flusher is disabled)"""
+    from utils.presence import flush_presence
+    print(f"Flushed presence of {flush_presence()} users")
+
+@app.cli.command('prune-changes')
+def prune_changes_command():
+    """Drop calendar changes older than the retention period (when the background pruner is disabled)"""
+    from utils.change_log import prune_calendar_changes
+    print(f"Pruned {prune_calendar_changes()} calendar changes")
 
 # Register blueprint
 from routes import main_bp
@@ -0,0 +1,92 @@
+"""
+Shared setup for the benchmarks: a throwaway database, bulk seeding, logged-in clients and query counting
+
+Import this module before anything from the app: it points DATABASE_URL at
+a temporary SQLite file (BENCH_DATABASE_URL overrides it, e.g. to run
+against Postgres) so the real database is never touched. The in-process
+feed and reference caches are disabled so every request does its full work.
+"""
+import os
+import sys
+import tempfile
+from contextlib import contextmanager
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKDIR = tempfile.mkdtemp(prefix='teamcal-bench-')
+os.environ['DATABASE_URL'] = os.environ.get('BENCH_DATABASE_URL', f"sqlite:///{os.path.join(WORKDIR, 'bench.db')}")
+os.environ.setdefault('PRESENCE_DB_PATH', os.path.join(WORKDIR, 'presence.db'))
+os.environ.setdefault('FEED_CACHE_TTL', '0')
+os.environ.setdefault('REFERENCE_CACHE_TTL', '0')
+sys.path.insert(0, ROOT)
+
+from sqlalchemy import event  # noqa: E402
+from werkzeug.security import generate_password_hash  # noqa: E402
+from app import app  # noqa: E402
+from models import db, User, Department  # noqa: E402
+
+app.config.update(TESTING=True, WTF_CSRF_ENABLED=False)
+
+PASSWORD = 'benchmark'
+PASSWORD_HASH = generate_password_hash(PASSWORD, method='pbkdf2:sha256:1')  # Cheap on purpose; logins are not measured
+
+
+def reset_database():
+    """Drop and recreate every table"""
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+
+
+def seed_users(count, departments=5):
+    """Insert count approved users spread over departments; the first one is an admin. Returns their ids."""
+    with app.app_context():
+        department_ids = []
+        for index in range(departments):
+            department = Department(name=f'Department {index}')
+            db.session.add(department)
+            db.session.flush()
+            department_ids.append(department.id)
+        db.session.execute(User.__table__.insert(), [{
+            'username': f'user{index}',
+            'email': user_email(index),
+            'password_hash': PASSWORD_HASH,
+            'is_admin': index == 0,
+            'approval_status': 'approved',
+            'timezone': 'UTC',
+            'department_id': department_ids[index % departments] if department_ids else None
+        } for index in range(count)])
+        db.session.commit()
+        return [user_id for (user_id,) in db.session.execute(db.select(User.id).order_by(User.id))]
+
+
+def user_email(index):
+    return f'user{index}@example.com'
+
+
+def login(index=0):
+    """Test client logged in as the index-th seeded user (0 is the admin)"""
+    client = app.test_client()
+    response = client.post('/login', data={'email': user_email(index), 'password': PASSWORD})
+    assert response.status_code == 302, f'login as {user_email(index)} failed'
+    return client
+
+
+@contextmanager
+def count_queries():
+    """Collect the SQL statements executed inside the block"""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
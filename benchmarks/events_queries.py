@@ -0,0 +1,79 @@
+"""
+Query count of the calendar and Gantt feeds as headcount grows
+
+    python benchmarks/events_queries.py [--sizes 25 100 400] [--events-per-user 6]
+
+Seeds each headcount with availability, busy and leave events in the
+current month, then requests the "all" and department views of
+/api/events and /api/gantt-data. The batched loaders fetch every event
+type for the whole user set at once, so each feed must issue the same
+number of queries at every size; the script exits non-zero if it does not.
+"""
+import argparse
+import time
+from datetime import date, time as clock, timedelta
+
+from common import app, db, reset_database, seed_users, login, count_queries
+from models import AvailabilitySlot, BusySlot, LeaveDay
+
+FEEDS = (
+    ('events, all', '/api/events?filter_type=all'),
+    ('events, department', '/api/events?filter_type=department&department_id=1'),
+    ('gantt, all', '/api/gantt-data?filter_type=all'),
+    ('gantt, department', '/api/gantt-data?filter_type=department&department_id=1'),
+)
+
+
+def seed_events(user_ids, per_user):
+    month_start = date.today().replace(day=1)
+    with app.app_context():
+        availability, busy, leave = [], [], []
+        for user_id in user_ids:
+            for index in range(per_user):
+                day = month_start + timedelta(days=index % 28)
+                availability.append({'user_id': user_id, 'date': day, 'start_time': clock(9), 'end_time': clock(17)})
+                busy.append({'user_id': user_id, 'date': day, 'start_time': clock(11), 'end_time': clock(12), 'title': 'Meeting'})
+            leave.append({'user_id': user_id, 'start_date': month_start + timedelta(days=20),
+                          'end_date': month_start + timedelta(days=21), 'approved_status': 'approved'})
+        db.session.execute(AvailabilitySlot.__table__.insert(), availability)
+        db.session.execute(BusySlot.__table__.insert(), busy)
+        db.session.execute(LeaveDay.__table__.insert(), leave)
+        db.session.commit()
+
+
+def measure(size, per_user):
+    reset_database()
+    seed_events(seed_users(size), per_user)
+    client = login()
+    results = {}
+    for name, url in FEEDS:
+        with count_queries() as statements:
+            started = time.perf_counter()
+            response = client.get(url)
+            elapsed = time.perf_counter() - started
+        assert response.status_code == 200, (url, response.status_code)
+        results[name] = (len(statements), elapsed)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[25, 100, 400])
+    parser.add_argument('--events-per-user', type=int, default=6)
+    args = parser.parse_args()
+
+    by_size = {size: measure(size, args.events_per_user) for size in args.sizes}
+    print(f"{'feed':<20}" + ''.join(f'{size:>8} users' for size in args.sizes))
+    flat = True
+    for name, _ in FEEDS:
+        counts = [by_size[size][name][0] for size in args.sizes]
+        flat = flat and len(set(counts)) == 1
+        print(f'{name:<20}' + ''.join(
+            f'{count:>5} q {by_size[size][name][1] * 1000:>4.0f}ms' for size, count in zip(args.sizes, counts)))
+    if not flat:
+        raise SystemExit('Query count grows with headcount')
+    print('Query counts are flat across headcounts')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""
+Punch endpoint cost with years of timesheet history per user
+
+    python benchmarks/punch_lookup.py [--users 40] [--years 5] [--rounds 100]
+
+Seeds every user but the last with a weekday entry for each of the past
+years, then runs clock-in, status, start-break, end-break and clock-out
+in turn for a user with that history and for the user without any. The
+open shift is found through UserStatus.current_timesheet_id or the
+partial unique index on open entries, so an endpoint must issue the same
+queries whatever the history length; the script exits non-zero if a
+count differs or SQLite does not plan the lookup on the partial index.
+"""
+import argparse
+import time
+from collections import Counter
+from datetime import date, datetime, time as clock, timedelta
+
+from common import app, db, reset_database, seed_users, login, count_queries
+from models import TimesheetEntry
+
+CALLS = (
+    ('post', '/api/timesheet/clock-in', {}),
+    ('get', '/api/timesheet/status', None),
+    ('post', '/api/timesheet/start-break', {'break_type': 'Coffee'}),
+    ('post', '/api/timesheet/end-break', {}),
+    ('post', '/api/timesheet/clock-out', {}),
+)
+
+
+def seed_history(user_ids, years):
+    first_day = date.today() - timedelta(days=365 * years)
+    with app.app_context():
+        for user_id in user_ids:
+            rows = []
+            day = first_day
+            while day < date.today():
+                if day.weekday() < 5:
+                    clock_in = datetime.combine(day, clock(9))
+                    rows.append({'user_id': user_id, 'date': day, 'clock_in': clock_in,
+                                 'clock_out': clock_in + timedelta(hours=8), 'break_duration': 30,
+                                 'duration_minutes': 450, 'location': 'Office'})
+                day += timedelta(days=1)
+            db.session.execute(TimesheetEntry.__table__.insert(), rows)
+        db.session.commit()
+        return TimesheetEntry.query.count()
+
+
+def run_punches(client, rounds):
+    """{path: (mean ms, queries per call)} over rounds of the punch sequence"""
+    seconds, queries = Counter(), Counter()
+    for _ in range(rounds):
+        for method, path, body in CALLS:
+            with count_queries() as statements:
+                started = time.perf_counter()
+                response = client.get(path) if method == 'get' else client.post(path, json=body)
+                seconds[path] += time.perf_counter() - started
+            assert response.status_code == 200 and response.json['success'], (path, response.json)
+            queries[path] += len(statements)
+    return {path: (seconds[path] / rounds * 1000, queries[path] / rounds) for _, path, _ in CALLS}
+
+
+def open_entry_plan():
+    with app.app_context():
+        if db.engine.dialect.name != 'sqlite':
+            return None
+        statement = db.select(TimesheetEntry.id).where(TimesheetEntry.user_id == 1, TimesheetEntry.clock_out.is_(None))
+        compiled = statement.compile(db.engine, compile_kwargs={'literal_binds': True})
+        return ' '.join(row[-1] for row in db.session.execute(db.text(f'EXPLAIN QUERY PLAN {compiled}')))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=40)
+    parser.add_argument('--years', type=int, default=5)
+    parser.add_argument('--rounds', type=int, default=100)
+    args = parser.parse_args()
+
+    reset_database()
+    user_ids = seed_users(args.users)
+    entries = seed_history(user_ids[:-1], args.years)
+    print(f'{entries} historical entries, {entries // (args.users - 1)} per user')
+
+    with_history = run_punches(login(1), args.rounds)
+    without_history = run_punches(login(args.users - 1), args.rounds)
+    print(f"{'endpoint':<28} {'history':>18} {'no history':>18}")
+    mismatched = []
+    for _, path, _ in CALLS:
+        (history_ms, history_queries), (fresh_ms, fresh_queries) = with_history[path], without_history[path]
+        print(f'{path:<28} {history_ms:>6.2f} ms {history_queries:>4.1f} q {fresh_ms:>6.2f} ms {fresh_queries:>4.1f} q')
+        if history_queries != fresh_queries:
+            mismatched.append(path)
+
+    plan = open_entry_plan()
+    if plan is not None:
+        print(f'open-entry lookup plan: {plan}')
+    if mismatched:
+        raise SystemExit(f'Query count depends on history length: {", ".join(mismatched)}')
+    if plan is not None and 'uq_timesheet_entry_open_user' not in plan:
+        raise SystemExit('The open-entry lookup does not use the partial unique index')
+    print('Punch endpoints issue the same queries regardless of history length')
+
+
+if __name__ == '__main__':
+    main()
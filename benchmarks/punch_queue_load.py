@@ -0,0 +1,153 @@
+"""
+Shift-start load on the punch queue versus the synchronous punch endpoints
+
+    python benchmarks/punch_queue_load.py [--users 500] [--concurrency 50] [--mode punch sync]
+
+Serves the app from a threaded HTTP server in this process and has every
+user clock in at once (the 9am spike), then clock out, over real
+connections. The punch mode posts to /api/timesheet/punches, which only
+logs the punch, and runs the background applier as main.py does. The sync
+mode posts to the clock-in and clock-out endpoints. Each mode reports
+sustained throughput, acknowledgement latency (p50/p99/max) and, for the
+queue, how long the applier took to catch up. The script exits non-zero
+if a queued punch is lost, rejected or left unapplied; a failed punch
+request is retried under its Idempotency-Key, as the client does, since
+SQLite can time out a writer under this much contention.
+"""
+import argparse
+import http.client
+import json
+import logging
+import threading
+import time
+import urllib.parse
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import make_server
+
+from common import app, db, reset_database, seed_users, user_email, PASSWORD, percentile
+from models import TimesheetEntry, PunchEvent
+from utils.punch_queue import start_punch_applier
+
+APPLIER_INTERVAL_SECONDS = 0.2
+DRAIN_TIMEOUT_SECONDS = 120
+RETRIES = 2
+
+
+class Server:
+    def __init__(self):
+        self.server = make_server('127.0.0.1', 0, app, threaded=True)
+        self.port = self.server.server_port
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def request(self, method, path, body=None, headers=None, cookie=None):
+        connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=60)
+        headers = dict(headers or {})
+        if cookie:
+            headers['Cookie'] = cookie
+        connection.request(method, path, body, headers)
+        response = connection.getresponse()
+        data = response.read()
+        connection.close()
+        return response.status, response.getheader('Set-Cookie'), data
+
+    def login(self, index):
+        form = urllib.parse.urlencode({'email': user_email(index), 'password': PASSWORD})
+        status, cookie, _ = self.request('POST', '/login', form, {'Content-Type': 'application/x-www-form-urlencoded'})
+        assert status == 302, f'login as {user_email(index)} failed'
+        return cookie.split(';')[0]
+
+
+def spike(server, cookies, mode, kind, concurrency):
+    """Send one punch of the given kind per user at once; returns (latencies, errors, lost)"""
+    latencies, errors, lost = [], [], []
+
+    def punch(cookie):
+        headers = {'Content-Type': 'application/json'}
+        if mode == 'punch':
+            path, body = '/api/timesheet/punches', {'kind': kind}
+            headers['Idempotency-Key'] = uuid.uuid4().hex
+        else:
+            path, body = f"/api/timesheet/{kind.replace('_', '-')}", {}
+        for attempt in range(RETRIES + 1 if mode == 'punch' else 1):
+            # A queued punch is retried under the same Idempotency-Key, as the client does
+            started = time.perf_counter()
+            status, _, data = server.request('POST', path, json.dumps(body), headers, cookie)
+            latencies.append(time.perf_counter() - started)
+            if status in (200, 202):
+                return
+            errors.append((status, data[:120]))
+        lost.append(cookie)
+
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(punch, cookies))
+    return latencies, errors, lost
+
+
+def wait_for_applier():
+    started = time.perf_counter()
+    with app.app_context():
+        while PunchEvent.query.filter(PunchEvent.applied_at.is_(None)).count():
+            if time.perf_counter() - started > DRAIN_TIMEOUT_SECONDS:
+                raise SystemExit('The applier did not drain the punch queue')
+            db.session.remove()
+            time.sleep(0.05)
+    return time.perf_counter() - started
+
+
+def run(mode, users, concurrency):
+    reset_database()
+    seed_users(users + 1)
+    server = Server()
+    with ThreadPoolExecutor(concurrency) as pool:
+        cookies = list(pool.map(server.login, range(1, users + 1)))
+
+    if mode == 'punch':
+        start_punch_applier(app, APPLIER_INTERVAL_SECONDS)
+    elapsed, drain = 0.0, 0.0
+    latencies, errors, lost = [], [], []
+    for kind in ('clock_in', 'clock_out'):
+        started = time.perf_counter()
+        kind_latencies, kind_errors, kind_lost = spike(server, cookies, mode, kind, concurrency)
+        elapsed += time.perf_counter() - started
+        latencies += kind_latencies
+        errors += kind_errors
+        lost += kind_lost
+        if mode == 'punch':
+            # Both spikes are timed apart; in production they are hours apart, so clock-outs never overtake
+            drain = max(drain, wait_for_applier())
+    server.server.shutdown()
+
+    latencies.sort()
+    print(f'{mode:>6}: {len(latencies)} punches in {elapsed:.2f}s = {len(latencies) / elapsed:.0f}/s; '
+          f'ack p50 {percentile(latencies, 0.5) * 1000:.1f} ms, p99 {percentile(latencies, 0.99) * 1000:.1f} ms, '
+          f'max {latencies[-1] * 1000:.0f} ms; errors {len(errors)}')
+    with app.app_context():
+        closed = TimesheetEntry.query.filter(TimesheetEntry.clock_out.isnot(None)).count()
+        print(f'        closed entries {closed}/{users}' + (f'; queue drained at most {drain:.2f}s after a spike' if mode == 'punch' else ''))
+        if mode == 'punch':
+            logged = PunchEvent.query.count()
+            rejected = PunchEvent.query.filter(PunchEvent.error.isnot(None)).count()
+            for status, data in errors[:5]:
+                print(f'        {status}: {data!r}')
+            if lost or logged != 2 * users or rejected or closed != users:
+                raise SystemExit(f'Queued punches lost or rejected: {len(lost)} unacknowledged, '
+                                 f'{logged} logged, {rejected} rejected, {closed} closed')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--mode', nargs='+', choices=('punch', 'sync'), default=['punch', 'sync'])
+    args = parser.parse_args()
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    # The applier keeps running once started, so the queue runs last
+    for mode in sorted(args.mode, reverse=True):
+        run(mode, args.users, args.concurrency)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+Peak Python memory of buffered versus streamed (?stream=1) JSON feeds
+
+    python benchmarks/streaming_memory.py [--sizes 100000 1000000] [--buffered-max 100000]
+
+Seeds availability slots across 20 users and reads /api/events for the
+whole team, with and without ?stream=1, while tracemalloc records the peak
+allocation. Streaming iterates the query with yield_per and writes array
+elements as it goes, so its peak must stay flat as the slot count grows
+tenfold; the script exits non-zero if it more than doubles. The buffered
+mode is only run up to --buffered-max slots, since it holds every row,
+dict and the whole JSON body at once.
+"""
+import argparse
+import time
+import tracemalloc
+from datetime import date, time as clock, timedelta
+
+from common import app, db, reset_database, seed_users, login
+from models import AvailabilitySlot
+
+USERS = 20
+INSERT_CHUNK = 50000
+
+
+def seed_slots(user_ids, count):
+    with app.app_context():
+        for offset in range(0, count, INSERT_CHUNK):
+            db.session.execute(AvailabilitySlot.__table__.insert(), [{
+                'user_id': user_ids[index % len(user_ids)],
+                'date': date(2020, 1, 1) + timedelta(days=index // len(user_ids) % 3000),
+                'start_time': clock(9),
+                'end_time': clock(17)
+            } for index in range(offset, min(count, offset + INSERT_CHUNK))])
+            db.session.commit()
+
+
+def read_feed(client, url):
+    """(peak MB, body bytes, seconds) of reading a whole response"""
+    tracemalloc.start()
+    started = time.perf_counter()
+    response = client.get(url, buffered=False)
+    size = sum(len(chunk) for chunk in response.response)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert response.status_code == 200, (url, response.status_code)
+    return peak / 1e6, size, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100000, 1000000])
+    parser.add_argument('--buffered-max', type=int, default=100000)
+    args = parser.parse_args()
+
+    reset_database()
+    user_ids = seed_users(USERS)
+    client = login()
+    seeded = 0
+    streamed_peaks = []
+    print(f"{'slots':>9} {'mode':>9} {'peak MB':>9} {'body MB':>9} {'seconds':>8}")
+    for size in sorted(args.sizes):
+        seed_slots(user_ids, size - seeded)
+        seeded = size
+        modes = [('streamed', '&stream=1')]
+        if size <= args.buffered_max:
+            modes.insert(0, ('buffered', ''))
+        for mode, query in modes:
+            peak, body, elapsed = read_feed(client, '/api/events?filter_type=all' + query)
+            if mode == 'streamed':
+                streamed_peaks.append(peak)
+            print(f'{size:>9} {mode:>9} {peak:>9.1f} {body / 1e6:>9.1f} {elapsed:>8.1f}')
+
+    if max(streamed_peaks) > 2 * min(streamed_peaks):
+        raise SystemExit('Streamed peak memory grows with the result size')
+    print('Streamed peak memory is flat across result sizes')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,9 @@
 from flask_wtf import FlaskForm
-from wtforms import StringField, PasswordField, SubmitField, TimeField, DateField, TextAreaField, SelectField, BooleanField
-from wtforms.validators import DataRequired, Email, EqualTo, Length, ValidationError
+from wtforms import StringField, PasswordField, SubmitField, TimeField, DateField, TextAreaField, SelectField, BooleanField, FloatField
+from wtforms.validators import DataRequired, Email, EqualTo, Length, ValidationError, Optional, NumberRange
 from models import User, Department
+from utils.reference_cache import department_choices
+from utils.timezone_helper import timezone_choices
 
 class LoginForm(FlaskForm):
     email = StringField('Email', validators=[DataRequired(), Email()])
@@ -18,8 +20,7 @@ class RegistrationForm(FlaskForm):
     
     def __init__(self, *args, **kwargs):
         super(RegistrationForm, self).__init__(*args, **kwargs)
-        departments = Department.query.order_by(Department.name).all()
-        self.department_id.choices = [(0, 'No Department')] + [(dept.id, dept.name) for dept in departments]
+        self.department_id.choices = [(0, 'No Department')] + department_choices()
     
     def validate_username(self, username):
         user = User.query.filter_by(username=username.data).first()
@@ -64,21 +65,18 @@ class ProfileForm(FlaskForm):
     department_id = SelectField('Department', coerce=int, validators=[DataRequired()])
     default_start_time = TimeField('Default Start Time')
     default_end_time = TimeField('Default End Time')
-    timezone = SelectField('Timezone', choices=[
-        ('UTC', 'UTC (Coordinated Universal Time)'),
-        ('Asia/Kolkata', 'India Standard Time (IST)'),
-        ('Europe/Berlin', 'Central European Time (CET)'),
-        ('Europe/London', 'Greenwich Mean Time (GMT)')
-    ], default='UTC')
+    timezone = SelectField('Timezone', default='UTC')
     submit = SubmitField('Update Profile')
     
     def __init__(self, *args, **kwargs):
         super(ProfileForm, self).__init__(*args, **kwargs)
-        self.department_id.choices = [(dept.id, dept.name) for dept in Department.query.order_by(Department.name).all()]
+        self.department_id.choices = department_choices()
+        self.timezone.choices = timezone_choices()
 
 class DepartmentForm(FlaskForm):
     name = StringField('Department Name', validators=[DataRequired(), Length(min=2, max=100)])
     description = TextAreaField('Description')
+    auto_checkout_hours = FloatField('Auto Checkout After (hours)', validators=[Optional(), NumberRange(min=0.5, max=24)])
     submit = SubmitField('Save Department')
     
     def validate_name(self, name):
@@ -96,8 +94,7 @@ class AddEmployeeForm(FlaskForm):
     
     def __init__(self, *args, **kwargs):
         super(AddEmployeeForm, self).__init__(*args, **kwargs)
-        departments = Department.query.order_by(Department.name).all()
-        self.department_id.choices = [(dept.id, dept.name) for dept in departments]
+        self.department_id.choices = department_choices()
     
     def validate_username(self, username):
         user = User.query.filter_by(username=username.data).first()
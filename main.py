@@ -2,12 +2,33 @@ from app import app
 from models import db
 from models import User, Department
 from werkzeug.security import generate_password_hash
+from utils.auto_checkout import start_auto_checkout_sweeper
+from utils.punch_queue import start_punch_applier
+from utils.presence import start_presence_flusher
+from utils.change_log import start_change_log_pruner
 import os
 # Initialize database on startup
 with app.app_context():
     # db.drop_all()
     db.create_all()
     
+    # create_all() only builds new tables, so add columns and indexes that were
+    # introduced after an existing database was created
+    inspector = db.inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing_columns:
+                column_type = column.type.compile(dialect=db.engine.dialect)
+                db.session.execute(db.text(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column_type}'))
+        db.session.commit()
+        for index in table.indexes:
+            try:
+                index.create(db.engine, checkfirst=True)
+            except Exception as e:
+                # e.g. a unique index over rows that already conflict; the app still runs without it
+                print(f"Could not create index {index.name}: {e}")
+    
     # Create departments
     departments = [
         {'name': 'Engineering', 'description': 'Software development and technical teams'},
@@ -38,6 +59,18 @@ with app.app_context():
         db.session.commit()
         print("✓ Admin created")
 
+# Clock out forgotten timesheet entries in the background (every worker runs one; sweeps are idempotent)
+start_auto_checkout_sweeper(app)
+
+# Fold queued punches into timesheets (every worker runs one; each punch is claimed by exactly one)
+start_punch_applier(app)
+
+# Write status and task changes held in the presence store back to UserStatus
+start_presence_flusher(app)
+
+# Drop calendar changes older than any client should still be syncing from
+start_change_log_pruner(app)
+
 if __name__ == '__main__':
     port=int(os.environ.get("PORT",5000))
     app.run(host="0.0.0.0",port=port)
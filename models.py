@@ -109,7 +109,9 @@ class Department(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), unique=True, nullable=False)
     description = db.Column(db.Text)
+    auto_checkout_hours = db.Column(db.Float, nullable=True)  # Open entries are closed after this; null uses the default
     created_at = db.Column(db.DateTime, default=func.now())
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     # Relationships
     users = db.relationship('User', backref='department', lazy=True)
@@ -134,7 +136,10 @@ class User(UserMixin, db.Model):
     default_start_time = db.Column(db.String(5), default='09:00')  # Format: HH:MM
     default_end_time = db.Column(db.String(5), default='17:00')    # Format: HH:MM
     timezone = db.Column(db.String(50), default='UTC')  # User's timezone (e.g., 'Asia/Kolkata', 'Europe/Berlin', 'Europe/London')
+    calendar_token = db.Column(db.String(64), unique=True, index=True)  # Secret in the user's ICS subscription URLs
+    auto_checkout_hours = db.Column(db.Float, nullable=True)  # Overrides the department's auto-checkout threshold
     created_at = db.Column(db.DateTime, default=func.now())
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     role=db.Column(db.String(20), default='user')
     
     # Relationships
@@ -159,7 +164,17 @@ class AvailabilitySlot(db.Model):
     end_time = db.Column(db.Time, nullable=False)
     recurring = db.Column(db.Boolean, default=False)
     recurring_days = db.Column(db.String(20))  # JSON string of weekdays [0-6]
+    recurrence_interval = db.Column(db.Integer, default=1)  # Repeat every N weeks
+    recurrence_until = db.Column(db.Date)  # Last possible occurrence (also set from the count)
+    recurrence_count = db.Column(db.Integer)  # Stop after this many occurrences
+    recurrence_exceptions = db.Column(db.Text)  # JSON list of skipped dates ['YYYY-MM-DD']
     created_at = db.Column(db.DateTime, default=func.now())
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    # Calendar and Gantt feeds read a date window per user
+    __table_args__ = (
+        db.Index('ix_availability_slot_user_date', 'user_id', 'date'),
+    )
     
     def __repr__(self):
         return f'<AvailabilitySlot {self.user.username} {self.date} {self.start_time}-{self.end_time}>'
@@ -173,6 +188,12 @@ class BusySlot(db.Model):
     title = db.Column(db.String(100), default='Busy')
     description = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=func.now())
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    # Calendar and Gantt feeds read a date window per user
+    __table_args__ = (
+        db.Index('ix_busy_slot_user_date', 'user_id', 'date'),
+    )
     
     def __repr__(self):
         return f'<BusySlot {self.user.username} {self.date} {self.start_time}-{self.end_time}>'
@@ -191,6 +212,7 @@ class LeaveDay(db.Model):
     created_at = db.Column(db.DateTime, default=func.now())
     approved_status = db.Column(db.String(20), default='pending')  # pending, approved, rejected
     submitted_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     # HR approval
     hr_id = db.Column(db.Integer, db.ForeignKey('user.id'))
@@ -209,6 +231,11 @@ class LeaveDay(db.Model):
     hr_reviewer = db.relationship('User', foreign_keys=[hr_id], backref='hr_reviewed_leaves')
     manager_reviewer = db.relationship('User', foreign_keys=[manager_id], backref='manager_reviewed_leaves')
     
+    # Calendar and Gantt feeds look up leave ranges overlapping a window per user
+    __table_args__ = (
+        db.Index('ix_leave_day_user_dates', 'user_id', 'start_date', 'end_date'),
+    )
+    
     def __repr__(self):
         return f'<LeaveDay {self.user.username} {self.start_date} to {self.end_date} {self.leave_type}>'
     
@@ -228,6 +255,22 @@ class LeaveDay(db.Model):
     def is_approved(self):
         """Check if leave is fully approved"""
         return self.approved_status == 'approved'
+
+
+class CalendarChange(db.Model):
+    """Append-only log of calendar event changes, read by the delta-sync endpoint"""
+    __tablename__ = 'calendar_change'
+    
+    id = db.Column(db.Integer, primary_key=True)  # Doubles as the sync cursor
+    event_type = db.Column(db.String(20), nullable=False)  # availability, busy, leave
+    event_id = db.Column(db.Integer, nullable=False)
+    user_id = db.Column(db.Integer, nullable=False, index=True)  # No FK so tombstones outlive the user
+    operation = db.Column(db.String(10), nullable=False)  # upsert, delete
+    changed_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)  # Retention is by age
+    
+    def __repr__(self):
+        return f'<CalendarChange {self.id} {self.operation} {self.event_type}-{self.event_id}>'
+
 class TimesheetEntry(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
@@ -235,18 +278,35 @@ class TimesheetEntry(db.Model):
     clock_in = db.Column(db.DateTime, nullable=False)
     clock_out = db.Column(db.DateTime, nullable=True)  # Null when still clocked in
     break_duration = db.Column(db.Integer, default=0)  # Break time in minutes
+    duration_minutes = db.Column(db.Integer, nullable=True)  # Worked minutes net of breaks, written at clock-out
     notes = db.Column(db.Text)
     location = db.Column(db.String(50), default='Office')  # Office, Remote, etc.
     created_at = db.Column(db.DateTime, default=func.now())
     updated_at = db.Column(db.DateTime, default=func.now(), onupdate=func.now())
     
+    __table_args__ = (
+        # At most one open entry per user; also serves the active-entry lookup
+        db.Index('uq_timesheet_entry_open_user', 'user_id', unique=True,
+                 sqlite_where=db.text('clock_out IS NULL'), postgresql_where=db.text('clock_out IS NULL')),
+        # Export order, so a full export streams rows without sorting the table first
+        db.Index('ix_timesheet_entry_date_clock_in', 'date', 'clock_in'),
+        # Keyset pages of one user's entries, newest first
+        db.Index('ix_timesheet_entry_user_date_clock_in', 'user_id', 'date', 'clock_in', 'id'),
+    )
+    
     @property
     def duration(self):
-        """Calculate work duration in minutes"""
+        """Work duration in minutes (stored at clock-out; computed for rows not yet backfilled)"""
         if not self.clock_out:
             return 0
+        if self.duration_minutes is not None:
+            return self.duration_minutes
+        return self.compute_duration()
+    
+    def compute_duration(self):
+        """Work duration in minutes from the clock times, net of breaks"""
         total_minutes = (self.clock_out - self.clock_in).total_seconds() / 60
-        return max(0, int(total_minutes - self.break_duration))
+        return max(0, int(total_minutes - (self.break_duration or 0)))
     
     @property
     def is_active(self):
@@ -263,15 +323,17 @@ class BreakEntry(db.Model):
     break_start = db.Column(db.DateTime, nullable=False)
     break_end = db.Column(db.DateTime, nullable=True)  # Null when break is active
     break_type = db.Column(db.String(50), default='Break')  # Break, Lunch, etc.
+    duration_minutes = db.Column(db.Integer, nullable=True)  # Written when the break ends
     created_at = db.Column(db.DateTime, default=func.now())
     updated_at = db.Column(db.DateTime, default=func.now(), onupdate=func.now())
     
     @property
     def duration(self):
-        """Calculate break duration in minutes"""
+        """Break duration in minutes (stored when the break ends; an active break counts up to now)"""
         if not self.break_end:
-            # If break is active, calculate from start to now
-            return int((datetime.now() - self.break_start).total_seconds() / 60)
+            return int((datetime.utcnow() - self.break_start).total_seconds() / 60)
+        if self.duration_minutes is not None:
+            return self.duration_minutes
         return int((self.break_end - self.break_start).total_seconds() / 60)
     
     @property
@@ -294,3 +356,112 @@ class UserStatus(db.Model):
     
     def __repr__(self):
         return f'<UserStatus {self.user.username} working:{self.is_working}>'
+
+class StatusChange(db.Model):
+    """Append-only log of team status changes, read by every worker's live status stream"""
+    __tablename__ = 'status_change'
+    
+    id = db.Column(db.Integer, primary_key=True)  # Doubles as the stream cursor
+    user_id = db.Column(db.Integer, nullable=False)  # No FK so the change outlives the user
+    changed_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    
+    def __repr__(self):
+        return f'<StatusChange {self.id} user-{self.user_id}>'
+
+class PunchEvent(db.Model):
+    """Append-only log of accepted punches, folded into timesheets by utils.punch_queue"""
+    __tablename__ = 'punch_event'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    kind = db.Column(db.String(20), nullable=False)  # clock_in, clock_out, break_start, break_end
+    idempotency_key = db.Column(db.String(64), nullable=False)  # Client-chosen; a retried punch reuses it
+    occurred_at = db.Column(db.DateTime, nullable=False)  # UTC; acceptance time, or the device's clock for synced batches
+    location = db.Column(db.String(50))
+    notes = db.Column(db.Text)
+    task = db.Column(db.String(200))
+    break_type = db.Column(db.String(50))
+    device_id = db.Column(db.String(64))  # Time clock that recorded the punch, for synced batches
+    claim_token = db.Column(db.String(32))  # Applier run folding the punch; see utils.punch_queue._claim
+    claimed_at = db.Column(db.DateTime)
+    applied_at = db.Column(db.DateTime, nullable=True)  # Null while queued
+    error = db.Column(db.String(200))  # Why the punch was rejected when it was applied
+    timesheet_entry_id = db.Column(db.Integer, nullable=True)  # Entry the punch touched
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'idempotency_key', name='uq_punch_event_user_key'),
+        # The applier's queue: only punches not yet applied
+        db.Index('ix_punch_event_pending', 'id',
+                 sqlite_where=db.text('applied_at IS NULL'), postgresql_where=db.text('applied_at IS NULL')),
+    )
+    
+    @property
+    def status(self):
+        if self.applied_at is None:
+            return 'queued'
+        return 'rejected' if self.error else 'applied'
+    
+    def __repr__(self):
+        return f'<PunchEvent {self.id} {self.user_id} {self.kind}>'
+
+class DailyWorkRollup(db.Model):
+    """Closed timesheet entries summed per user, local work date and location"""
+    __tablename__ = 'daily_work_rollup'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    work_date = db.Column(db.Date, nullable=False, index=True)  # Clock-in date in the user's timezone
+    location = db.Column(db.String(50), nullable=False, default='Office')
+    worked_minutes = db.Column(db.Integer, nullable=False, default=0)  # Net of breaks, like TimesheetEntry.duration
+    break_minutes = db.Column(db.Integer, nullable=False, default=0)
+    sessions = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'work_date', 'location', name='uq_daily_work_rollup_user_date_location'),
+    )
+    
+    def __repr__(self):
+        return f'<DailyWorkRollup {self.user_id} {self.work_date} {self.location}>'
+
+class PayrollRun(db.Model):
+    """Persisted snapshot of a payroll run over a pay period"""
+    __tablename__ = 'payroll_run'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    period_start = db.Column(db.Date, nullable=False)
+    period_end = db.Column(db.Date, nullable=False)
+    employee_count = db.Column(db.Integer, default=0)
+    total_gross_pay = db.Column(db.Numeric(14, 2), default=0)
+    created_by = db.Column(db.Integer, db.ForeignKey('user.id'))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    # Relationships
+    lines = db.relationship('PayrollLine', backref='run', lazy=True, cascade='all, delete-orphan')
+    
+    def __repr__(self):
+        return f'<PayrollRun {self.id} {self.period_start}-{self.period_end}>'
+
+class PayrollLine(db.Model):
+    """One employee's hours and pay for one week of a payroll run (rates as they were at the run)"""
+    __tablename__ = 'payroll_line'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    run_id = db.Column(db.Integer, db.ForeignKey('payroll_run.id'), nullable=False, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    week_start = db.Column(db.Date, nullable=False)  # Monday
+    regular_minutes = db.Column(db.Integer, default=0)
+    overtime_minutes = db.Column(db.Integer, default=0)
+    hourly_rate = db.Column(db.Numeric(10, 2))
+    overtime_rate = db.Column(db.Numeric(10, 2))
+    regular_pay = db.Column(db.Numeric(12, 2), default=0)
+    overtime_pay = db.Column(db.Numeric(12, 2), default=0)
+    gross_pay = db.Column(db.Numeric(12, 2), default=0)
+    
+    __table_args__ = (
+        db.UniqueConstraint('run_id', 'user_id', 'week_start', name='uq_payroll_line_run_user_week'),
+    )
+    
+    def __repr__(self):
+        return f'<PayrollLine {self.run_id} {self.user_id} {self.week_start}>'
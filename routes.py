@@ -1,12 +1,15 @@
-from flask import Blueprint,render_template,render_template_string, flash, redirect, url_for, request, jsonify
+from flask import Blueprint,render_template,render_template_string, flash, redirect, url_for, request, jsonify, current_app, abort, stream_with_context
 from flask_login import login_user, logout_user, current_user, login_required
 from werkzeug.security import generate_password_hash, check_password_hash
 from models import  db
-from models import User, Department, AvailabilitySlot, BusySlot, LeaveDay, TimesheetEntry, UserStatus, BreakEntry
+from models import User, Department, AvailabilitySlot, BusySlot, LeaveDay, TimesheetEntry, UserStatus, BreakEntry, CalendarChange, DailyWorkRollup, PayrollRun, PayrollLine, PunchEvent
 from forms import LoginForm, RegistrationForm, AvailabilityForm, BusySlotForm, LeaveDayForm, ProfileForm, AddEmployeeForm, DepartmentForm
 from datetime import datetime, date, time
 from sqlalchemy.sql import func
+from sqlalchemy.exc import IntegrityError
 import json
+import heapq
+import secrets
 import sys
 import os
 from flask import make_response,send_file
@@ -25,8 +28,52 @@ from utils.timezone_helper import (
     convert_user_timezone_to_utc, 
     get_current_time_in_user_timezone,
     format_datetime_for_user,
-    get_user_timezone
+    get_user_timezone,
+    resolve_timezone,
+    utc_to_local,
+    convert_utc_column
 )
+from utils.calendar_events import (
+    select_calendar_users,
+    load_user_events,
+    parse_window_date,
+    feed_change_markers,
+    calendar_user_scope,
+    iter_scope_events
+)
+from utils.json_stream import wants_stream, iter_rows, iter_json_array, iter_json_object, streaming_json_response
+from utils.csv_stream import wants_gzip, iter_csv, iter_gzip
+from utils.change_log import latest_change_cursor, changes_since
+from utils.timeline import timeline_origin, build_user_timeline
+from utils.compact_events import encode_compact_events, compact_response, wants_msgpack
+from utils.scheduling import find_common_free_slots, MAX_FREE_SLOT_DAYS
+from utils.bulk_availability import ingest_availability, MAX_BULK_SLOTS
+from utils.recurrence import (
+    apply_recurrence,
+    add_recurrence_exception,
+    availability_window_criteria,
+    expand_availability,
+    occurrence_cache_stats
+)
+from utils.conditional import change_marker, compute_etag, not_modified, not_modified_since, with_etag
+from utils.ics import ics_window, iter_ics_calendar, ICS_CACHE_MAX_BYTES
+from utils.auto_checkout import auto_checkout_hours
+from utils.timesheet import (
+    active_timesheet_entry, close_timesheet_entry, end_breaks, update_break_total,
+    ENTRY_ORDER, ENTRY_PAGE_SIZE, MAX_ENTRY_PAGE_SIZE, encode_entry_cursor, entries_after
+)
+from utils.work_rollup import refresh_entries_rollup, total_timesheet_entries
+from utils.punch_queue import (
+    PUNCH_KINDS, MAX_PUNCH_BATCH_SIZE, record_punch, serialize_punch,
+    parse_punch_batch, record_punch_batch, apply_user_punches
+)
+from utils.payroll import (run_payroll, split_overtime, serialize_payroll_run, serialize_payroll_line,
+                           MAX_PAYROLL_DAYS)
+from utils.status_stream import load_team_status, public_team_status, iter_status_events, STATUS_STREAM_ENABLED
+from utils.presence import record_presence, pending_presence, effective_presence
+from utils.feed_cache import feed_cache, invalidate_user_feeds, invalidate_membership_feeds
+from utils.reference_cache import (reference_cache, cached_users, cached_departments,
+                                   invalidate_users, invalidate_departments)
 
 @main_bp.route('/')
 def index():
@@ -75,6 +122,7 @@ def register():
         )
         db.session.add(user)
         db.session.commit()
+        invalidate_users()
         flash('Registration successful! Your account is pending admin approval. You will be able to log in once approved.', 'info')
         return redirect(url_for('main.login'))
     
@@ -104,10 +152,12 @@ def add_department():
     if form.validate_on_submit():
         department = Department(
             name=form.name.data,
-            description=form.description.data
+            description=form.description.data,
+            auto_checkout_hours=form.auto_checkout_hours.data
         )
         db.session.add(department)
         db.session.commit()
+        invalidate_departments()
         flash(f'Department "{department.name}" created successfully!', 'success')
         return redirect(url_for('main.admin_departments'))
     
@@ -134,7 +184,9 @@ def edit_department(dept_id):
         
         department.name = form.name.data
         department.description = form.description.data
+        department.auto_checkout_hours = form.auto_checkout_hours.data
         db.session.commit()
+        invalidate_departments()
         flash(f'Department "{department.name}" updated successfully!', 'success')
         return redirect(url_for('main.admin_departments'))
     
@@ -184,8 +236,11 @@ def assign_employee_to_department(dept_id, user_id):
     department = Department.query.get_or_404(dept_id)
     user = User.query.get_or_404(user_id)
     
+    old_department_id = user.department_id
     user.department_id = dept_id
     db.session.commit()
+    invalidate_membership_feeds(user, old_department_id)
+    invalidate_users()
     
     return jsonify({
         'success': True,
@@ -201,8 +256,11 @@ def unassign_employee_from_department(dept_id, user_id):
     
     user = User.query.get_or_404(user_id)
     
+    old_department_id = user.department_id
     user.department_id = None
     db.session.commit()
+    invalidate_membership_feeds(user, old_department_id)
+    invalidate_users()
     
     return jsonify({
         'success': True,
@@ -228,6 +286,7 @@ def delete_department(dept_id):
     
     db.session.delete(department)
     db.session.commit()
+    invalidate_departments()
     
     return jsonify({
         'success': True,
@@ -262,6 +321,7 @@ def approve_user(user_id):
     user.approved_by = current_user.id
     user.approved_at = datetime.now()
     db.session.commit()
+    invalidate_users()
     
     return jsonify({
         'success': True, 
@@ -283,6 +343,7 @@ def reject_user(user_id):
     user.approved_by = current_user.id
     user.approved_at = datetime.now()
     db.session.commit()
+    invalidate_users()
     
     return jsonify({
         'success': True,
@@ -300,6 +361,20 @@ def pending_users_count():
     
     return jsonify({'success': True, 'count': count})
 
+@main_bp.route('/api/admin/cache-stats')
+@login_required
+def cache_stats():
+    """Get hit/miss counters for the server-side caches"""
+    if not current_user.is_admin:
+        return jsonify({'success': False, 'error': 'Access denied'}), 403
+    
+    return jsonify({
+        'success': True,
+        'feed_cache': feed_cache.stats(),
+        'recurrence_cache': occurrence_cache_stats(),
+        'reference_cache': reference_cache.stats()
+    })
+
 @main_bp.route('/admin/users/<int:user_id>/department', methods=['POST'])
 @login_required
 def update_user_department(user_id):
@@ -309,6 +384,7 @@ def update_user_department(user_id):
     
     data = request.get_json()
     user = User.query.get_or_404(user_id)
+    old_department_id = user.department_id
     
     department_id = data.get('department_id')
     if department_id:
@@ -323,20 +399,54 @@ def update_user_department(user_id):
         message = f'{user.username} removed from department'
     
     db.session.commit()
+    invalidate_membership_feeds(user, old_department_id)
+    invalidate_users()
     
     return jsonify({
         'success': True,
         'message': message
     })
 
+@main_bp.route('/admin/users/<int:user_id>/auto-checkout', methods=['POST'])
+@login_required
+def update_user_auto_checkout(user_id):
+    """Set or clear a user's auto-checkout threshold (null falls back to the department's)"""
+    if not current_user.is_admin:
+        return jsonify({'error': 'Access denied'}), 403
+    
+    data = request.get_json() or {}
+    user = User.query.get_or_404(user_id)
+    
+    hours = data.get('auto_checkout_hours')
+    if hours is not None:
+        try:
+            hours = float(hours)
+        except (TypeError, ValueError):
+            return jsonify({'error': 'auto_checkout_hours must be a number'}), 400
+        if not 0.5 <= hours <= 24:
+            return jsonify({'error': 'auto_checkout_hours must be between 0.5 and 24'}), 400
+    
+    user.auto_checkout_hours = hours
+    db.session.commit()
+    
+    return jsonify({
+        'success': True,
+        'auto_checkout_hours': auto_checkout_hours(user)
+    })
+
 @main_bp.route('/api/departments')
 @login_required
 def get_departments_api():
     """Get all departments for API use - accessible to all users"""
-    departments = Department.query.order_by(Department.name).all()
-    return jsonify({
+    etag = reference_cache.etag('departments')
+    response = not_modified(etag)
+    if response:
+        return response
+    
+    departments = cached_departments()
+    return with_etag(jsonify({
         'departments': [{'id': d.id, 'name': d.name, 'description': d.description} for d in departments]
-    })
+    }), etag)
 
 @main_bp.route('/logout')
 @login_required
@@ -349,9 +459,10 @@ def logout():
 @login_required
 def calendar():
     # All users can now view all employees and departments for filtering
-    users = User.query.all()
-    departments = Department.query.order_by(Department.name).all()
-    return render_template('calendar.html', users=users, departments=departments)
+    users = cached_users()
+    departments = cached_departments()
+    return render_template('calendar.html', users=users, departments=departments,
+                           status_stream_enabled=STATUS_STREAM_ENABLED)
 
 @main_bp.route('/profile', methods=['GET', 'POST'])
 @login_required
@@ -359,6 +470,7 @@ def profile():
     form = ProfileForm()
     
     if form.validate_on_submit():
+        old_department_id = current_user.department_id
         current_user.username = form.username.data
         current_user.email = form.email.data
         current_user.department_id = form.department_id.data
@@ -369,6 +481,8 @@ def profile():
         current_user.timezone = form.timezone.data
         
         db.session.commit()
+        invalidate_membership_feeds(current_user, old_department_id)
+        invalidate_users()
         flash('Profile updated successfully!', 'success')
         return redirect(url_for('main.profile'))
     
@@ -383,7 +497,7 @@ def profile():
             form.default_end_time.data = datetime.strptime(current_user.default_end_time, '%H:%M').time()
         form.timezone.data = current_user.timezone or 'UTC'
     
-    return render_template('profile.html', form=form)
+    return render_template('profile.html', form=form, calendar_feeds=calendar_feed_urls(current_user))
 
 @main_bp.route('/admin')
 @login_required
@@ -413,6 +527,7 @@ def add_employee():
         )
         db.session.add(user)
         db.session.commit()
+        invalidate_users()
         flash(f'Employee {user.username} added successfully!', 'success')
     else:
         for field, errors in form.errors.items():
@@ -452,6 +567,65 @@ def generate_user_color(user_id, username):
     color_index = (user_id - 1) % len(colors)
     return colors[color_index]
 
+EVENT_ID_PREFIXES = {'availability': 'avail', 'busy': 'busy', 'leave': 'leave'}
+
+def build_calendar_event(event_type, row, user):
+    """Build the FullCalendar event dict for an availability, busy or leave row"""
+    # Generate unique color for this user
+    user_color = generate_user_color(user.id, user.username)
+    
+    if event_type == 'availability':
+        event = {
+            'id': f'avail-{row.id}',
+            'title': f'{user.username} - Available',
+            'start': f'{row.date}T{row.start_time}',
+            'end': f'{row.date}T{row.end_time}',
+            'color': user_color,
+            'borderColor': user_color,
+            'backgroundColor': user_color + '20',  # 20% opacity background
+            'user_id': user.id,
+            'username': user.username,
+            'type': 'availability',
+            'display': 'block'  # For Gantt-like appearance
+        }
+        if row.recurring:
+            # Occurrence of a weekly rule - every occurrence carries the rule's id
+            event['recurring'] = True
+        return event
+    
+    if event_type == 'busy':
+        return {
+            'id': f'busy-{row.id}',
+            'title': f'{user.username} - {row.title}',
+            'start': f'{row.date}T{row.start_time}',
+            'end': f'{row.date}T{row.end_time}',
+            'color': user_color,
+            'borderColor': user_color,
+            'backgroundColor': user_color + '80',  # 80% opacity for busy
+            'user_id': user.id,
+            'username': user.username,
+            'type': 'busy',
+            'description': row.description,
+            'display': 'block'  # For Gantt-like appearance
+        }
+    
+    # Leave days - user color with pattern
+    return {
+        'id': f'leave-{row.id}',
+        'title': f'{user.username} - {row.leave_type}',
+        'start': f'{row.start_date}',
+        'end':f'{row.end_date}',
+        'allDay': True,
+        'color': user_color,
+        'borderColor': user_color,
+        'backgroundColor': user_color + '40',  # 40% opacity for leave
+        'user_id': user.id,
+        'username': user.username,
+        'type': 'leave',
+        'notes': row.notes,
+        'display': 'block'  # For Gantt-like appearance
+    }
+
 @main_bp.route('/api/events')
 @login_required
 def get_events():
@@ -460,110 +634,280 @@ def get_events():
     user_filter = request.args.get('user_id')
     department_filter = request.args.get('department_id')
     filter_type = request.args.get('filter_type', 'all')  # 'individual', 'department', 'all'
+    response_format = request.args.get('format', 'events')  # 'events' or dictionary-encoded 'compact'
+    window_start = parse_window_date(start_date)
+    window_end = parse_window_date(end_date)
+    compact = response_format == 'compact'
+    streaming = wants_stream() and not compact  # Compact payloads are small enough to buffer
+    encoding = 'msgpack' if compact and wants_msgpack() else 'json'
+    
+    # Serve repeat views of the same feed from the cache while its scope is unchanged
+    cache_key = ('events', response_format, encoding, filter_type, user_filter, department_filter,
+                 window_start, window_end)
+    cache_version = feed_cache.scope_version(filter_type, user_filter, department_filter)
+    cached = None if streaming else feed_cache.get(cache_key, cache_version)
+    if cached is not None:
+        cached_body, etag, change_cursor, mimetype = cached
+        response = not_modified(etag) or with_etag(
+            current_app.response_class(cached_body, mimetype=mimetype), etag)
+        response.headers['X-Changes-Cursor'] = str(change_cursor)
+        if compact:
+            response.vary.add('Accept')
+        return response
+    
+    # Read the sync cursor before the rows so clients replay anything written meanwhile
+    change_cursor = latest_change_cursor()
+    
+    # Answer If-None-Match from cheap change markers before building the feed
+    etag = compute_etag(cache_key, feed_change_markers(
+        filter_type, user_filter, department_filter, window_start, window_end))
+    response = not_modified(etag)
+    if response:
+        response.headers['X-Changes-Cursor'] = str(change_cursor)
+        if compact:
+            response.vary.add('Accept')
+        return response
+    
+    # Streaming mode writes events as they are read, grouped by type instead of by user,
+    # so memory stays flat for very large windows (not cached)
+    if streaming:
+        events = (
+            build_calendar_event(event_type, row, user)
+            for event_type, row, user in iter_scope_events(
+                filter_type, user_filter, department_filter, window_start, window_end)
+        )
+        response = streaming_json_response(iter_json_array(events))
+        response.headers['X-Changes-Cursor'] = str(change_cursor)
+        return with_etag(response, etag)
     
     events = []
     
     # All users can now see team events - determine which users to show based on filter type
-    if filter_type == 'individual' and user_filter:
-        if user_filter == 'all':
-            users = User.query.all()
-        else:
-            users = [User.query.get(int(user_filter))]
-    elif filter_type == 'department' and department_filter:
-        if department_filter == 'all':
-            users = User.query.all()
-        else:
-            users = User.query.filter_by(department_id=int(department_filter)).all()
-    elif filter_type == 'all':
-        users = User.query.all()
+    users = select_calendar_users(filter_type, user_filter, department_filter)
+    
+    # Fetch every event type for the selected users in a fixed number of queries,
+    # limited to the visible window
+    user_events = load_user_events([user.id for user in users], start=window_start, end=window_end)
+    
+    if compact:
+        # Users' names and colours are sent once; events refer to them by index
+        response = compact_response(encode_compact_events(
+            users, user_events, timeline_origin(user_events, window_start),
+            lambda user: generate_user_color(user.id, user.username)
+        ))
     else:
-        users = User.query.all()
+        for user in users:
+            for event_type in ('availability', 'busy', 'leave'):
+                for row in user_events[user.id][event_type]:
+                    events.append(build_calendar_event(event_type, row, user))
+        response = jsonify(events)
     
-    for user in users:
-        # Generate unique color for this user
-        user_color = generate_user_color(user.id, user.username)
-        
-        # Availability slots
-        availability_slots = AvailabilitySlot.query.filter_by(user_id=user.id).all()
-        for slot in availability_slots:
-            events.append({
-                'id': f'avail-{slot.id}',
-                'title': f'{user.username} - Available',
-                'start': f'{slot.date}T{slot.start_time}',
-                'end': f'{slot.date}T{slot.end_time}',
-                'color': user_color,
-                'borderColor': user_color,
-                'backgroundColor': user_color + '20',  # 20% opacity background
-                'user_id': user.id,
-                'username': user.username,
-                'type': 'availability',
-                'display': 'block'  # For Gantt-like appearance
-            })
-        
-        # Busy slots - darker version of user color
-        busy_slots = BusySlot.query.filter_by(user_id=user.id).all()
-        for slot in busy_slots:
-            # Create darker version for busy slots
-            busy_color = user_color.replace('#', '#') + 'DD'  # Darker opacity
-            events.append({
-                'id': f'busy-{slot.id}',
-                'title': f'{user.username} - {slot.title}',
-                'start': f'{slot.date}T{slot.start_time}',
-                'end': f'{slot.date}T{slot.end_time}',
-                'color': user_color,
-                'borderColor': user_color,
-                'backgroundColor': user_color + '80',  # 80% opacity for busy
-                'user_id': user.id,
-                'username': user.username,
-                'type': 'busy',
-                'description': slot.description,
-                'display': 'block'  # For Gantt-like appearance
-            })
-        
-        # Leave days - user color with pattern
-        leave_days = LeaveDay.query.filter_by(user_id=user.id,approved_status='approved'  # CRITICAL: Only show approved leaves
-        ).all()
-        for leave in leave_days:
-            events.append({
-                'id': f'leave-{leave.id}',
-                'title': f'{user.username} - {leave.leave_type}',
-                'start': f'{leave.start_date}',
-                'end':f'{leave.end_date}',
-                'allDay': True,
-                'color': user_color,
-                'borderColor': user_color,
-                'backgroundColor': user_color + '40',  # 40% opacity for leave
-                'user_id': user.id,
-                'username': user.username,
-                'type': 'leave',
-                'notes': leave.notes,
-                'display': 'block'  # For Gantt-like appearance
-            })
+    feed_cache.set(cache_key, cache_version, (response.get_data(), etag, change_cursor, response.mimetype))
+    response.headers['X-Changes-Cursor'] = str(change_cursor)
+    return with_etag(response, etag)
+
+@main_bp.route('/api/events/changes')
+@login_required
+def get_event_changes():
+    """Get calendar events added, modified or deleted since a sync cursor"""
+    since = request.args.get('since', type=int)
+    user_filter = request.args.get('user_id')
+    department_filter = request.args.get('department_id')
+    filter_type = request.args.get('filter_type', 'all')
+    
+    cursor = latest_change_cursor()
+    
+    # Without a valid cursor the client has to do a full fetch first
+    if since is None or since > cursor:
+        return jsonify({'cursor': cursor, 'reset': True, 'changed': [], 'deleted': []})
+    
+    upserts, deletes, truncated = changes_since(
+        since, calendar_user_scope(filter_type, user_filter, department_filter))
+    if truncated:
+        return jsonify({'cursor': cursor, 'reset': True, 'changed': [], 'deleted': []})
+    
+    # Load the current state of every upserted event, one query per event type
+    rows = {}
+    for model, event_type in ((AvailabilitySlot, 'availability'), (BusySlot, 'busy'), (LeaveDay, 'leave')):
+        ids = [event_id for kind, event_id in upserts if kind == event_type]
+        if ids:
+            for row in model.query.filter(model.id.in_(ids)).all():
+                rows[(event_type, row.id)] = row
+    
+    users = {}
+    owner_ids = {row.user_id for row in rows.values()}
+    if owner_ids:
+        users = {user.id: user for user in User.query.filter(User.id.in_(owner_ids)).all()}
+    
+    changed = []
+    for key in sorted(upserts):
+        row = rows.get(key)
+        # Rows deleted since, and leave that is no longer approved, are tombstones for the calendar
+        if row is None or (key[0] == 'leave' and row.approved_status != 'approved'):
+            deletes.add(key)
+            continue
+        # Recurring rules expand per window, which this endpoint does not know
+        if key[0] == 'availability' and row.recurring:
+            return jsonify({'cursor': cursor, 'reset': True, 'changed': [], 'deleted': []})
+        changed.append(build_calendar_event(key[0], row, users[row.user_id]))
+    
+    return jsonify({
+        'cursor': cursor,
+        'reset': False,
+        'changed': changed,
+        'deleted': [f'{EVENT_ID_PREFIXES[event_type]}-{event_id}' for event_type, event_id in sorted(deletes)]
+    })
+
+def calendar_feed_urls(user):
+    """ICS subscription URLs for a user, creating their feed token on first use"""
+    if not user.calendar_token:
+        user.calendar_token = secrets.token_urlsafe(24)
+        db.session.commit()
     
-    return jsonify(events)
+    urls = {
+        'team': url_for('main.team_calendar_feed', token=user.calendar_token, _external=True),
+        'personal': url_for('main.user_calendar_feed', token=user.calendar_token, user_id=user.id, _external=True)
+    }
+    if user.department_id:
+        urls['department'] = url_for('main.department_calendar_feed', token=user.calendar_token,
+                                     department_id=user.department_id, _external=True)
+    return urls
+
+def render_calendar_feed(name, filter_type, user_filter=None, department_filter=None):
+    """Stream an ICS feed for a calendar scope, serving repeat fetches from the feed cache"""
+    window_start, window_end = ics_window()
+    
+    cache_key = ('ics', filter_type, user_filter, department_filter, window_start, window_end)
+    cache_version = feed_cache.scope_version(filter_type, user_filter, department_filter)
+    cached = feed_cache.get(cache_key, cache_version)
+    if cached is not None:
+        body, etag, last_modified = cached
+        response = not_modified_since(etag, last_modified)
+        if response is None:
+            response = current_app.response_class(body, mimetype='text/calendar')
+            response.last_modified = last_modified
+            response = with_etag(response, etag)
+        return response
+    
+    markers = feed_change_markers(filter_type, user_filter, department_filter, window_start, window_end)
+    etag = compute_etag(cache_key, markers)
+    
+    # Deletions do not move any updated_at, so the change log counts too
+    user_scope = calendar_user_scope(filter_type, user_filter, department_filter)
+    last_change = db.session.query(db.func.max(CalendarChange.changed_at))
+    if user_scope is not None:
+        last_change = last_change.filter(CalendarChange.user_id.in_(db.select(User.id).where(user_scope)))
+    timestamps = [marker[1] for marker in markers if marker[1]] + [last_change.scalar()]
+    last_modified = max((timestamp for timestamp in timestamps if timestamp), default=None)
+    
+    response = not_modified_since(etag, last_modified)
+    if response:
+        return response
+    
+    def stream_and_cache(chunks):
+        # Keep a copy for the feed cache unless the document grows too large to hold
+        rendered, size = [], 0
+        for chunk in chunks:
+            if rendered is not None:
+                rendered.append(chunk)
+                size += len(chunk)
+                if size > ICS_CACHE_MAX_BYTES:
+                    rendered = None
+            yield chunk
+        if rendered is not None:
+            feed_cache.set(cache_key, cache_version, (''.join(rendered), etag, last_modified))
+    
+    events = iter_scope_events(filter_type, user_filter, department_filter, window_start, window_end)
+    response = current_app.response_class(
+        stream_with_context(stream_and_cache(iter_ics_calendar(f'TeamCal - {name}', events))),
+        mimetype='text/calendar'
+    )
+    response.last_modified = last_modified
+    return with_etag(response, etag)
+
+def get_feed_subscriber(token):
+    """The approved user a feed token belongs to, or 404"""
+    subscriber = User.query.filter_by(calendar_token=token).first()
+    if subscriber is None or subscriber.approval_status != 'approved':
+        abort(404)
+    return subscriber
+
+@main_bp.route('/calendar/feeds/<token>/team.ics')
+def team_calendar_feed(token):
+    get_feed_subscriber(token)
+    return render_calendar_feed('Team', 'all')
+
+@main_bp.route('/calendar/feeds/<token>/users/<int:user_id>.ics')
+def user_calendar_feed(token, user_id):
+    get_feed_subscriber(token)
+    user = User.query.get_or_404(user_id)
+    return render_calendar_feed(user.username, 'individual', user_filter=user.id)
+
+@main_bp.route('/calendar/feeds/<token>/departments/<int:department_id>.ics')
+def department_calendar_feed(token, department_id):
+    get_feed_subscriber(token)
+    department = Department.query.get_or_404(department_id)
+    return render_calendar_feed(department.name, 'department', department_filter=department.id)
+
+@main_bp.route('/api/calendar-feeds')
+@login_required
+def get_calendar_feeds():
+    """Get the current user's ICS subscription URLs"""
+    return jsonify({'success': True, 'feeds': calendar_feed_urls(current_user)})
+
+@main_bp.route('/api/calendar-feeds/reset', methods=['POST'])
+@login_required
+def reset_calendar_feeds():
+    """Replace the feed token, revoking every previously shared subscription URL"""
+    current_user.calendar_token = None
+    return jsonify({'success': True, 'feeds': calendar_feed_urls(current_user)})
 
 @main_bp.route('/api/gantt-data')
 @login_required
 def get_gantt_data():
+    start_date = request.args.get('start')
+    end_date = request.args.get('end')
     user_filter = request.args.get('user_id')
     department_filter = request.args.get('department_id')
     filter_type = request.args.get('filter_type', 'all')
+    response_format = request.args.get('format', 'events')  # 'events' or compact 'timeline'
+    window_start = parse_window_date(start_date)
+    window_end = parse_window_date(end_date)
+    
+    # Serve repeat views of the same timeline from the cache while its scope is unchanged
+    cache_key = ('gantt', response_format, filter_type, user_filter, department_filter, window_start, window_end)
+    cache_version = feed_cache.scope_version(filter_type, user_filter, department_filter)
+    cached = feed_cache.get(cache_key, cache_version)
+    if cached is not None:
+        cached_body, etag = cached
+        return not_modified(etag) or with_etag(
+            current_app.response_class(cached_body, mimetype='application/json'), etag)
+    
+    # Answer If-None-Match from cheap change markers before building the timeline
+    etag = compute_etag(cache_key, feed_change_markers(
+        filter_type, user_filter, department_filter, window_start, window_end,
+        approved_leave_only=False))
+    response = not_modified(etag)
+    if response:
+        return response
     
     # All users can now see team timeline data - determine which users to show based on filter type
-    if filter_type == 'individual' and user_filter:
-        if user_filter == 'all':
-            users = User.query.all()
-        else:
-            users = [User.query.get(int(user_filter))]
-    elif filter_type == 'department' and department_filter:
-        if department_filter == 'all':
-            users = User.query.all()
-        else:
-            users = User.query.filter_by(department_id=int(department_filter)).all()
-    elif filter_type == 'all':
-        users = User.query.all()
-    else:
-        users = User.query.all()
+    users = select_calendar_users(filter_type, user_filter, department_filter)
+    
+    # Fetch every event type for the selected users in a fixed number of queries,
+    # limited to the visible timeline window
+    events_by_user = load_user_events(
+        [user.id for user in users],
+        start=window_start,
+        end=window_end,
+        approved_leave_only=False
+    )
+    
+    if response_format == 'timeline':
+        gantt_data = build_gantt_timeline(users, events_by_user, window_start)
+        response = jsonify(gantt_data)
+        feed_cache.set(cache_key, cache_version, (response.get_data(), etag))
+        return with_etag(response, etag)
     
     gantt_data = {'users': []}
     
@@ -571,9 +915,7 @@ def get_gantt_data():
         user_color = generate_user_color(user.id, user.username)
         user_events = []
         
-        # Get all events for this user
-        availability_slots = AvailabilitySlot.query.filter_by(user_id=user.id).all()
-        for slot in availability_slots:
+        for slot in events_by_user[user.id]['availability']:
             user_events.append({
                 'id': f'avail-{slot.id}',
                 'title': f'{user.username} - Available',
@@ -582,8 +924,7 @@ def get_gantt_data():
                 'type': 'availability'
             })
         
-        busy_slots = BusySlot.query.filter_by(user_id=user.id).all()
-        for slot in busy_slots:
+        for slot in events_by_user[user.id]['busy']:
             user_events.append({
                 'id': f'busy-{slot.id}',
                 'title': f'{user.username} - {slot.title}',
@@ -592,8 +933,7 @@ def get_gantt_data():
                 'type': 'busy'
             })
         
-        leave_days = LeaveDay.query.filter_by(user_id=user.id).all()
-        for leave in leave_days:
+        for leave in events_by_user[user.id]['leave']:
             user_events.append({
                 'id': f'leave-{leave.id}',
                 'title': f'{user.username} - {leave.leave_type}',
@@ -611,7 +951,69 @@ def get_gantt_data():
                 'events': user_events
             })
     
-    return jsonify(gantt_data)
+    response = jsonify(gantt_data)
+    feed_cache.set(cache_key, cache_version, (response.get_data(), etag))
+    return with_etag(response, etag)
+
+def build_gantt_timeline(users, events_by_user, window_start=None):
+    """Compact Gantt payload: merged intervals per user as start/duration minute offsets from origin"""
+    origin = timeline_origin(events_by_user, window_start)
+    timeline = {'format': 'timeline', 'origin': origin.isoformat(), 'unit': 'minutes', 'users': []}
+    
+    for user in users:
+        user_events = events_by_user[user.id]
+        # Only include users who have events (availability, busy, or leave)
+        if not any(user_events.values()):
+            continue
+        
+        timeline['users'].append({
+            'id': user.id,
+            'username': user.username,
+            'color': generate_user_color(user.id, user.username),
+            **build_user_timeline(user_events, origin)
+        })
+    
+    return timeline
+
+@main_bp.route('/api/schedule/free-slots')
+@login_required
+def get_free_slots():
+    """Find windows when all the given users are available at the same time"""
+    try:
+        user_ids = [int(uid) for uid in request.args.get('user_ids', '').split(',') if uid.strip()]
+        start_date = datetime.strptime(request.args['start_date'], '%Y-%m-%d').date()
+        end_date = datetime.strptime(request.args['end_date'], '%Y-%m-%d').date()
+        min_duration = request.args.get('min_duration', 30, type=int)
+        work_start = datetime.strptime(request.args.get('work_start', '09:00'), '%H:%M').time()
+        work_end = datetime.strptime(request.args.get('work_end', '17:00'), '%H:%M').time()
+    except (KeyError, ValueError):
+        return jsonify({'success': False, 'error': 'user_ids, start_date and end_date (YYYY-MM-DD) are required; '
+                                                   'work_start and work_end must be HH:MM'}), 400
+    
+    user_ids = list(dict.fromkeys(user_ids))
+    if not user_ids:
+        return jsonify({'success': False, 'error': 'At least one user is required'}), 400
+    if end_date < start_date or (end_date - start_date).days >= MAX_FREE_SLOT_DAYS:
+        return jsonify({'success': False, 'error': f'Date range must be between 1 and {MAX_FREE_SLOT_DAYS} days'}), 400
+    if min_duration <= 0:
+        return jsonify({'success': False, 'error': 'min_duration must be a positive number of minutes'}), 400
+    
+    users = User.query.filter(User.id.in_(user_ids)).all()
+    if len(users) != len(user_ids):
+        return jsonify({'success': False, 'error': 'Unknown user'}), 404
+    
+    windows = find_common_free_slots(user_ids, start_date, end_date, min_duration, work_start, work_end)
+    
+    return jsonify({
+        'success': True,
+        'users': [{'id': user.id, 'username': user.username} for user in users],
+        'slots': [{
+            'date': start.date().isoformat(),
+            'start': start.isoformat(),
+            'end': end.isoformat(),
+            'duration_minutes': int((end - start).total_seconds() // 60)
+        } for start, end in windows]
+    })
 
 @main_bp.route('/api/availability', methods=['POST'])
 @login_required
@@ -624,11 +1026,16 @@ def add_availability():
             date=datetime.strptime(data['date'], '%Y-%m-%d').date(),
             start_time=datetime.strptime(data['start_time'], '%H:%M').time(),
             end_time=datetime.strptime(data['end_time'], '%H:%M').time(),
-            recurring=data.get('recurring', False)
+            recurring=False
         )
         
+        # A recurring slot is stored once as a weekly rule and expanded per requested window
+        if data.get('recurring'):
+            apply_recurrence(slot, data)
+        
         db.session.add(slot)
         db.session.commit()
+        invalidate_user_feeds(current_user)
         
         return jsonify({'success': True, 'id': slot.id})
     except Exception as e:
@@ -655,40 +1062,23 @@ def add_multi_availability():
         if start_time >= end_time:
             return jsonify({'success': False, 'error': 'End time must be after start time'}), 400
         
-        # Create availability slots for all dates
-        slots_created = 0
-        errors = []
-        
-        for date_str in dates:
-            try:
-                # Check if availability already exists for this date and time
-                date_obj = datetime.strptime(date_str, '%Y-%m-%d').date()
-                existing = AvailabilitySlot.query.filter_by(
-                    user_id=current_user.id,
-                    date=date_obj,
-                    start_time=start_time,
-                    end_time=end_time
-                ).first()
-                
-                if not existing:
-                    slot = AvailabilitySlot(
-                        user_id=current_user.id,
-                        date=date_obj,
-                        start_time=start_time,
-                        end_time=end_time,
-                        recurring=False
-                    )
-                    db.session.add(slot)
-                    slots_created += 1
-                else:
-                    errors.append(f"Availability already exists for {date_str}")
-                    
-            except Exception as e:
-                errors.append(f"Error creating slot for {date_str}: {str(e)}")
+        # Create availability slots for all dates, checking for existing ones in a single query
+        results = ingest_availability(
+            [{'date': date_str, 'start_time': start_time_str, 'end_time': end_time_str} for date_str in dates],
+            current_user.id,
+            {current_user.id}
+        )
+        slots_created = sum(1 for result in results if result['status'] == 'created')
+        errors = [
+            f"Availability already exists for {date_str}" if result['status'] == 'duplicate'
+            else f"Error creating slot for {date_str}: {result['error']}"
+            for date_str, result in zip(dates, results) if result['status'] != 'created'
+        ]
         
         # Commit all changes
         if slots_created > 0:
             db.session.commit()
+            invalidate_user_feeds(current_user)
         
         # Prepare response
         response_data = {
@@ -706,6 +1096,45 @@ def add_multi_availability():
         db.session.rollback()
         return jsonify({'success': False, 'error': str(e)}), 400
 
+@main_bp.route('/api/availability/bulk', methods=['POST'])
+@login_required
+def add_bulk_availability():
+    """Add many availability slots at once; admins may add them for any user"""
+    data = request.get_json(silent=True) or {}
+    items = data.get('slots')
+    
+    if not isinstance(items, list) or not items:
+        return jsonify({'success': False, 'error': 'slots must be a non-empty list'}), 400
+    if len(items) > MAX_BULK_SLOTS:
+        return jsonify({'success': False, 'error': f'At most {MAX_BULK_SLOTS} slots per request'}), 400
+    
+    try:
+        items = [item if isinstance(item, dict) else {} for item in items]
+        requested = {str(item.get('user_id')) for item in items}
+        user_ids = {int(user_id) for user_id in requested if user_id.isdigit()} | {current_user.id}
+        users = {user.id: user for user in User.query.filter(User.id.in_(user_ids)).all()}
+        allowed_user_ids = set(users) if current_user.is_admin else {current_user.id}
+        
+        results = ingest_availability(items, current_user.id, allowed_user_ids)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'error': str(e)}), 400
+    
+    # Invalidate the cached feeds of everyone who gained slots
+    owner_ids = {
+        int(items[result['index']].get('user_id') or current_user.id)
+        for result in results if result['status'] == 'created'
+    }
+    for user_id in owner_ids:
+        invalidate_user_feeds(users[user_id])
+    
+    summary = {'created': 0, 'duplicate': 0, 'error': 0}
+    for result in results:
+        summary[result['status']] += 1
+    
+    return jsonify({'success': True, 'summary': summary, 'results': results})
+
 @main_bp.route('/api/busy', methods=['POST'])
 @login_required
 def add_busy_slot():
@@ -723,6 +1152,7 @@ def add_busy_slot():
         
         db.session.add(slot)
         db.session.commit()
+        invalidate_user_feeds(current_user)
         
         return jsonify({'success': True, 'id': slot.id})
     except Exception as e:
@@ -768,8 +1198,10 @@ def update_event(event_type, event_id):
         if event.user_id != current_user.id and not current_user.is_admin:
             return jsonify({'success': False, 'error': 'Access denied'}), 403
         
-        # Update common fields
-        event.date = datetime.strptime(data['date'], '%Y-%m-%d').date()
+        # Update common fields - a recurring rule keeps its first date, editing one
+        # occurrence changes the times of the whole series
+        if not (event_type == 'availability' and event.recurring):
+            event.date = datetime.strptime(data['date'], '%Y-%m-%d').date()
         
         # Update type-specific fields
         if event_type == 'availability':
@@ -785,6 +1217,7 @@ def update_event(event_type, event_id):
             event.notes = data.get('notes', '')
         
         db.session.commit()
+        invalidate_user_feeds(event.user)
         return jsonify({'success': True, 'id': event.id})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 400
@@ -806,8 +1239,15 @@ def delete_event(event_type, event_id):
         if event.user_id != current_user.id and not current_user.is_admin:
             return jsonify({'success': False, 'error': 'Access denied'}), 403
         
-        db.session.delete(event)
+        owner = event.user
+        occurrence_date = request.args.get('date')
+        if event_type == 'availability' and event.recurring and occurrence_date:
+            # Deleting a single occurrence of a recurring slot skips that date
+            add_recurrence_exception(event, datetime.strptime(occurrence_date, '%Y-%m-%d').date())
+        else:
+            db.session.delete(event)
         db.session.commit()
+        invalidate_user_feeds(owner)
         
         return jsonify({'success': True})
     except Exception as e:
@@ -818,7 +1258,7 @@ def delete_event(event_type, event_id):
 @login_required
 def timesheet():
     """Timesheet view for logging work hours"""
-    return render_template('timesheet.html')
+    return render_template('timesheet.html', status_stream_enabled=STATUS_STREAM_ENABLED)
 
 @main_bp.route('/timesheet/weekly')
 @login_required
@@ -847,7 +1287,7 @@ def weekly_timesheet():
         TimesheetEntry.user_id == current_user.id,
         TimesheetEntry.date >= week_start,
         TimesheetEntry.date <= week_end
-    ).order_by(TimesheetEntry.date).all()
+    ).order_by(TimesheetEntry.date, TimesheetEntry.clock_in).all()
     
     # Get break entries for all timesheet entries this week
     entry_ids = [entry.id for entry in entries]
@@ -870,18 +1310,17 @@ def weekly_timesheet():
     for i in range(7):
         current_date = week_start + timedelta(days=i)
         
-        # Find entry for this date
-        day_entry = None
-        for entry in entries:
-            if entry.date == current_date:
-                day_entry = entry
-                break
+        # Find every entry for this date (a day can have several sessions)
+        day_entries = [entry for entry in entries if entry.date == current_date]
         
-        if day_entry:
+        if day_entries:
+            day_entry = day_entries[0]
+            last_entry = day_entries[-1]
+            
             # Calculate lunch break times
             lunch_out = None
             lunch_in = None
-            entry_breaks = breaks.get(day_entry.id, [])
+            entry_breaks = [break_entry for entry in day_entries for break_entry in breaks.get(entry.id, [])]
             
             # Find longest break (assumed to be lunch)
             longest_break = None
@@ -893,7 +1332,7 @@ def weekly_timesheet():
                 lunch_out = convert_utc_to_user_timezone(longest_break.break_start)
                 lunch_in = convert_utc_to_user_timezone(longest_break.break_end)
             
-            daily_hours = day_entry.duration / 60  # Convert minutes to hours
+            daily_hours = sum(entry.duration for entry in day_entries) / 60  # Convert minutes to hours
             total_hours += daily_hours
             cumulative_hours += daily_hours
             
@@ -904,7 +1343,7 @@ def weekly_timesheet():
                 'start_time': convert_utc_to_user_timezone(day_entry.clock_in) if day_entry.clock_in else None,
                 'lunch_out': lunch_out,
                 'lunch_in': lunch_in,
-                'end_time': convert_utc_to_user_timezone(day_entry.clock_out) if day_entry.clock_out else None,
+                'end_time': convert_utc_to_user_timezone(last_entry.clock_out) if last_entry.clock_out else None,
                 'daily_hours': daily_hours,
                 'cumulative_hours': cumulative_hours
             })
@@ -923,8 +1362,7 @@ def weekly_timesheet():
     
     # Calculate overtime
     standard_hours = current_user.standard_hours or 40
-    overtime_hours = max(0, total_hours - standard_hours)
-    regular_hours = min(total_hours, standard_hours)
+    regular_hours, overtime_hours = split_overtime(total_hours, standard_hours)
     
     # Calculate pay
     regular_pay = regular_hours * float(current_user.hourly_rate or 0)
@@ -956,12 +1394,10 @@ def clock_in():
     """Clock in user and start timesheet entry"""
     try:
         data = request.get_json() or {}
+        user_status = UserStatus.query.filter_by(user_id=current_user.id).first()
         
         # Check if user is already clocked in
-        active_entry = TimesheetEntry.query.filter_by(
-            user_id=current_user.id,
-            clock_out=None
-        ).first()
+        active_entry = active_timesheet_entry(current_user.id, user_status)
         
         if active_entry:
             return jsonify({'success': False, 'error': 'Already clocked in'}), 400
@@ -977,10 +1413,14 @@ def clock_in():
         )
         
         db.session.add(entry)
-        db.session.flush()  # Ensure entry.id is available
+        try:
+            db.session.flush()  # Ensure entry.id is available
+        except IntegrityError:
+            # A concurrent clock-in won the unique index on open entries
+            db.session.rollback()
+            return jsonify({'success': False, 'error': 'Already clocked in'}), 400
         
         # Update user status
-        user_status = UserStatus.query.filter_by(user_id=current_user.id).first()
         if not user_status:
             user_status = UserStatus(user_id=current_user.id)
             db.session.add(user_status)
@@ -1012,45 +1452,21 @@ def clock_out():
     """Clock out user and complete timesheet entry"""
     try:
         data = request.get_json() or {}
+        user_status = UserStatus.query.filter_by(user_id=current_user.id).first()
         
         # Find active timesheet entry
-        entry = TimesheetEntry.query.filter_by(
-            user_id=current_user.id,
-            clock_out=None
-        ).first()
+        entry = active_timesheet_entry(current_user.id, user_status)
         
         if not entry:
             return jsonify({'success': False, 'error': 'Not clocked in'}), 400
         
-        # End any active breaks first
-        active_breaks = BreakEntry.query.filter_by(
-            user_id=current_user.id,
-            timesheet_entry_id=entry.id,
-            break_end=None
-        ).all()
-        
-        clock_out_time = datetime.utcnow()
-        for break_entry in active_breaks:
-            break_entry.break_end = clock_out_time
-        
-        # Calculate total break duration from BreakEntry records
-        total_break_duration = db.session.query(
-            db.func.sum(
-                db.func.extract('epoch', BreakEntry.break_end - BreakEntry.break_start) / 60
-            )
-        ).filter(
-            BreakEntry.timesheet_entry_id == entry.id,
-            BreakEntry.break_end.isnot(None)
-        ).scalar() or 0
-        
-        # Update timesheet entry
-        entry.clock_out = clock_out_time
-        entry.break_duration = int(total_break_duration)  # Server-authoritative break duration
+        # End any active breaks, then store the break and work minutes
+        close_timesheet_entry(entry, datetime.utcnow())
         if data.get('notes'):
             entry.notes = data.get('notes')
+        refresh_entries_rollup([(entry.user_id, entry.clock_in)])
         
         # Update user status
-        user_status = UserStatus.query.filter_by(user_id=current_user.id).first()
         if user_status:
             user_status.is_working = False
             user_status.current_timesheet_id = None
@@ -1080,10 +1496,8 @@ def start_break():
     """Start a break for the current user"""
     try:
         # Check if user is currently clocked in
-        active_entry = TimesheetEntry.query.filter_by(
-            user_id=current_user.id,
-            clock_out=None
-        ).first()
+        user_status = UserStatus.query.filter_by(user_id=current_user.id).first()
+        active_entry = active_timesheet_entry(current_user.id, user_status)
         
         if not active_entry:
             return jsonify({'success': False, 'error': 'You must be clocked in to start a break'}), 400
@@ -1109,10 +1523,10 @@ def start_break():
         db.session.add(break_entry)
         
         # Update user status to "On Break"
-        user_status = UserStatus.query.filter_by(user_id=current_user.id).first()
         if user_status:
             user_status.status_message = 'On Break'
             user_status.current_task = f"On {break_entry.break_type}"
+            user_status.last_activity = datetime.utcnow()
             user_status.updated_at = datetime.now()
         
         db.session.commit()
@@ -1142,26 +1556,21 @@ def end_break():
             return jsonify({'success': False, 'error': 'No active break found'}), 400
         
         # End the break
-        active_break.break_end = datetime.now()
+        end_breaks([active_break], datetime.utcnow())
         
         # Update the timesheet entry's break duration
-        timesheet_entry = active_break.timesheet_entry
-        total_break_duration = db.session.query(
-            db.func.sum(
-                db.func.extract('epoch', BreakEntry.break_end - BreakEntry.break_start) / 60
-            )
-        ).filter(
-            BreakEntry.timesheet_entry_id == timesheet_entry.id,
-            BreakEntry.break_end.isnot(None)
-        ).scalar() or 0
-        
-        timesheet_entry.break_duration = int(total_break_duration) + active_break.duration
+        timesheet_entry = db.session.get(TimesheetEntry, active_break.timesheet_entry_id)
+        update_break_total(timesheet_entry)
+        if timesheet_entry.clock_out is not None:
+            # A break left open past clock-out changes a day already rolled up
+            refresh_entries_rollup([(timesheet_entry.user_id, timesheet_entry.clock_in)])
         
         # Update user status back to Available
         user_status = UserStatus.query.filter_by(user_id=current_user.id).first()
         if user_status:
             user_status.status_message = 'Available'
             user_status.current_task = request.json.get('task', '')
+            user_status.last_activity = datetime.utcnow()
             user_status.updated_at = datetime.now()
         
         db.session.commit()
@@ -1176,21 +1585,110 @@ def end_break():
         db.session.rollback()
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@main_bp.route('/api/timesheet/punches', methods=['POST'])
+@login_required
+def submit_punch():
+    """Log a clock-in, clock-out or break punch and acknowledge it before it reaches the timesheet"""
+    try:
+        data = request.get_json() or {}
+        kind = data.get('kind')
+        if kind not in PUNCH_KINDS:
+            return jsonify({'success': False, 'error': f"kind must be one of: {', '.join(PUNCH_KINDS)}"}), 400
+        
+        # A retried punch carries the same key and gets the original punch back
+        idempotency_key = request.headers.get('Idempotency-Key') or data.get('idempotency_key')
+        if idempotency_key and len(idempotency_key) > 64:
+            return jsonify({'success': False, 'error': 'Idempotency key is limited to 64 characters'}), 400
+        
+        punch, created = record_punch(
+            current_user.id, kind, idempotency_key,
+            location=data.get('location'),
+            notes=data.get('notes'),
+            task=data.get('task'),
+            break_type=data.get('break_type')
+        )
+        return jsonify({'success': True, 'punch': serialize_punch(punch), 'duplicate': not created}), 202
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@main_bp.route('/api/timesheet/punches/batch', methods=['POST'])
+@login_required
+def sync_punch_batch():
+    """Record and apply an ordered list of punches for many users (time clocks replaying offline punches)"""
+    if not current_user.is_admin:
+        return jsonify({'success': False, 'error': 'Access denied'}), 403
+    try:
+        data = request.get_json() or {}
+        raw_punches = data.get('punches')
+        if not isinstance(raw_punches, list) or not raw_punches:
+            return jsonify({'success': False, 'error': 'punches must be a non-empty list'}), 400
+        if len(raw_punches) > MAX_PUNCH_BATCH_SIZE:
+            return jsonify({'success': False, 'error': f'At most {MAX_PUNCH_BATCH_SIZE} punches per batch'}), 400
+        device_id = data.get('device_id')
+        if device_id is not None and (not isinstance(device_id, str) or len(device_id) > 64):
+            return jsonify({'success': False, 'error': 'device_id must be a string of at most 64 characters'}), 400
+        
+        # Log first (durable once committed), then fold into timesheets in one transaction;
+        # anything the fold cannot apply stays queued for the background applier
+        parsed = parse_punch_batch(raw_punches, device_id)
+        recorded = iter(record_punch_batch([item for item, _ in parsed if item]))
+        outcomes = [(next(recorded) if item else None, error) for item, error in parsed]
+        punch_ids = [punch.id for punch, _ in filter(None, (outcome for outcome, _ in outcomes))]
+        if punch_ids:
+            apply_user_punches({item['user_id'] for item, _ in parsed if item})
+            # One query refreshes every punch's outcome
+            PunchEvent.query.filter(PunchEvent.id.in_(punch_ids)).all()
+        
+        results = []
+        for index, (outcome, error) in enumerate(outcomes):
+            if outcome is None:
+                results.append({'index': index, 'status': 'invalid', 'error': error})
+                continue
+            punch, created = outcome
+            results.append({
+                'index': index,
+                'punch_id': punch.id,
+                'user_id': punch.user_id,
+                'kind': punch.kind,
+                'status': punch.status,
+                'error': punch.error,
+                'entry_id': punch.timesheet_entry_id,
+                'duplicate': not created
+            })
+        statuses = [result['status'] for result in results]
+        return jsonify({
+            'success': True,
+            'results': results,
+            'applied': statuses.count('applied'),
+            'rejected': statuses.count('rejected'),
+            'invalid': statuses.count('invalid'),
+            'queued': statuses.count('queued')
+        })
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@main_bp.route('/api/timesheet/punches/<int:punch_id>', methods=['GET'])
+@login_required
+def get_punch(punch_id):
+    """Whether a logged punch has been applied (or why it was rejected)"""
+    punch = db.session.get(PunchEvent, punch_id)
+    if punch is None or (punch.user_id != current_user.id and not current_user.is_admin):
+        return jsonify({'success': False, 'error': 'Punch not found'}), 404
+    return jsonify({'success': True, 'punch': serialize_punch(punch)})
+
 @main_bp.route('/api/timesheet/status', methods=['GET'])
 @login_required
 def get_timesheet_status():
     """Get current timesheet status for user"""
     try:
-        # Check for auto-checkout first
-        check_and_perform_auto_checkout(current_user.id)
-        
         # Check for active entry
-        active_entry = TimesheetEntry.query.filter_by(
-            user_id=current_user.id,
-            clock_out=None
-        ).first()
-        
         user_status = UserStatus.query.filter_by(user_id=current_user.id).first()
+        active_entry = active_timesheet_entry(current_user.id, user_status)
+        if user_status:
+            status_message, current_task, _ = effective_presence(
+                user_status, pending_presence([current_user.id]).get(current_user.id))
         
         if active_entry:
             return jsonify({
@@ -1200,60 +1698,20 @@ def get_timesheet_status():
                 'clock_in': active_entry.clock_in.isoformat(),
                 'current_duration': (datetime.utcnow() - active_entry.clock_in).total_seconds() / 60,
                 'location': active_entry.location,
-                'current_task': user_status.current_task if user_status else '',
-                'status_message': user_status.status_message if user_status else 'Available'
+                'current_task': current_task if user_status else '',
+                'status_message': status_message if user_status else 'Available',
+                'auto_checkout_hours': auto_checkout_hours(current_user)
             })
         else:
             return jsonify({
                 'success': True,
                 'is_clocked_in': False,
                 'current_duration': 0,
-                'status_message': user_status.status_message if user_status else 'Offline'
+                'status_message': status_message if user_status else 'Offline'
             })
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
-def check_and_perform_auto_checkout(user_id):
-    """Check if a user should be automatically clocked out after 6 hours"""
-    try:
-        # Find active timesheet entry
-        active_entry = TimesheetEntry.query.filter_by(
-            user_id=user_id,
-            clock_out=None
-        ).first()
-        
-        if not active_entry:
-            return False
-        
-        # Calculate hours worked
-        utc_now = datetime.utcnow()
-        hours_worked = (utc_now - active_entry.clock_in).total_seconds() / 3600
-        
-        # Auto-checkout after 6 hours
-        if hours_worked >= 6:
-            # Perform automatic checkout
-            active_entry.clock_out = utc_now
-            # Note: duration is calculated automatically via @property, don't set it directly
-            existing_notes = active_entry.notes or ''
-            active_entry.notes = existing_notes + ' [Auto-checkout after 6 hours]' if existing_notes else '[Auto-checkout after 6 hours]'
-            
-            # Update user status
-            user_status = UserStatus.query.filter_by(user_id=user_id).first()
-            if user_status:
-                user_status.is_working = False
-                user_status.current_timesheet_id = None
-                user_status.status_message = 'Offline'
-                user_status.last_activity = utc_now
-            
-            db.session.commit()
-            return True
-            
-        return False
-        
-    except Exception as e:
-        print(f"Error in auto-checkout for user {user_id}: {str(e)}")
-        return False
-
 @main_bp.route('/api/timesheet/update-status', methods=['POST'])
 @login_required
 def update_user_status():
@@ -1262,21 +1720,30 @@ def update_user_status():
         data = request.get_json()
         
         user_status = UserStatus.query.filter_by(user_id=current_user.id).first()
+        leaving_break = (user_status is not None and
+                         user_status.status_message == 'On Break' and
+                         'status_message' in data and
+                         data['status_message'] != 'On Break')
+        if user_status and not leaving_break:
+            # A plain status or task change is written behind, batched with everyone else's
+            record_presence(current_user.id, datetime.utcnow(),
+                            **{field: data[field] for field in ('status_message', 'current_task') if field in data})
+            return jsonify({
+                'success': True,
+                'message': 'Status updated successfully',
+                'break_ended': False
+            })
+        
         if not user_status:
             user_status = UserStatus(user_id=current_user.id)
             db.session.add(user_status)
         
         # Check if user is changing away from "On Break" status
         break_ended = False
-        if (user_status.status_message == 'On Break' and 
-            'status_message' in data and 
-            data['status_message'] != 'On Break'):
+        if leaving_break:
             
             # Find active timesheet entry first
-            active_timesheet = TimesheetEntry.query.filter_by(
-                user_id=current_user.id,
-                clock_out=None
-            ).first()
+            active_timesheet = active_timesheet_entry(current_user.id, user_status)
             
             if active_timesheet:
                 # End any active breaks for this timesheet entry
@@ -1286,22 +1753,12 @@ def update_user_status():
                     break_end=None
                 ).all()
                 
-                for break_entry in active_breaks:
-                    break_entry.break_end = datetime.now()
-                    break_ended = True
+                end_breaks(active_breaks, datetime.utcnow())
                 
                 if active_breaks:
                     # Recalculate total break duration for the timesheet entry
-                    total_break_duration = db.session.query(
-                        db.func.sum(
-                            db.func.extract('epoch', BreakEntry.break_end - BreakEntry.break_start) / 60
-                        )
-                    ).filter(
-                        BreakEntry.timesheet_entry_id == active_timesheet.id,
-                        BreakEntry.break_end.isnot(None)
-                    ).scalar() or 0
-                    
-                    active_timesheet.break_duration = int(total_break_duration)
+                    break_ended = True
+                    update_break_total(active_timesheet)
         
         if 'status_message' in data:
             user_status.status_message = data['status_message']
@@ -1330,44 +1787,7 @@ def get_team_status():
         if not current_user.is_admin:
             return jsonify({'success': False, 'error': 'Access denied'}), 403
         
-        # Get all users with their status and active timesheets in bulk
-        users_query = db.session.query(User, UserStatus).outerjoin(UserStatus).all()
-        
-        # Check for auto-checkout for all users before fetching status
-        user_ids = [user.id for user, _ in users_query]
-        for user_id in user_ids:
-            check_and_perform_auto_checkout(user_id)
-        
-        # Bulk fetch active timesheet entries to avoid N+1 queries (after auto-checkout checks)
-        active_entries = db.session.query(TimesheetEntry).filter(
-            TimesheetEntry.user_id.in_(user_ids),
-            TimesheetEntry.clock_out.is_(None)
-        ).all()
-        active_entries_by_user = {entry.user_id: entry for entry in active_entries}
-        
-        team_status = []
-        for user, status in users_query:
-            active_entry = active_entries_by_user.get(user.id)
-            
-            # Determine status message safely
-            if active_entry:
-                status_msg = (status.status_message if status else None) or 'Working'
-            else:
-                status_msg = (status.status_message if status else None) or 'Offline'
-            
-            team_status.append({
-                'user_id': user.id,
-                'username': user.username,
-                'is_working': status.is_working if status else False,
-                'is_clocked_in': active_entry is not None,
-                'status_message': status_msg,
-                'current_task': status.current_task if status else '',
-                'last_activity': status.last_activity.isoformat() if status and status.last_activity else None,
-                'clock_in_time': active_entry.clock_in.isoformat() if active_entry else None,
-                'current_duration': (datetime.utcnow() - active_entry.clock_in).total_seconds() / 60 if active_entry else 0
-            })
-        
-        return jsonify({'success': True, 'team_status': team_status})
+        return jsonify({'success': True, 'team_status': load_team_status()})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
@@ -1376,47 +1796,28 @@ def get_team_status():
 def get_public_team_status():
     """Get public team status (limited info for non-admin users)"""
     try:
-        # Get all users with their status (limited info)
-        users_query = db.session.query(User, UserStatus).outerjoin(UserStatus).all()
-        
-        # Bulk fetch active timesheet entries to avoid N+1 queries
-        user_ids = [user.id for user, _ in users_query]
-        active_entries = db.session.query(TimesheetEntry).filter(
-            TimesheetEntry.user_id.in_(user_ids),
-            TimesheetEntry.clock_out.is_(None)
-        ).all()
-        active_entries_by_user = {entry.user_id: entry for entry in active_entries}
-        
-        public_status = []
-        for user, status in users_query:
-            active_entry = active_entries_by_user.get(user.id)
-            
-            # Only show basic info for public status
-            if status and status.is_working and active_entry:
-                public_status.append({
-                    'user_id': user.id,
-                    'username': user.username,
-                    'is_working': True,
-                    'is_clocked_in': True,
-                    'status_message': status.status_message or 'Working',
-                    'current_task': status.current_task if status.current_task else '',
-                    'current_duration': (datetime.utcnow() - active_entry.clock_in).total_seconds() / 60
-                })
-            elif active_entry:  # User is clocked in but no status record
-                public_status.append({
-                    'user_id': user.id,
-                    'username': user.username,
-                    'is_working': True,
-                    'is_clocked_in': True,
-                    'status_message': 'Working',
-                    'current_task': '',
-                    'current_duration': (datetime.utcnow() - active_entry.clock_in).total_seconds() / 60
-                })
-        
-        return jsonify({'success': True, 'public_status': public_status})
+        return jsonify({'success': True, 'public_status': public_team_status(load_team_status())})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@main_bp.route('/api/team/status/stream', methods=['GET'])
+@login_required
+def stream_team_status():
+    """Live team status as Server-Sent Events: a snapshot, then deltas as statuses change.
+    
+    Admins get the rows of /api/team/status, everyone else those of
+    /api/team/public-status. The polling endpoints stay as the fallback.
+    Off unless STATUS_STREAM_ENABLED, since every open stream holds a
+    worker; 204 tells EventSource not to reconnect.
+    """
+    if not STATUS_STREAM_ENABLED:
+        return '', 204
+    events = iter_status_events(current_app._get_current_object(), public=not current_user.is_admin)
+    response = current_app.response_class(stream_with_context(events), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # Keep nginx from buffering the stream
+    return response
+
 @main_bp.route('/analytics')
 @login_required
 def analytics():
@@ -1428,7 +1829,7 @@ def analytics():
     
     # Get basic stats for the template
     total_users = User.query.count()
-    total_entries = TimesheetEntry.query.count()
+    total_entries = total_timesheet_entries()
     
     # Get users for filter dropdown
     users = User.query.order_by(User.username).all()
@@ -1454,40 +1855,25 @@ def analytics_overview():
         
         # Basic counts
         total_users = User.query.count()
-        total_entries = TimesheetEntry.query.count()
+        total_entries = total_timesheet_entries()
         active_users = db.session.query(UserStatus).filter_by(is_working=True).count()
         
         # Date range for filtering
         from datetime import datetime, timedelta
-        end_date = datetime.now()
+        end_date = datetime.now().date()
         start_date = end_date - timedelta(days=days)
+        week_start = end_date - timedelta(days=end_date.weekday())
         
-        # Total hours worked (within selected time range)
-        total_hours_result = db.session.query(
-            db.func.sum(
-                db.func.extract('epoch', TimesheetEntry.clock_out - TimesheetEntry.clock_in) / 3600
-            ).label('total_hours')
-        ).filter(
-            TimesheetEntry.clock_out.isnot(None),
-            TimesheetEntry.clock_in >= start_date
-        ).scalar()
-        
-        total_hours = float(total_hours_result) if total_hours_result else 0
-        
-        # This week's hours
-        week_start = datetime.now() - timedelta(days=datetime.now().weekday())
-        week_start = week_start.replace(hour=0, minute=0, second=0, microsecond=0)
-        
-        week_hours_result = db.session.query(
-            db.func.sum(
-                db.func.extract('epoch', TimesheetEntry.clock_out - TimesheetEntry.clock_in) / 3600
-            ).label('week_hours')
+        # Total and this week's hours worked, from the daily rollup
+        total_minutes, week_minutes = db.session.query(
+            db.func.sum(db.case((DailyWorkRollup.work_date >= start_date, DailyWorkRollup.worked_minutes), else_=0)),
+            db.func.sum(db.case((DailyWorkRollup.work_date >= week_start, DailyWorkRollup.worked_minutes), else_=0))
         ).filter(
-            TimesheetEntry.clock_out.isnot(None),
-            TimesheetEntry.clock_in >= week_start
-        ).scalar()
+            DailyWorkRollup.work_date >= min(start_date, week_start)
+        ).one()
         
-        week_hours = float(week_hours_result) if week_hours_result else 0
+        total_hours = float(total_minutes or 0) / 60
+        week_hours = float(week_minutes or 0) / 60
         
         return jsonify({
             'success': True,
@@ -1517,25 +1903,20 @@ def analytics_work_hours_trend():
         
         # Get date range based on filter
         from datetime import datetime, timedelta
-        end_date = datetime.now().replace(hour=23, minute=59, second=59)
+        end_date = datetime.now().date()
         start_date = end_date - timedelta(days=days-1)
-        start_date = start_date.replace(hour=0, minute=0, second=0)
         
-        # Query daily hours
+        # Query daily hours from the rollup
         daily_hours = db.session.query(
-            db.func.date(TimesheetEntry.clock_in).label('work_date'),
-            db.func.sum(
-                db.func.extract('epoch', TimesheetEntry.clock_out - TimesheetEntry.clock_in) / 3600
-            ).label('total_hours')
+            DailyWorkRollup.work_date,
+            (db.func.sum(DailyWorkRollup.worked_minutes) / 60.0).label('total_hours')
         ).filter(
-            TimesheetEntry.clock_out.isnot(None),
-            TimesheetEntry.clock_in >= start_date,
-            TimesheetEntry.clock_in <= end_date
-        ).group_by(db.func.date(TimesheetEntry.clock_in)).all()
+            DailyWorkRollup.work_date.between(start_date, end_date)
+        ).group_by(DailyWorkRollup.work_date).all()
         
         # Create complete date range with 0 hours for missing days
         date_range = []
-        current_date = start_date.date()
+        current_date = start_date
         hours_dict = {row.work_date: float(row.total_hours) for row in daily_hours}
         
         for i in range(days):
@@ -1565,27 +1946,22 @@ def analytics_user_productivity():
         
         # Get productivity data per user (based on selected time range)
         from datetime import datetime, timedelta
-        start_date = datetime.now() - timedelta(days=days)
+        start_date = datetime.now().date() - timedelta(days=days)
         
         user_stats = db.session.query(
             User.username,
-            db.func.count(TimesheetEntry.id).label('total_sessions'),
-            db.func.sum(
-                db.func.extract('epoch', TimesheetEntry.clock_out - TimesheetEntry.clock_in) / 3600
-            ).label('total_hours'),
-            db.func.avg(
-                db.func.extract('epoch', TimesheetEntry.clock_out - TimesheetEntry.clock_in) / 3600
-            ).label('avg_session_hours')
-        ).join(TimesheetEntry).filter(
-            TimesheetEntry.clock_out.isnot(None),
-            TimesheetEntry.clock_in >= start_date
+            db.func.sum(DailyWorkRollup.sessions).label('total_sessions'),
+            (db.func.sum(DailyWorkRollup.worked_minutes) / 60.0).label('total_hours'),
+            (db.func.sum(DailyWorkRollup.worked_minutes) / 60.0 / db.func.sum(DailyWorkRollup.sessions)).label('avg_session_hours')
+        ).join(DailyWorkRollup).filter(
+            DailyWorkRollup.work_date >= start_date
         ).group_by(User.id, User.username).all()
         
         productivity_data = []
         for stat in user_stats:
             productivity_data.append({
                 'username': stat.username,
-                'total_sessions': stat.total_sessions,
+                'total_sessions': int(stat.total_sessions),
                 'total_hours': round(float(stat.total_hours), 1),
                 'avg_session_hours': round(float(stat.avg_session_hours), 2)
             })
@@ -1638,42 +2014,74 @@ def analytics_status_distribution():
 @main_bp.route('/api/timesheet/entries', methods=['GET'])
 @login_required
 def get_timesheet_entries():
-    """Get timesheet entries for current user or all users (admin)"""
+    """Get timesheet entries for current user or all users (admin).
+
+    With limit or cursor the entries come in keyset pages: follow 'next'
+    until it is null. count=1 adds the total number of matching entries.
+    """
     try:
         user_id = request.args.get('user_id', type=int)
         start_date = request.args.get('start_date')
         end_date = request.args.get('end_date')
+        limit = request.args.get('limit', type=int)
+        cursor = request.args.get('cursor')
+        paged = limit is not None or bool(cursor)
         
         # Permission check
         if user_id and user_id != current_user.id and not current_user.is_admin:
             return jsonify({'success': False, 'error': 'Access denied'}), 403
         
         # Build query
-        query = TimesheetEntry.query
+        criteria = []
         
         if user_id:
-            query = query.filter_by(user_id=user_id)
+            criteria.append(TimesheetEntry.user_id == user_id)
         elif not current_user.is_admin:
-            query = query.filter_by(user_id=current_user.id)
+            criteria.append(TimesheetEntry.user_id == current_user.id)
         
         if start_date:
-            query = query.filter(TimesheetEntry.date >= datetime.strptime(start_date, '%Y-%m-%d').date())
+            criteria.append(TimesheetEntry.date >= datetime.strptime(start_date, '%Y-%m-%d').date())
         if end_date:
-            query = query.filter(TimesheetEntry.date <= datetime.strptime(end_date, '%Y-%m-%d').date())
-        
-        entries = query.order_by(TimesheetEntry.date.desc(), TimesheetEntry.clock_in.desc()).all()
+            criteria.append(TimesheetEntry.date <= datetime.strptime(end_date, '%Y-%m-%d').date())
+        
+        # Entries are shown in the viewer's timezone, so it is part of the ETag. A page
+        # hashes its own rows instead, since a marker over the whole scope costs a full scan
+        if not paged:
+            etag = compute_etag(
+                'timesheet-entries', request.query_string, current_user.id, current_user.timezone,
+                change_marker(TimesheetEntry, *criteria, extra=(
+                    db.func.count(TimesheetEntry.clock_out), db.func.sum(TimesheetEntry.break_duration))),
+                change_marker(User)
+            )
+            response = not_modified(etag)
+            if response:
+                return response
+        
+        # Join the username in the same query instead of lazy-loading entry.user per row
+        query = db.select(TimesheetEntry, User.username).join(
+            User, TimesheetEntry.user_id == User.id
+        ).where(*criteria).order_by(*ENTRY_ORDER)
+        page = {}
+        if paged:
+            page_size = min(max(limit or ENTRY_PAGE_SIZE, 1), MAX_ENTRY_PAGE_SIZE)
+            if cursor:
+                query = query.where(entries_after(cursor))
+            # One extra row tells whether another page follows
+            query = query.limit(page_size + 1)
+        if request.args.get('count') in ('1', 'true'):
+            page['total'] = db.session.scalar(
+                db.select(db.func.count()).select_from(TimesheetEntry).where(*criteria)
+            )
+        viewer_timezone = current_user.timezone or get_user_timezone()
+        viewer_zone = resolve_timezone(viewer_timezone)
         
-        entries_data = []
-        for entry in entries:
-            # Convert UTC times to user's timezone for display
-            user_clock_in = convert_utc_to_user_timezone(entry.clock_in, current_user.timezone) if entry.clock_in else None
-            user_clock_out = convert_utc_to_user_timezone(entry.clock_out, current_user.timezone) if entry.clock_out else None
+        def format_entry(entry, username, user_clock_in, user_clock_out):
             user_date = user_clock_in.date() if user_clock_in else entry.date
             
-            entries_data.append({
+            return {
                 'id': entry.id,
                 'user_id': entry.user_id,
-                'username': entry.user.username,
+                'username': username,
                 'date': user_date.isoformat(),
                 'clock_in': user_clock_in.isoformat() if user_clock_in else None,
                 'clock_out': user_clock_out.isoformat() if user_clock_out else None,
@@ -1682,9 +2090,37 @@ def get_timesheet_entries():
                 'location': entry.location,
                 'notes': entry.notes,
                 'is_active': entry.is_active
-            })
+            }
         
-        return jsonify({'success': True, 'entries': entries_data})
+        # Convert UTC times to user's timezone for display
+        if wants_stream() and not paged:
+            entries = (
+                format_entry(entry, username,
+                             utc_to_local(entry.clock_in, viewer_zone) if entry.clock_in else None,
+                             utc_to_local(entry.clock_out, viewer_zone) if entry.clock_out else None)
+                for entry, username in iter_rows(query)
+            )
+            return with_etag(streaming_json_response(iter_json_object({'success': True}, 'entries', entries)), etag)
+        
+        rows = db.session.execute(query).all()
+        if paged:
+            page['next'] = encode_entry_cursor(rows[page_size - 1][0]) if len(rows) > page_size else None
+            rows = rows[:page_size]
+        clock_ins = convert_utc_column([entry.clock_in for entry, _ in rows], viewer_timezone)
+        clock_outs = convert_utc_column([entry.clock_out for entry, _ in rows], viewer_timezone)
+        entries_data = [
+            format_entry(entry, username, user_clock_in, user_clock_out)
+            for (entry, username), user_clock_in, user_clock_out in zip(rows, clock_ins, clock_outs)
+        ]
+        if paged:
+            etag = compute_etag('timesheet-entries', request.query_string, current_user.id, entries_data, page)
+            response = not_modified(etag)
+            if response:
+                return response
+        
+        return with_etag(jsonify({'success': True, 'entries': entries_data, **page}), etag)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
@@ -1696,108 +2132,50 @@ def availability_analytics():
         user_id = request.args.get('user_id')
         start_date = request.args.get('start_date')
         end_date = request.args.get('end_date')
-        # Build query for availability slots
-        query = AvailabilitySlot.query
-        
-        if user_id and current_user.is_admin:
-            query = query.filter(AvailabilitySlot.user_id == user_id)
-        elif not current_user.is_admin:
-            query = query.filter(AvailabilitySlot.user_id == current_user.id)
-        
-        if start_date:
-            query = query.filter(AvailabilitySlot.date >= datetime.strptime(start_date, '%Y-%m-%d').date())
-        if end_date:
-            query = query.filter(AvailabilitySlot.date <= datetime.strptime(end_date, '%Y-%m-%d').date())
-        
-        availability_slots = query.order_by(AvailabilitySlot.date.desc()).all()
-        
-        # Build query for busy slots
-        busy_query = BusySlot.query
-        if user_id and current_user.is_admin:
-            busy_query = busy_query.filter(BusySlot.user_id == user_id)
-        elif not current_user.is_admin:
-            busy_query = busy_query.filter(BusySlot.user_id == current_user.id)
         
-        if start_date:
-            busy_query = busy_query.filter(BusySlot.date >= datetime.strptime(start_date, '%Y-%m-%d').date())
-        if end_date:
-            busy_query = busy_query.filter(BusySlot.date <= datetime.strptime(end_date, '%Y-%m-%d').date())
+        window_start = datetime.strptime(start_date, '%Y-%m-%d').date() if start_date else None
+        window_end = datetime.strptime(end_date, '%Y-%m-%d').date() if end_date else None
         
-        busy_slots = busy_query.order_by(BusySlot.date.desc()).all()
-        
-        # Build query for leave days
-        leave_query = LeaveDay.query
-        if user_id and current_user.is_admin:
-            leave_query = leave_query.filter(LeaveDay.user_id == user_id)
-        elif not current_user.is_admin:
-            leave_query = leave_query.filter(LeaveDay.user_id == current_user.id)
-        
-        if start_date:
-            leave_query = leave_query.filter(LeaveDay.start_date >= datetime.strptime(start_date, '%Y-%m-%d').date())
-        if end_date:
-            leave_query = leave_query.filter(LeaveDay.end_date <= datetime.strptime(end_date, '%Y-%m-%d').date())
-        
-        leave_days = leave_query.order_by(LeaveDay.start_date.desc()).all()
-        
-        # Format availability data
-        availability_data = []
-        for slot in availability_slots:
-            # Note: start_time and end_time are time objects, not datetime, so no timezone conversion needed
-            user_start_time = slot.start_time
-            user_end_time = slot.end_time
+        # Build one query per event type, newest first, with the owner's username joined in
+        queries = []
+        for model in (AvailabilitySlot, BusySlot, LeaveDay):
+            first_day = LeaveDay.start_date if model is LeaveDay else model.date
+            last_day = LeaveDay.end_date if model is LeaveDay else model.date
+            query = db.select(model, User.username).join(User, model.user_id == User.id)
             
-            availability_data.append({
-                'id': slot.id,
-                'type': 'availability',
-                'user_id': slot.user_id,
-                'username': slot.user.username,
-                'date': slot.date.isoformat(),
-                'start_time': user_start_time.strftime('%H:%M') if user_start_time else None,
-                'end_time': user_end_time.strftime('%H:%M') if user_end_time else None,
-                'status': 'Available',
-                'notes': ''  # AvailabilitySlot doesn't have a notes field
-            })
-        
-        # Format busy data
-        for slot in busy_slots:
-            # Note: start_time and end_time are time objects, not datetime, so no timezone conversion needed
-            user_start_time = slot.start_time
-            user_end_time = slot.end_time
+            if user_id and current_user.is_admin:
+                query = query.where(model.user_id == user_id)
+            elif not current_user.is_admin:
+                query = query.where(model.user_id == current_user.id)
             
-            availability_data.append({
-                'id': slot.id,
-                'type': 'busy',
-                'user_id': slot.user_id,
-                'username': slot.user.username,
-                'date': slot.date.isoformat(),
-                'start_time': user_start_time.strftime('%H:%M') if user_start_time else None,
-                'end_time': user_end_time.strftime('%H:%M') if user_end_time else None,
-                'status': 'Busy',
-                'notes': slot.description or ''  # BusySlot uses description field instead of notes
-            })
-        
-        # Format leave data
-        for leave in leave_days:
-            availability_data.append({
-                'id': leave.id,
-                'type': 'leave',
-                'user_id': leave.user_id,
-                'username': leave.user.username,
-                'date': leave.start_date.isoformat(),  # Add this for sorting
-                'start_date': leave.start_date.isoformat(),
-                'end_date': leave.end_date.isoformat(),
-                'start_time': 'All Day',
-                'end_time': 'All Day',
-                'status': 'Leave',
-                'notes': leave.notes or ''
-            })
-        print("<pre>")    
-        print(availability_data)
-        print("</pre>")
-        # Sort by date
-        availability_data.sort(key=lambda x:x.get('date') or x.get('start_date'), reverse=True)
-        
-        # Calculate analytics
+            if model is AvailabilitySlot:
+                # Recurring rules are matched by their span and expanded below
+                query = query.where(*availability_window_criteria(
+                    window_start, window_end + timedelta(days=1) if window_end else None))
+            else:
+                if window_start:
+                    query = query.where(first_day >= window_start)
+                if window_end:
+                    query = query.where(last_day <= window_end)
+            
+            queries.append(query.order_by(first_day.desc()))
+        
+        availability_query, busy_query, leave_query = queries
+        rule_query = availability_query.where(AvailabilitySlot.recurring.is_(True))
+        availability_query = availability_query.where(db.not_(AvailabilitySlot.recurring.is_(True)))
+        
+        def expand_rules(rows):
+            """Occurrences of the recurring rules in the window, newest first"""
+            occurrences = [
+                (occurrence, username)
+                for rule, username in rows
+                for occurrence in expand_availability(
+                    rule, window_start, window_end + timedelta(days=1) if window_end else None)
+            ]
+            occurrences.sort(key=lambda row: row[0].date, reverse=True)
+            return occurrences
+        
+        # Calculate analytics while the rows are formatted
         def calculate_duration_hours(start_time, end_time):
             """Calculate duration in hours between two time objects"""
             if not start_time or not end_time:
@@ -1813,37 +2191,105 @@ def availability_analytics():
             
             return (end_dt - start_dt).total_seconds() / 3600
         
-        total_availability_hours = sum([
-            calculate_duration_hours(slot.start_time, slot.end_time)
-            for slot in availability_slots 
-        ])
-        
-        total_busy_hours = sum([
-            calculate_duration_hours(slot.start_time, slot.end_time)
-            for slot in busy_slots 
-        ])
-        
-        total_leave_days = len(leave_days)
-        
-        # Get unique dates for availability rate calculation
-        availability_dates = set([slot.date for slot in availability_slots])
-        busy_dates = set([slot.date for slot in busy_slots])
-        leave_dates = set([leave.start_date for leave in leave_days])
-        all_dates = availability_dates.union(busy_dates).union(leave_dates)
-        
-        analytics = {
-            'total_availability_hours': round(total_availability_hours, 1),
-            'total_busy_hours': round(total_busy_hours, 1),
-            'total_leave_days': total_leave_days,
-            'total_scheduled_days': len(all_dates),
-            'availability_rate': round((len(availability_dates) / len(all_dates) * 100) if all_dates else 0, 1)
-        }
-        print(availability_data)
-        print(analytics)
+        totals = {'availability_hours': 0, 'busy_hours': 0, 'leave_days': 0}
+        availability_dates = set()
+        all_dates = set()
+        
+        def format_availability(rows):
+            for slot, username in rows:
+                totals['availability_hours'] += calculate_duration_hours(slot.start_time, slot.end_time)
+                availability_dates.add(slot.date)
+                all_dates.add(slot.date)
+                
+                # Note: start_time and end_time are time objects, not datetime, so no timezone conversion needed
+                yield {
+                    'id': slot.id,
+                    'type': 'availability',
+                    'user_id': slot.user_id,
+                    'username': username,
+                    'date': slot.date.isoformat(),
+                    'start_time': slot.start_time.strftime('%H:%M') if slot.start_time else None,
+                    'end_time': slot.end_time.strftime('%H:%M') if slot.end_time else None,
+                    'status': 'Available',
+                    'notes': ''  # AvailabilitySlot doesn't have a notes field
+                }
+        
+        def format_busy(rows):
+            for slot, username in rows:
+                totals['busy_hours'] += calculate_duration_hours(slot.start_time, slot.end_time)
+                all_dates.add(slot.date)
+                
+                yield {
+                    'id': slot.id,
+                    'type': 'busy',
+                    'user_id': slot.user_id,
+                    'username': username,
+                    'date': slot.date.isoformat(),
+                    'start_time': slot.start_time.strftime('%H:%M') if slot.start_time else None,
+                    'end_time': slot.end_time.strftime('%H:%M') if slot.end_time else None,
+                    'status': 'Busy',
+                    'notes': slot.description or ''  # BusySlot uses description field instead of notes
+                }
+        
+        def format_leave(rows):
+            for leave, username in rows:
+                totals['leave_days'] += 1
+                all_dates.add(leave.start_date)
+                
+                yield {
+                    'id': leave.id,
+                    'type': 'leave',
+                    'user_id': leave.user_id,
+                    'username': username,
+                    'date': leave.start_date.isoformat(),  # Add this for sorting
+                    'start_date': leave.start_date.isoformat(),
+                    'end_date': leave.end_date.isoformat(),
+                    'start_time': 'All Day',
+                    'end_time': 'All Day',
+                    'status': 'Leave',
+                    'notes': leave.notes or ''
+                }
+        
+        def summarize():
+            return {
+                'total_availability_hours': round(totals['availability_hours'], 1),
+                'total_busy_hours': round(totals['busy_hours'], 1),
+                'total_leave_days': totals['leave_days'],
+                'total_scheduled_days': len(all_dates),
+                'availability_rate': round((len(availability_dates) / len(all_dates) * 100) if all_dates else 0, 1)
+            }
+        
+        if wants_stream():
+            # Each query is already newest-first, so merging keeps the response sorted by date
+            availability_rows = heapq.merge(
+                iter_rows(availability_query),
+                expand_rules(db.session.execute(rule_query).all()),
+                key=lambda row: row[0].date,
+                reverse=True
+            )
+            rows = heapq.merge(
+                format_availability(availability_rows),
+                format_busy(iter_rows(busy_query)),
+                format_leave(iter_rows(leave_query)),
+                key=lambda x: x['date'],
+                reverse=True
+            )
+            return streaming_json_response(iter_json_object(
+                {'success': True}, 'data', rows, trailer=lambda: {'analytics': summarize()}
+            ))
+        
+        availability_data = list(format_availability(db.session.execute(availability_query).all()))
+        availability_data.extend(format_availability(expand_rules(db.session.execute(rule_query).all())))
+        availability_data.extend(format_busy(db.session.execute(busy_query).all()))
+        availability_data.extend(format_leave(db.session.execute(leave_query).all()))
+        
+        # Sort by date
+        availability_data.sort(key=lambda x:x.get('date') or x.get('start_date'), reverse=True)
+        
         return jsonify({
             'success': True, 
             'data': availability_data,
-            'analytics': analytics
+            'analytics': summarize()
         })
         
     except Exception as e:
@@ -1863,7 +2309,7 @@ def get_users():
         return jsonify({'success': False, 'error': 'Access denied'}), 403
     
     try:
-        users = User.query.filter_by(approval_status='approved').order_by(User.username).all()
+        users = sorted(cached_users('approved'), key=lambda user: user.username)
         users_data = [{'id': user.id, 'username': user.username} for user in users]
         return jsonify({'success': True, 'users': users_data})
     except Exception as e:
@@ -1872,7 +2318,7 @@ def get_users():
 @main_bp.route('/api/timesheet/download', methods=['GET'])
 @login_required
 def download_timesheet():
-    """Download timesheet entries as CSV"""
+    """Download timesheet entries as CSV, streamed (gzip-compressed with ?gzip=1)"""
     try:
         user_id = request.args.get('user_id', type=int)
         start_date = request.args.get('start_date')
@@ -1882,92 +2328,145 @@ def download_timesheet():
         if user_id and user_id != current_user.id and not current_user.is_admin:
             return jsonify({'success': False, 'error': 'Access denied'}), 403
         
-        # Build query
-        query = TimesheetEntry.query
+        # Build query; usernames come from the join instead of a lazy load per row
+        query = db.select(
+            TimesheetEntry.date, TimesheetEntry.clock_in, TimesheetEntry.clock_out,
+            TimesheetEntry.break_duration, TimesheetEntry.duration_minutes,
+            TimesheetEntry.location, TimesheetEntry.notes, User.username
+        ).join(User, User.id == TimesheetEntry.user_id)
         
         if user_id:
-            query = query.filter_by(user_id=user_id)
+            query = query.where(TimesheetEntry.user_id == user_id)
         elif not current_user.is_admin:
-            query = query.filter_by(user_id=current_user.id)
+            query = query.where(TimesheetEntry.user_id == current_user.id)
         
         if start_date:
-            query = query.filter(TimesheetEntry.date >= datetime.strptime(start_date, '%Y-%m-%d').date())
+            query = query.where(TimesheetEntry.date >= datetime.strptime(start_date, '%Y-%m-%d').date())
         if end_date:
-            query = query.filter(TimesheetEntry.date <= datetime.strptime(end_date, '%Y-%m-%d').date())
+            query = query.where(TimesheetEntry.date <= datetime.strptime(end_date, '%Y-%m-%d').date())
         
-        entries = query.order_by(TimesheetEntry.date.desc(), TimesheetEntry.clock_in.desc()).all()
-        
-        # Generate CSV content
-        import csv
-        from io import StringIO
-        
-        output = StringIO()
-        writer = csv.writer(output)
-        
-        # Write header
-        writer.writerow([
-            'Date (YYYY-MM-DD)', 'Day of Week', 'Employee', 'Clock In Time', 'Clock Out Time', 
-            'Work Duration (Hours)', 'Break Duration (Minutes)', 'Total Time (Hours)', 'Location', 'Status', 'Notes'
-        ])
-        
-        # Write data rows
-        for entry in entries:
-            # Calculate total time including breaks
-            work_hours = round(entry.duration / 60, 2) if entry.duration else 0.00
-            break_minutes = entry.break_duration or 0
-            total_hours = round((entry.duration + break_minutes) / 60, 2) if entry.duration else 0.00
-            
-            # Status determination
-            status = 'Active' if entry.is_active else 'Completed'
-            
-            # Convert times to user's timezone for display
-            try:
-                user_clock_in = convert_utc_to_user_timezone(entry.clock_in, current_user.timezone) if entry.clock_in else None
-                user_clock_out = convert_utc_to_user_timezone(entry.clock_out, current_user.timezone) if entry.clock_out else None
-                user_date = user_clock_in.date() if user_clock_in else entry.date
-                
-                # Format times safely
-                clock_in_str = user_clock_in.strftime('%I:%M %p') if user_clock_in else 'No Clock In'
-                clock_out_str = user_clock_out.strftime('%I:%M %p') if user_clock_out else ('Still Active' if entry.is_active else 'No Clock Out')
-            except Exception as e:
-                # Fallback formatting if timezone conversion fails
-                clock_in_str = entry.clock_in.strftime('%I:%M %p') if entry.clock_in else 'No Clock In'
-                clock_out_str = entry.clock_out.strftime('%I:%M %p') if entry.clock_out else ('Still Active' if entry.is_active else 'No Clock Out')
-                user_date = entry.date
-            
-            writer.writerow([
-                user_date.strftime('%Y-%m-%d'),  # Date in user's timezone
-                user_date.strftime('%A'),       # Day of week in user's timezone
-                entry.user.username,
-                clock_in_str,  # Safe clock in time
-                clock_out_str,  # Safe clock out time
-                f"{work_hours:.2f}",
-                break_minutes,
-                f"{total_hours:.2f}",
-                entry.location or 'Office',
-                status,
-                entry.notes or ''
-            ])
-        
-        csv_content = output.getvalue()
-        output.close()
+        query = query.order_by(TimesheetEntry.date.desc(), TimesheetEntry.clock_in.desc())
         
         # Generate filename
         if user_id and current_user.is_admin:
-            user = User.query.get(user_id)
+            user = User.query.get_or_404(user_id)
             filename = f"timesheet_{user.username}_{datetime.now().strftime('%Y%m%d')}.csv"
         else:
             filename = f"timesheet_{current_user.username}_{datetime.now().strftime('%Y%m%d')}.csv"
         
+        # Times are shown in the exporting user's timezone
+        export_zone = resolve_timezone(current_user.timezone)
+        
+        def format_rows():
+            # Rows arrive from a server-side cursor (yield_per), so memory stays flat
+            for day, clock_in, clock_out, break_duration, duration_minutes, location, notes, username in iter_rows(query):
+                is_active = clock_out is None
+                
+                # Calculate total time including breaks
+                if is_active:
+                    duration = 0
+                elif duration_minutes is not None:
+                    duration = duration_minutes
+                else:
+                    duration = max(0, int((clock_out - clock_in).total_seconds() / 60 - (break_duration or 0)))
+                work_hours = round(duration / 60, 2) if duration else 0.00
+                break_minutes = break_duration or 0
+                total_hours = round((duration + break_minutes) / 60, 2) if duration else 0.00
+                
+                # Convert times to user's timezone for display
+                user_clock_in = utc_to_local(clock_in, export_zone) if clock_in else None
+                user_clock_out = utc_to_local(clock_out, export_zone) if clock_out else None
+                user_date = user_clock_in.date() if user_clock_in else day
+                
+                yield [
+                    user_date.strftime('%Y-%m-%d'),  # Date in user's timezone
+                    user_date.strftime('%A'),       # Day of week in user's timezone
+                    username,
+                    user_clock_in.strftime('%I:%M %p') if user_clock_in else 'No Clock In',
+                    user_clock_out.strftime('%I:%M %p') if user_clock_out else 'Still Active',
+                    f"{work_hours:.2f}",
+                    break_minutes,
+                    f"{total_hours:.2f}",
+                    location or 'Office',
+                    'Active' if is_active else 'Completed',
+                    notes or ''
+                ]
+        
+        chunks = iter_csv([
+            'Date (YYYY-MM-DD)', 'Day of Week', 'Employee', 'Clock In Time', 'Clock Out Time', 
+            'Work Duration (Hours)', 'Break Duration (Minutes)', 'Total Time (Hours)', 'Location', 'Status', 'Notes'
+        ], format_rows())
+        
         from flask import Response
+        if wants_gzip():
+            return Response(
+                stream_with_context(iter_gzip(chunks)),
+                mimetype='application/gzip',
+                headers={'Content-Disposition': f'attachment; filename={filename}.gz'}
+            )
         return Response(
-            csv_content,
+            stream_with_context(chunks),
             mimetype='text/csv',
             headers={'Content-Disposition': f'attachment; filename={filename}'}
         )
+    except ValueError:
+        return jsonify({'success': False, 'error': 'Dates must be YYYY-MM-DD'}), 400
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@main_bp.route('/api/payroll/runs', methods=['POST'])
+@login_required
+def create_payroll_run():
+    """Compute and store payroll for every employee over a pay period (admin only)"""
+    if not current_user.is_admin:
+        return jsonify({'success': False, 'error': 'Access denied'}), 403
+    
+    data = request.get_json() or {}
+    try:
+        period_start = datetime.strptime(data['period_start'], '%Y-%m-%d').date()
+        period_end = datetime.strptime(data['period_end'], '%Y-%m-%d').date()
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'success': False, 'error': 'period_start and period_end must be YYYY-MM-DD'}), 400
+    if period_end < period_start:
+        return jsonify({'success': False, 'error': 'period_end must not be before period_start'}), 400
+    if (period_end - period_start).days >= MAX_PAYROLL_DAYS:
+        return jsonify({'success': False, 'error': f'Pay periods are limited to {MAX_PAYROLL_DAYS} days'}), 400
+    
+    try:
+        run = run_payroll(period_start, period_end, created_by=current_user.id)
+        db.session.commit()
+        return jsonify({'success': True, 'run': serialize_payroll_run(run)}), 201
     except Exception as e:
+        db.session.rollback()
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@main_bp.route('/api/payroll/runs', methods=['GET'])
+@login_required
+def get_payroll_runs():
+    """List stored payroll runs, newest first (admin only)"""
+    if not current_user.is_admin:
+        return jsonify({'success': False, 'error': 'Access denied'}), 403
+    
+    runs = PayrollRun.query.order_by(PayrollRun.created_at.desc()).all()
+    return jsonify({'success': True, 'runs': [serialize_payroll_run(run) for run in runs]})
+
+@main_bp.route('/api/payroll/runs/<int:run_id>', methods=['GET'])
+@login_required
+def get_payroll_run(run_id):
+    """A stored payroll run with its per-employee, per-week lines (admin only)"""
+    if not current_user.is_admin:
+        return jsonify({'success': False, 'error': 'Access denied'}), 403
+    
+    run = PayrollRun.query.get_or_404(run_id)
+    lines = db.session.query(PayrollLine, User.username).join(User, User.id == PayrollLine.user_id).filter(
+        PayrollLine.run_id == run.id
+    ).order_by(User.username, PayrollLine.week_start).all()
+    return jsonify({
+        'success': True,
+        'run': serialize_payroll_run(run),
+        'lines': [serialize_payroll_line(line, username) for line, username in lines]
+    })
+
 @main_bp.route("/invoice/<int:user_id>", methods=['GET'])
 @login_required
 def generate_invoice(user_id):
@@ -2159,6 +2658,7 @@ def submit_leave_request():
         
         db.session.add(leave_request)
         db.session.commit()
+        invalidate_user_feeds(current_user)
         recipients=[]
         # Send email notifications to HR and Manager
         specific_recipients = [
@@ -2209,24 +2709,27 @@ def get_leave_requests():
         status_filter = request.args.get('status', 'pending')
         
         # Build query based on user role
-        if current_user.is_admin or current_user.is_hr:
-            # HR and Admin can see all requests
-            query = LeaveDay.query
-        else:
-            # Regular users can only see their own requests
-            query = LeaveDay.query.filter_by(user_id=current_user.id)
+        criteria = []
+        if not (current_user.is_admin or current_user.is_hr):
+            # Regular users can only see their own requests; HR and Admin can see all
+            criteria.append(LeaveDay.user_id == current_user.id)
         
         # Apply status filter
-        if status_filter == 'pending':
-            query = query.filter_by(approved_status='pending')
-        elif status_filter == 'approved':
-            query = query.filter_by(approved_status='approved')
-        elif status_filter == 'rejected':
-            query = query.filter_by(approved_status='rejected')
+        if status_filter in ('pending', 'approved', 'rejected'):
+            criteria.append(LeaveDay.approved_status == status_filter)
         # If status_filter == 'all', don't filter by status
         
+        # Requests embed the requester's name, email and department
+        etag = compute_etag(
+            'leave-requests', current_user.id, status_filter,
+            change_marker(LeaveDay, *criteria), change_marker(User), change_marker(Department)
+        )
+        response = not_modified(etag)
+        if response:
+            return response
+        
         # Get requests ordered by submission date
-        requests = query.order_by(LeaveDay.submitted_at.desc()).all()
+        requests = LeaveDay.query.filter(*criteria).order_by(LeaveDay.submitted_at.desc()).all()
         
         requests_data = []
         for req in requests:
@@ -2250,7 +2753,7 @@ def get_leave_requests():
                 'hr_reviewed_at': req.hr_reviewed_at.isoformat() if req.hr_reviewed_at else None,
             })
         
-        return jsonify({'success': True, 'requests': requests_data})
+        return with_etag(jsonify({'success': True, 'requests': requests_data}), etag)
         
     except Exception as e:
         print(f"Error getting leave requests: {e}")
@@ -2286,6 +2789,7 @@ def approve_leave_request(request_id):
             leave_request.notes = f"{existing_notes}\n\nHR Comments: {comments}"
         
         db.session.commit()
+        invalidate_user_feeds(leave_request.user)
         
         # Send approval email (uncomment when ready)
         # try:
@@ -2332,6 +2836,7 @@ def reject_leave_request(request_id):
         leave_request.notes = f"{existing_notes}\n\nRejection Reason: {comments}"
         
         db.session.commit()
+        invalidate_user_feeds(leave_request.user)
         
         # Send rejection email (uncomment when ready)
         # try:
@@ -2406,6 +2911,7 @@ def cancel_leave_request(request_id):
         # Delete the request
         db.session.delete(leave_request)
         db.session.commit()
+        invalidate_user_feeds(current_user)
         
         return jsonify({'success': True, 'message': 'Leave request cancelled'})
         
@@ -16,6 +16,7 @@ let allEvents = [];
 let currentView = 'calendar';
 let currentTimelineView = 'week'; // 'week' or 'month'
 let ganttData = [];
+let lastChangeCursor = null; // Sync cursor from the last full events fetch
 
 document.addEventListener('DOMContentLoaded', function() {
     const calendarEl = document.getElementById('calendar');
@@ -43,30 +44,20 @@ document.addEventListener('DOMContentLoaded', function() {
             meridiem: 'short'
         },
         events: function(fetchInfo, successCallback, failureCallback) {
-            // Get current filter settings
-            const userFilter = document.getElementById('userFilter')?.value || 'all';
-            const departmentFilter = document.getElementById('departmentFilter')?.value || 'all';
-            
-            // Build URL with filter parameters
-            const params = new URLSearchParams({
-                start: fetchInfo.startStr,
-                end: fetchInfo.endStr
-            });
-            
-            // Priority: user filter takes precedence over department filter
-            if (userFilter !== 'all') {
-                params.append('filter_type', 'individual');
-                params.append('user_id', userFilter);
-            } else if (departmentFilter !== 'all') {
-                params.append('filter_type', 'department');
-                params.append('department_id', departmentFilter);
-            } else {
-                params.append('filter_type', 'all');
-            }
+            // Build URL with the visible window and current filter parameters
+            const params = getCalendarFilterParams();
+            params.append('start', fetchInfo.startStr);
+            params.append('end', fetchInfo.endStr);
+            // Dictionary-encoded payload: each user's name and colour are sent once
+            params.append('format', 'compact');
             
             fetch(`/api/events?${params.toString()}`)
-                .then(response => response.json())
-                .then(data => {
+                .then(response => {
+                    lastChangeCursor = response.headers.get('X-Changes-Cursor');
+                    return response.json();
+                })
+                .then(payload => {
+                    const data = payload.format === 'compact' ? decodeCompactEvents(payload) : payload;
                     allEvents = data;
                     updateTeamMemberCounts(data);
                     updateUserColorLegend(data);
@@ -210,6 +201,120 @@ function filterCalendar() {
     }
 }
 
+// Minute offsets from a YYYY-MM-DD origin, as used by the compact and timeline payloads
+function parseOffsetOrigin(origin) {
+    const parts = origin.split('-');
+    return Date.UTC(parseInt(parts[0]), parseInt(parts[1]) - 1, parseInt(parts[2]));
+}
+
+function offsetToDate(origin, minutes) {
+    return new Date(origin + minutes * 60000);
+}
+
+function formatOffsetDate(date) {
+    const pad = n => String(n).padStart(2, '0');
+    return `${date.getUTCFullYear()}-${pad(date.getUTCMonth() + 1)}-${pad(date.getUTCDate())}`;
+}
+
+function formatOffsetDateTime(date) {
+    const pad = n => String(n).padStart(2, '0');
+    return `${formatOffsetDate(date)}T${pad(date.getUTCHours())}:${pad(date.getUTCMinutes())}:00`;
+}
+
+// Expand the compact events payload into the FullCalendar events /api/events returns by default
+function decodeCompactEvents(data) {
+    const origin = parseOffsetOrigin(data.origin);
+    const prefixes = { availability: 'avail', busy: 'busy', leave: 'leave' };
+    const opacity = { availability: '20', busy: '80', leave: '40' };
+    
+    return data.events.map(([code, userIndex, start, end, id, extra = {}]) => {
+        const type = data.types[code];
+        const [userId, username, color] = data.users[userIndex];
+        const event = {
+            id: `${prefixes[type]}-${id}`,
+            color: color,
+            borderColor: color,
+            backgroundColor: color + opacity[type],
+            user_id: userId,
+            username: username,
+            type: type,
+            display: 'block'
+        };
+        
+        if (type === 'leave') {
+            event.title = `${username} - ${extra.leave_type || 'Leave'}`;
+            event.start = formatOffsetDate(offsetToDate(origin, start));
+            event.end = formatOffsetDate(offsetToDate(origin, end));
+            event.allDay = true;
+            event.notes = extra.notes || '';
+        } else {
+            event.title = type === 'busy' ? `${username} - ${extra.title || 'Busy'}` : `${username} - Available`;
+            event.start = formatOffsetDateTime(offsetToDate(origin, start));
+            event.end = formatOffsetDateTime(offsetToDate(origin, end));
+            if (type === 'busy') event.description = extra.description || '';
+            if (extra.recurring) event.recurring = true;
+        }
+        return event;
+    });
+}
+
+// Filter parameters for the current user/department selection
+function getCalendarFilterParams() {
+    const userFilter = document.getElementById('userFilter')?.value || 'all';
+    const departmentFilter = document.getElementById('departmentFilter')?.value || 'all';
+    const params = new URLSearchParams();
+    
+    // Priority: user filter takes precedence over department filter
+    if (userFilter !== 'all') {
+        params.append('filter_type', 'individual');
+        params.append('user_id', userFilter);
+    } else if (departmentFilter !== 'all') {
+        params.append('filter_type', 'department');
+        params.append('department_id', departmentFilter);
+    } else {
+        params.append('filter_type', 'all');
+    }
+    
+    return params;
+}
+
+// Apply event changes since the last sync instead of refetching the whole calendar
+function syncEventChanges() {
+    if (lastChangeCursor === null) {
+        calendar.refetchEvents();
+        return;
+    }
+    
+    const params = getCalendarFilterParams();
+    params.append('since', lastChangeCursor);
+    
+    fetch(`/api/events/changes?${params.toString()}`)
+        .then(response => response.json())
+        .then(data => {
+            if (data.reset) {
+                calendar.refetchEvents();
+                return;
+            }
+            
+            // Replace changed events and drop deleted ones (a recurring slot shows up once per occurrence)
+            const source = calendar.getEventSources()[0];
+            const replacedIds = new Set(data.deleted.concat(data.changed.map(event => event.id)));
+            calendar.getEvents().forEach(existing => {
+                if (replacedIds.has(existing.id)) existing.remove();
+            });
+            data.changed.forEach(event => calendar.addEvent(event, source));
+            
+            allEvents = allEvents.filter(event => !replacedIds.has(event.id)).concat(data.changed);
+            lastChangeCursor = data.cursor;
+            updateTeamMemberCounts(allEvents);
+            updateUserColorLegend(allEvents);
+        })
+        .catch(error => {
+            console.error('Error syncing event changes:', error);
+            calendar.refetchEvents();
+        });
+}
+
 function initializeModalHandlers() {
     // Set up form submission
     const addEventForm = document.getElementById('addEventForm');
@@ -345,15 +450,8 @@ function addEvent() {
     .then(data => {
         if (data.success) {
             showAlert(`${capitalizeFirst(currentEventType)} added successfully!`, 'success');
-            // Refetch events and update team member counts
-            fetch('/api/events')
-                .then(response => response.json())
-                .then(events => {
-                    allEvents = events;
-                    updateTeamMemberCounts(events);
-                    updateUserColorLegend(events);
-                    calendar.refetchEvents();
-                });
+            // Apply the changes and update team member counts
+            syncEventChanges();
             bootstrap.Modal.getInstance(document.getElementById('addEventModal')).hide();
         } else {
             showAlert(`Error: ${data.error}`, 'danger');
@@ -444,14 +542,7 @@ function createSingleDayAvailability() {
             showAlert('Availability added successfully!', 'success');
             
             // Refresh calendar
-            fetch('/api/events')
-                .then(response => response.json())
-                .then(events => {
-                    allEvents = events;
-                    updateTeamMemberCounts(events);
-                    updateUserColorLegend(events);
-                    calendar.refetchEvents();
-                });
+            syncEventChanges();
             
             // Close modal
             bootstrap.Modal.getInstance(document.getElementById('unifiedAvailabilityModal')).hide();
@@ -641,16 +732,19 @@ function createMultiDayAvailability() {
         return;
     }
     
-    // Prepare data for submission
+    // Store one weekly rule instead of a slot per date; the server expands it per view
     const eventData = {
-        dates: dates.map(d => d.date),
+        date: startDate,
         start_time: startTime,
         end_time: endTime,
-        type: 'multi_availability'
+        recurring: true,
+        recurring_days: selectedDays,
+        until: endDate,
+        type: 'availability'
     };
     
     // Submit to backend
-    fetch('/api/multi-availability', {
+    fetch('/api/availability', {
         method: 'POST',
         headers: {
             'Content-Type': 'application/json',
@@ -663,14 +757,7 @@ function createMultiDayAvailability() {
             showAlert(`Successfully created availability for ${dates.length} days!`, 'success');
             
             // Refresh calendar
-            fetch('/api/events')
-                .then(response => response.json())
-                .then(events => {
-                    allEvents = events;
-                    updateTeamMemberCounts(events);
-                    updateUserColorLegend(events);
-                    calendar.refetchEvents();
-                });
+            syncEventChanges();
             
             // Close modal
             bootstrap.Modal.getInstance(document.getElementById('unifiedAvailabilityModal')).hide();
@@ -694,7 +781,8 @@ function generateDateRange(startDateStr, endDateStr, selectedDays) {
     const current = new Date(startDate);
     while (current <= endDate) {
         const dayOfWeek = current.getDay();
-        if (selectedDays.includes(dayOfWeek)) {
+        // Weekday checkboxes count from Monday = 0, getDay() from Sunday = 0
+        if (selectedDays.includes((dayOfWeek + 6) % 7)) {
             dates.push({
                 date: current.toISOString().split('T')[0],
                 weekday: weekdays[dayOfWeek]
@@ -860,22 +948,22 @@ function deleteEvent() {
     const eventType = selectedEvent.extendedProps.type;
     const actualId = eventId.split('-')[1]; // Remove prefix like 'avail-', 'busy-', 'leave-'
     
-    fetch(`/api/events/${eventType}/${actualId}`, {
+    // For a recurring slot, offer to skip just this date instead of deleting the series
+    let query = '';
+    if (selectedEvent.extendedProps.recurring &&
+        confirm('This availability repeats weekly. Delete only this occurrence? (Cancel deletes the whole series)')) {
+        query = `?date=${selectedEvent.startStr.split('T')[0]}`;
+    }
+    
+    fetch(`/api/events/${eventType}/${actualId}${query}`, {
         method: 'DELETE'
     })
     .then(response => response.json())
     .then(data => {
         if (data.success) {
             showAlert('Event deleted successfully!', 'success');
-            // Refetch events and update team member counts
-            fetch('/api/events')
-                .then(response => response.json())
-                .then(events => {
-                    allEvents = events;
-                    updateTeamMemberCounts(events);
-                    updateUserColorLegend(events);
-                    calendar.refetchEvents();
-                });
+            // Apply the changes and update team member counts
+            syncEventChanges();
             bootstrap.Modal.getInstance(document.getElementById('eventDetailsModal')).hide();
         } else {
             showAlert(`Error: ${data.error}`, 'danger');
@@ -1027,15 +1115,8 @@ function updateEvent() {
     .then(data => {
         if (data.success) {
             showAlert(`${capitalizeFirst(currentEventType)} updated successfully!`, 'success');
-            // Refetch events and update team member counts
-            fetch('/api/events')
-                .then(response => response.json())
-                .then(events => {
-                    allEvents = events;
-                    updateTeamMemberCounts(events);
-                    updateUserColorLegend(events);
-                    calendar.refetchEvents();
-                });
+            // Apply the changes and update team member counts
+            syncEventChanges();
             bootstrap.Modal.getInstance(document.getElementById('addEventModal')).hide();
             
             // Reset the button back to "Add Event"
@@ -1203,8 +1284,12 @@ function loadGanttChart() {
     const userFilter = document.getElementById('userFilter')?.value || 'all';
     const departmentFilter = document.getElementById('departmentFilter')?.value || 'all';
     
-    // Build URL with filter parameters
-    const params = new URLSearchParams();
+    // Build URL with filter parameters, limited to the visible timeline window
+    const timelineWindow = getTimelineWindow();
+    const params = new URLSearchParams({
+        start: timelineWindow.start,
+        end: timelineWindow.end
+    });
     
     // Priority: user filter takes precedence over department filter
     if (userFilter !== 'all') {
@@ -1217,17 +1302,51 @@ function loadGanttChart() {
         params.append('filter_type', 'all');
     }
     
+    // Ask for merged intervals in the compact columnar format
+    params.append('format', 'timeline');
+    
     fetch(`/api/gantt-data?${params.toString()}`)
         .then(response => response.json())
         .then(data => {
-            ganttData = data;
-            renderGanttChart(data);
+            ganttData = data.format === 'timeline' ? decodeTimelineData(data) : data;
+            renderGanttChart(ganttData);
         })
         .catch(error => {
             console.error('Error loading Gantt data:', error);
         });
 }
 
+// Expand the columnar timeline payload (minute offsets from origin) into the events renderGanttChart expects
+function decodeTimelineData(data) {
+    const origin = parseOffsetOrigin(data.origin);
+    const labels = { availability: 'Available', busy: 'Busy', leave: 'Leave' };
+    
+    return {
+        users: data.users.map(user => {
+            const events = [];
+            ['availability', 'busy', 'leave'].forEach(type => {
+                const columns = user[type];
+                columns.start.forEach((offset, i) => {
+                    const start = offsetToDate(origin, offset);
+                    const end = offsetToDate(origin, offset + columns.duration[i]);
+                    if (type === 'leave') {
+                        // Leave ranges are whole days; the payload's end is exclusive
+                        end.setUTCDate(end.getUTCDate() - 1);
+                    }
+                    events.push({
+                        id: `${type}-${user.id}-${i}`,
+                        title: `${user.username} - ${labels[type]}`,
+                        start: type === 'leave' ? formatOffsetDate(start) : formatOffsetDateTime(start),
+                        end: type === 'leave' ? formatOffsetDate(end) : formatOffsetDateTime(end),
+                        type: type
+                    });
+                });
+            });
+            return { id: user.id, username: user.username, color: user.color, events: events };
+        })
+    };
+}
+
 // Switch timeline view between week and month
 function switchTimelineView(viewType) {
     currentTimelineView = viewType;
@@ -1243,10 +1362,30 @@ function switchTimelineView(viewType) {
         monthBtn.classList.add('active');
     }
     
-    // Re-render the chart with new view
-    if (ganttData) {
-        renderGanttChart(ganttData);
+    // Reload the chart for the new view's window
+    loadGanttChart();
+}
+
+// Visible timeline window as half-open YYYY-MM-DD bounds, matching renderGanttChart's periods
+function getTimelineWindow() {
+    const toDateStr = d => `${d.getFullYear()}-${String(d.getMonth() + 1).padStart(2, '0')}-${String(d.getDate()).padStart(2, '0')}`;
+    let start, end;
+    
+    if (currentTimelineView === 'week') {
+        // 5 weeks - 1 past + current + 3 future
+        start = new Date();
+        const dayOfWeek = start.getDay();
+        start.setDate(start.getDate() - dayOfWeek + (dayOfWeek === 0 ? -6 : 1) - 7);
+        end = new Date(start);
+        end.setDate(start.getDate() + 5 * 7);
+    } else {
+        // 12 months from the start of the current month
+        const now = new Date();
+        start = new Date(now.getFullYear(), now.getMonth(), 1);
+        end = new Date(now.getFullYear(), now.getMonth() + 12, 1);
     }
+    
+    return { start: toDateStr(start), end: toDateStr(end) };
 }
 
 
@@ -1793,7 +1932,7 @@ function submitQuickAvailability() {
             if (result.success) {
                 // Close modal and refresh calendar
                 bootstrap.Modal.getInstance(document.getElementById('quickAvailabilityModal')).hide();
-                calendar.refetchEvents();
+                syncEventChanges();
                 showAlert('Availability added successfully!', 'success');
             } else {
                 showAlert('Error adding availability: ' + result.error, 'danger');
@@ -1823,7 +1962,7 @@ function submitQuickAvailability() {
             if (result.success) {
                 // Close modal and refresh calendar
                 bootstrap.Modal.getInstance(document.getElementById('quickAvailabilityModal')).hide();
-                calendar.refetchEvents();
+                syncEventChanges();
                 showAlert(`Multi-day availability added successfully! (${result.count} days)`, 'success');
             } else {
                 showAlert('Error adding multi-day availability: ' + result.error, 'danger');
@@ -2108,7 +2247,10 @@ document.addEventListener('DOMContentLoaded', function() {
     
     // Load and refresh live team status on calendar page
     if (document.getElementById('liveTeamStatus')) {
-        loadLiveTeamStatus();
-        setInterval(loadLiveTeamStatus, 30000); // Refresh every 30 seconds
+        // Live when streams are enabled, polling otherwise
+        subscribeTeamStatus(teamStatus => {
+            updateLiveStatusDisplay(teamStatus);
+            updateStatusTimestamp();
+        }, loadLiveTeamStatus);
     }
 });
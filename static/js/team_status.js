@@ -0,0 +1,60 @@
+// Live team status: a Server-Sent Events snapshot followed by deltas when the server enables streams,
+// otherwise (and as the fallback) polling
+const TEAM_STATUS_STREAM_URL = '/api/team/status/stream';
+const TEAM_STATUS_POLL_INTERVAL_MS = 30000;
+const TEAM_STATUS_DURATION_TICK_MS = 60000; // Re-render so clocked-in durations keep counting
+
+function subscribeTeamStatus(onUpdate, poll) {
+    let pollTimer = null;
+
+    function startPolling() {
+        if (pollTimer) return;
+        poll();
+        pollTimer = setInterval(poll, TEAM_STATUS_POLL_INTERVAL_MS);
+    }
+
+    if (!window.teamStatusStreamEnabled || typeof EventSource === 'undefined') {
+        startPolling();
+        return;
+    }
+
+    // user_id -> {member, receivedAt}; rows are replaced whole, durations age locally
+    const members = new Map();
+
+    function render() {
+        const now = Date.now();
+        onUpdate(Array.from(members.values(), ({member, receivedAt}) => (
+            member.is_clocked_in ?
+                Object.assign({}, member, {current_duration: member.current_duration + (now - receivedAt) / 60000}) :
+                member
+        )));
+    }
+
+    function store(rows) {
+        const receivedAt = Date.now();
+        rows.forEach(member => members.set(member.user_id, {member, receivedAt}));
+    }
+
+    const source = new EventSource(TEAM_STATUS_STREAM_URL);
+    source.addEventListener('snapshot', event => {
+        members.clear();
+        store(JSON.parse(event.data).team_status);
+        render();
+    });
+    source.addEventListener('delta', event => {
+        const delta = JSON.parse(event.data);
+        delta.removed.forEach(userId => members.delete(userId));
+        store(delta.team_status);
+        render();
+    });
+    source.addEventListener('error', () => {
+        // EventSource retries dropped connections itself; it only gives up on a refused stream
+        if (source.readyState === EventSource.CLOSED) {
+            startPolling();
+        }
+    });
+
+    setInterval(() => {
+        if (!pollTimer && members.size) render();
+    }, TEAM_STATUS_DURATION_TICK_MS);
+}
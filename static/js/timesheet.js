@@ -1,6 +1,11 @@
 // Timesheet JavaScript functionality
 let currentStatus = null;
 let durationInterval = null;
+let timesheetLoadGeneration = 0;
+const TIMESHEET_PAGE_SIZE = 200; // Entries per keyset page
+const PUNCH_SEND_RETRIES = 2;
+const PUNCH_POLL_INTERVAL_MS = 500;
+const PUNCH_POLL_ATTEMPTS = 10;
 
 // Initialize timesheet when page loads
 document.addEventListener('DOMContentLoaded', function() {
@@ -11,8 +16,7 @@ document.addEventListener('DOMContentLoaded', function() {
     loadTimesheetEntries();
     
     if (window.currentUser && window.currentUser.is_admin) {
-        loadTeamStatus();
-        setInterval(loadTeamStatus, 30000); // Refresh every 30 seconds
+        subscribeTeamStatus(updateTeamStatusDisplay, loadTeamStatus); // Live when streams are enabled, polling otherwise
     }
     
     // Event listeners
@@ -153,14 +157,7 @@ function clockIn() {
         task: task
     };
     
-    fetch('/api/timesheet/clock-in', {
-        method: 'POST',
-        headers: {
-            'Content-Type': 'application/json',
-        },
-        body: JSON.stringify(data)
-    })
-    .then(response => response.json())
+    submitPunch('clock_in', data)
     .then(data => {
         if (data.success) {
             showAlert('Successfully clocked in!', 'success');
@@ -179,6 +176,47 @@ function clockIn() {
     });
 }
 
+// Punches are logged and acknowledged at once, then applied to the timesheet within
+// a second or two; resolves with {success, error} once the server has applied it
+function submitPunch(kind, details) {
+    const body = JSON.stringify({kind: kind, ...details});
+    const idempotencyKey = window.crypto && crypto.randomUUID ?
+        crypto.randomUUID() :
+        `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+    
+    function send(attempt) {
+        return fetch('/api/timesheet/punches', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                'Idempotency-Key': idempotencyKey
+            },
+            body: body
+        })
+        .then(response => response.json())
+        .catch(error => {
+            // The key makes a resend safe even if the first request was logged
+            if (attempt < PUNCH_SEND_RETRIES) {
+                return send(attempt + 1);
+            }
+            throw error;
+        });
+    }
+    
+    return send(0).then(data => data.success ? waitForPunch(data.punch, 0) : data);
+}
+
+function waitForPunch(punch, attempt) {
+    // Still queued after the last poll: it was accepted and will be applied
+    if (punch.status !== 'queued' || attempt >= PUNCH_POLL_ATTEMPTS) {
+        return Promise.resolve({success: punch.status !== 'rejected', error: punch.error, punch: punch});
+    }
+    return new Promise(resolve => setTimeout(resolve, PUNCH_POLL_INTERVAL_MS))
+        .then(() => fetch(`/api/timesheet/punches/${punch.id}`))
+        .then(response => response.json())
+        .then(data => data.success ? waitForPunch(data.punch, attempt + 1) : data);
+}
+
 function showClockOutModal() {
     const modal = new bootstrap.Modal(document.getElementById('clockOutModal'));
     
@@ -207,14 +245,7 @@ function confirmClockOut() {
         notes: notes
     };
     
-    fetch('/api/timesheet/clock-out', {
-        method: 'POST',
-        headers: {
-            'Content-Type': 'application/json',
-        },
-        body: JSON.stringify(data)
-    })
-    .then(response => response.json())
+    submitPunch('clock_out', data)
     .then(data => {
         if (data.success) {
             showAlert('Successfully clocked out!', 'info');
@@ -430,24 +461,74 @@ function loadTimesheetEntries() {
     
     const params = new URLSearchParams({
         start_date: startDate,
-        end_date: endDate
+        end_date: endDate,
+        limit: TIMESHEET_PAGE_SIZE
     });
     
-    fetch(`/api/timesheet/entries?${params}`)
-        .then(response => response.json())
-        .then(data => {
-            if (data.success) {
-                updateTimesheetTable(data.entries);
-                calculateStats(data.entries);
-                updateSummaryStats(data.entries, startDate, endDate);
-            } else {
-                showAlert('Error loading timesheet entries: ' + data.error, 'danger');
-            }
-        })
-        .catch(error => {
-            console.error('Timesheet entries load failed:', error.message || error);
-            showAlert('Failed to load timesheet entries', 'danger');
-        });
+    // Rows are shown page by page; totals need every page, so they wait for the last one
+    const generation = ++timesheetLoadGeneration;
+    const entries = [];
+    
+    function loadPage(cursor) {
+        if (cursor) {
+            params.set('cursor', cursor);
+        }
+        return fetch(`/api/timesheet/entries?${params}`)
+            .then(response => response.json())
+            .then(data => {
+                if (generation !== timesheetLoadGeneration) {
+                    return; // A newer load replaced this one
+                }
+                if (!data.success) {
+                    showAlert('Error loading timesheet entries: ' + data.error, 'danger');
+                    return;
+                }
+                
+                if (cursor) {
+                    appendTimesheetRows(data.entries);
+                } else {
+                    updateTimesheetTable(data.entries);
+                }
+                entries.push(...data.entries);
+                
+                if (data.next) {
+                    return loadPage(data.next);
+                }
+                calculateStats(entries);
+                updateSummaryStats(entries, startDate, endDate);
+            });
+    }
+    
+    loadPage(null).catch(error => {
+        console.error('Timesheet entries load failed:', error.message || error);
+        showAlert('Failed to load timesheet entries', 'danger');
+    });
+}
+
+function timesheetRowHtml(entry) {
+    const date = new Date(entry.date).toLocaleDateString();
+    const clockIn = entry.clock_in ? new Date(entry.clock_in).toLocaleTimeString([], {hour: '2-digit', minute: '2-digit', hour12: true}) : '--';
+    const clockOut = entry.clock_out ? new Date(entry.clock_out).toLocaleTimeString([], {hour: '2-digit', minute: '2-digit', hour12: true}) : '--';
+    
+    const duration = entry.duration > 0 ? 
+        `${Math.floor(entry.duration / 60)}h ${entry.duration % 60}m` : 
+        (entry.is_active ? 'Active' : '--');
+    
+    const statusBadge = entry.is_active ? 
+        '<span class="badge bg-success">Active</span>' : 
+        '<span class="badge bg-secondary">Completed</span>';
+    
+    return `
+        <tr>
+            <td>${date}</td>
+            <td>${clockIn}</td>
+            <td>${clockOut}</td>
+            <td>${duration}</td>
+            <td>${entry.location || 'Office'}</td>
+            <td>${entry.notes || '--'}</td>
+            <td>${statusBadge}</td>
+        </tr>
+    `;
 }
 
 function updateTimesheetTable(entries) {
@@ -458,34 +539,11 @@ function updateTimesheetTable(entries) {
         return;
     }
     
-    let html = '';
-    entries.forEach(entry => {
-        const date = new Date(entry.date).toLocaleDateString();
-        const clockIn = entry.clock_in ? new Date(entry.clock_in).toLocaleTimeString([], {hour: '2-digit', minute: '2-digit', hour12: true}) : '--';
-        const clockOut = entry.clock_out ? new Date(entry.clock_out).toLocaleTimeString([], {hour: '2-digit', minute: '2-digit', hour12: true}) : '--';
-        
-        const duration = entry.duration > 0 ? 
-            `${Math.floor(entry.duration / 60)}h ${entry.duration % 60}m` : 
-            (entry.is_active ? 'Active' : '--');
-        
-        const statusBadge = entry.is_active ? 
-            '<span class="badge bg-success">Active</span>' : 
-            '<span class="badge bg-secondary">Completed</span>';
-        
-        html += `
-            <tr>
-                <td>${date}</td>
-                <td>${clockIn}</td>
-                <td>${clockOut}</td>
-                <td>${duration}</td>
-                <td>${entry.location || 'Office'}</td>
-                <td>${entry.notes || '--'}</td>
-                <td>${statusBadge}</td>
-            </tr>
-        `;
-    });
-    
-    tbody.innerHTML = html;
+    tbody.innerHTML = entries.map(timesheetRowHtml).join('');
+}
+
+function appendTimesheetRows(entries) {
+    document.getElementById('timesheetTableBody').insertAdjacentHTML('beforeend', entries.map(timesheetRowHtml).join(''));
 }
 
 function calculateStats(entries) {
@@ -570,19 +628,10 @@ function startBreak() {
     
     const breakType = document.getElementById('statusSelect')?.value || 'Break';
     
-    fetch('/api/timesheet/start-break', {
-        method: 'POST',
-        headers: {
-            'Content-Type': 'application/json',
-        },
-        body: JSON.stringify({
-            break_type: breakType
-        })
-    })
-    .then(response => response.json())
+    submitPunch('break_start', {break_type: breakType})
     .then(data => {
         if (data.success) {
-            showAlert(data.message, 'success');
+            showAlert('Break started successfully. Change your status from "On Break" to end the break.', 'success');
             // Set status to "On Break" in the UI
             const statusSelect = document.getElementById('statusSelect');
             const statusDisplay = document.getElementById('currentStatusDisplay');
@@ -763,44 +812,19 @@ function handleQuickDateSelect() {
     endPicker.value = endDate.toISOString().split('T')[0];
 }
 
-// Auto-checkout after 6 hours
+// The server clocks out entries open past the user's auto-checkout threshold;
+// refresh once it has passed so the view reflects it
 function checkAutoCheckout() {
-    if (!currentStatus || !currentStatus.is_clocked_in) return;
+    if (!currentStatus || !currentStatus.is_clocked_in || !currentStatus.auto_checkout_hours) return;
     
     const clockInTime = new Date(currentStatus.clock_in);
     const now = new Date();
     const hoursWorked = (now - clockInTime) / (1000 * 60 * 60); // Convert to hours
     
-    // Auto checkout after 6 hours
-    if (hoursWorked >= 6) {
-        showAlert('You have been automatically clocked out after 6 hours of work time.', 'info');
-        
-        // Automatically clock out with summary
-        const notes = 'Auto checkout after 6 hours';
-        const task = currentStatus.current_task || 'Work completed';
-        
-        const data = {
-            notes: notes,
-            task: task
-        };
-        
-        fetch('/api/timesheet/clock-out', {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json',
-            },
-            body: JSON.stringify(data)
-        })
-        .then(response => response.json())
-        .then(data => {
-            if (data.success) {
-                loadTimesheetStatus();
-                loadTimesheetEntries();
-            }
-        })
-        .catch(error => {
-            console.error('Auto checkout failed:', error.message || error);
-        });
+    if (hoursWorked >= currentStatus.auto_checkout_hours) {
+        showAlert(`You have been automatically clocked out after ${currentStatus.auto_checkout_hours} hours of work time.`, 'info');
+        loadTimesheetStatus();
+        loadTimesheetEntries();
     }
 }
 
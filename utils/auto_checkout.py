@@ -0,0 +1,151 @@
+"""
+Scheduled auto-checkout of timesheet entries left open past their threshold
+"""
+import os
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from sqlalchemy import case
+from models import db, User, Department, TimesheetEntry, BreakEntry, UserStatus
+from utils.work_rollup import refresh_entries_rollup
+from utils.status_stream import record_bulk_status_changes
+
+AUTO_CHECKOUT_HOURS = float(os.environ.get('AUTO_CHECKOUT_HOURS', 6))  # Default when neither user nor department sets one
+AUTO_CHECKOUT_SWEEP_SECONDS = int(os.environ.get('AUTO_CHECKOUT_SWEEP_SECONDS', 60))  # 0 disables the background sweeper
+
+_sweeper = None
+
+
+def auto_checkout_hours(user):
+    """Threshold for one user: their own, else their department's, else the default"""
+    if user.auto_checkout_hours:
+        return user.auto_checkout_hours
+    if user.department and user.department.auto_checkout_hours:
+        return user.department.auto_checkout_hours
+    return AUTO_CHECKOUT_HOURS
+
+
+def auto_checkout_note(hours):
+    return f'[Auto-checkout after {hours:g} hours]'
+
+
+def threshold_overrides():
+    """{hours: [user ids]} for every user whose threshold is not the default"""
+    query = db.select(
+        User.id, db.func.coalesce(User.auto_checkout_hours, Department.auto_checkout_hours)
+    ).outerjoin(Department, User.department_id == Department.id).where(
+        db.or_(User.auto_checkout_hours.isnot(None), Department.auto_checkout_hours.isnot(None))
+    )
+    overrides = {}
+    for user_id, hours in db.session.execute(query):
+        if hours and hours != AUTO_CHECKOUT_HOURS:
+            overrides.setdefault(hours, []).append(user_id)
+    return overrides
+
+
+def sweep_auto_checkouts(now=None):
+    """Clock out every entry open longer than its owner's threshold; returns the closed entry ids.
+
+    One UPDATE closes the entries, batched ones end their open breaks at the
+    checkout time and store the break and work minutes, and another marks
+    their owners offline, committed together with the
+    refreshed daily work rollup. Running from several gunicorn workers at
+    once is safe: the clock_out IS NULL guard is re-checked on the locked
+    row, so an entry closed by one sweep is skipped by the others, and
+    RETURNING only reports the rows this sweep closed.
+    """
+    now = now or datetime.utcnow()
+    overrides = threshold_overrides()
+
+    def per_threshold(value_for, type_):
+        default = db.literal(value_for(AUTO_CHECKOUT_HOURS), type_)
+        if not overrides:
+            return default
+        return case(
+            *[(TimesheetEntry.user_id.in_(user_ids), db.literal(value_for(hours), type_))
+              for hours, user_ids in overrides.items()],
+            else_=default
+        )
+
+    cutoff = per_threshold(lambda hours: now - timedelta(hours=hours), db.DateTime)
+    note = per_threshold(auto_checkout_note, db.Text)
+    closed = db.session.execute(
+        TimesheetEntry.__table__.update().where(
+            TimesheetEntry.clock_out.is_(None),
+            TimesheetEntry.clock_in <= cutoff
+        ).values(
+            clock_out=now,
+            notes=case((db.func.coalesce(TimesheetEntry.notes, '') == '', note),
+                       else_=TimesheetEntry.notes + ' ' + note),
+            updated_at=now
+        ).returning(TimesheetEntry.id, TimesheetEntry.user_id, TimesheetEntry.clock_in, TimesheetEntry.break_duration)
+    ).all()
+
+    if closed:
+        # Breaks still running end with the entry, as close_timesheet_entry ends them
+        open_breaks = db.session.execute(
+            db.select(BreakEntry.id, BreakEntry.timesheet_entry_id, BreakEntry.break_start).where(
+                BreakEntry.timesheet_entry_id.in_([row.id for row in closed]),
+                BreakEntry.break_end.is_(None)
+            )
+        ).all()
+        ended_break_minutes = defaultdict(int)
+        if open_breaks:
+            break_minutes = []
+            for break_id, entry_id, break_start in open_breaks:
+                minutes = int((now - break_start).total_seconds() / 60)
+                ended_break_minutes[entry_id] += minutes
+                break_minutes.append({'break_id': break_id, 'minutes': minutes})
+            db.session.execute(
+                BreakEntry.__table__.update().where(
+                    BreakEntry.__table__.c.id == db.bindparam('break_id')
+                ).values(break_end=now, duration_minutes=db.bindparam('minutes')),
+                break_minutes
+            )
+        
+        entry_minutes = []
+        for entry_id, _, clock_in, break_duration in closed:
+            total_break = (break_duration or 0) + ended_break_minutes[entry_id]
+            entry_minutes.append({
+                'entry_id': entry_id,
+                'breaks': total_break,
+                'minutes': max(0, int((now - clock_in).total_seconds() / 60 - total_break))
+            })
+        db.session.execute(
+            TimesheetEntry.__table__.update().where(
+                TimesheetEntry.__table__.c.id == db.bindparam('entry_id')
+            ).values(break_duration=db.bindparam('breaks'), duration_minutes=db.bindparam('minutes')),
+            entry_minutes
+        )
+        db.session.execute(
+            UserStatus.__table__.update().where(
+                UserStatus.user_id.in_({row.user_id for row in closed})
+            ).values(is_working=False, current_timesheet_id=None, status_message='Offline', last_activity=now)
+        )
+        record_bulk_status_changes({row.user_id for row in closed})
+        refresh_entries_rollup((row.user_id, row.clock_in) for row in closed)
+    db.session.commit()
+    return [row.id for row in closed]
+
+
+def start_auto_checkout_sweeper(app, interval=AUTO_CHECKOUT_SWEEP_SECONDS):
+    """Run sweep_auto_checkouts every interval seconds in a daemon thread, once per process"""
+    global _sweeper
+    if interval <= 0 or _sweeper is not None:
+        return
+
+    def run():
+        while True:
+            time.sleep(interval)
+            with app.app_context():
+                try:
+                    sweep_auto_checkouts()
+                except Exception as e:
+                    db.session.rollback()
+                    print(f"Error in auto-checkout sweep: {str(e)}")
+                finally:
+                    db.session.remove()
+
+    _sweeper = threading.Thread(target=run, name='auto-checkout-sweeper', daemon=True)
+    _sweeper.start()
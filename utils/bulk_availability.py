@@ -0,0 +1,104 @@
+"""
+Set-based bulk ingestion of availability slots
+"""
+from datetime import datetime, date, time
+from models import db, AvailabilitySlot
+from utils.change_log import record_bulk_upserts
+
+BULK_INSERT_BATCH_SIZE = 1000  # Rows per multi-row INSERT
+MAX_BULK_SLOTS = 10000  # Largest submission accepted in one request
+
+
+def parse_slot_item(item, default_user_id):
+    """(user_id, date, start_time, end_time) from one submitted slot; raises ValueError.
+
+    Dates are YYYY-MM-DD and times HH:MM; fromisoformat is used rather than
+    strptime because it is far cheaper per call.
+    """
+    user_id = int(item.get('user_id') or default_user_id)
+    day = date.fromisoformat(item['date'])
+    start_time = time.fromisoformat(item['start_time'])
+    end_time = time.fromisoformat(item['end_time'])
+    if start_time >= end_time:
+        raise ValueError('End time must be after start time')
+    return user_id, day, start_time, end_time
+
+
+def existing_slot_keys(keys):
+    """Which (user_id, date, start_time, end_time) keys already exist, in one query.
+
+    Reads every single slot of the submitted users between the earliest and
+    latest submitted date and matches in memory, which keeps the number of
+    bind parameters independent of the submission size.
+    """
+    if not keys:
+        return set()
+    dates = [key[1] for key in keys]
+    query = db.select(
+        AvailabilitySlot.user_id, AvailabilitySlot.date, AvailabilitySlot.start_time, AvailabilitySlot.end_time
+    ).where(
+        AvailabilitySlot.user_id.in_({key[0] for key in keys}),
+        AvailabilitySlot.date.between(min(dates), max(dates)),
+        db.not_(AvailabilitySlot.recurring.is_(True))
+    )
+    return {tuple(row) for row in db.session.execute(query)} & set(keys)
+
+
+def insert_slots(keys, batch_size=BULK_INSERT_BATCH_SIZE):
+    """Insert slots with multi-row INSERTs, batch_size rows at a time; returns {key: id}.
+
+    Ids are matched back through the returned key columns rather than by
+    row order, which lets every backend batch the RETURNING inserts.
+    """
+    now = datetime.utcnow()
+    ids = {}
+    statement = AvailabilitySlot.__table__.insert().returning(
+        AvailabilitySlot.id, AvailabilitySlot.user_id, AvailabilitySlot.date,
+        AvailabilitySlot.start_time, AvailabilitySlot.end_time
+    )
+    for offset in range(0, len(keys), batch_size):
+        rows = [
+            {'user_id': user_id, 'date': day, 'start_time': start_time, 'end_time': end_time,
+             'recurring': False, 'created_at': now, 'updated_at': now}
+            for user_id, day, start_time, end_time in keys[offset:offset + batch_size]
+        ]
+        for slot_id, *key in db.session.execute(statement, rows):
+            ids[tuple(key)] = slot_id
+    record_bulk_upserts(AvailabilitySlot, ((slot_id, key[0]) for key, slot_id in ids.items()))
+    return ids
+
+
+def ingest_availability(items, default_user_id, allowed_user_ids):
+    """Validate, de-duplicate and insert many slots; returns one result per item.
+
+    Slots may only be added for users in allowed_user_ids. Items that repeat
+    an existing slot, or an earlier item of the same submission, are reported
+    as duplicates. The caller commits.
+    """
+    results = [None] * len(items)
+    pending = {}  # key -> index of the first item that submitted it
+    for index, item in enumerate(items):
+        try:
+            key = parse_slot_item(item, default_user_id)
+        except KeyError as e:
+            results[index] = {'index': index, 'status': 'error', 'error': f'Missing field {e}'}
+            continue
+        except (TypeError, ValueError) as e:
+            results[index] = {'index': index, 'status': 'error', 'error': str(e)}
+            continue
+        if key[0] not in allowed_user_ids:
+            results[index] = {'index': index, 'status': 'error', 'error': 'Access denied'}
+        elif key in pending:
+            results[index] = {'index': index, 'status': 'duplicate'}
+        else:
+            pending[key] = index
+
+    for key in existing_slot_keys(list(pending)):
+        index = pending.pop(key)
+        results[index] = {'index': index, 'status': 'duplicate'}
+
+    for key, slot_id in insert_slots(list(pending)).items():
+        index = pending[key]
+        results[index] = {'index': index, 'status': 'created', 'id': slot_id}
+
+    return results
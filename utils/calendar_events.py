@@ -0,0 +1,166 @@
+"""
+Batched loaders for calendar and Gantt event feeds
+"""
+from collections import defaultdict
+from datetime import datetime
+from models import db, User, AvailabilitySlot, BusySlot, LeaveDay
+from utils.conditional import change_marker
+from utils.json_stream import iter_rows
+from utils.recurrence import expand_availability, rule_occurrence_dates, availability_window_criteria
+
+
+def parse_window_date(value):
+    """Parse a window bound sent by FullCalendar ('2025-09-28' or '2025-09-28T00:00:00+05:30')"""
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value[:10], '%Y-%m-%d').date()
+    except ValueError:
+        return None
+
+
+def select_calendar_users(filter_type, user_filter=None, department_filter=None):
+    """Resolve the calendar filter parameters to the list of users to show"""
+    if filter_type == 'individual' and user_filter and user_filter != 'all':
+        user = User.query.get(int(user_filter))
+        return [user] if user else []
+    if filter_type == 'department' and department_filter and department_filter != 'all':
+        return User.query.filter_by(department_id=int(department_filter)).all()
+    return User.query.all()
+
+
+def load_user_events(user_ids, start=None, end=None, approved_leave_only=True):
+    """Load availability, busy and leave rows for many users in three queries.
+
+    The optional window is half-open like FullCalendar's: slots dated
+    start <= date < end, and leave ranges overlapping it. Recurring
+    availability is expanded into its occurrences in the window. Returns a
+    dict keyed by user id with 'availability', 'busy' and 'leave' lists, each
+    in insertion (id) order.
+    """
+    events = defaultdict(lambda: {'availability': [], 'busy': [], 'leave': []})
+    user_ids = list(user_ids)
+    if not user_ids:
+        return events
+
+    for model, key in ((AvailabilitySlot, 'availability'), (BusySlot, 'busy'), (LeaveDay, 'leave')):
+        criteria = [model.user_id.in_(user_ids)] + _window_criteria(model, start, end, approved_leave_only)
+        for row in model.query.filter(*criteria).order_by(model.user_id, model.id).all():
+            if model is AvailabilitySlot:
+                events[row.user_id][key].extend(expand_availability(row, start, end))
+            else:
+                events[row.user_id][key].append(row)
+
+    return events
+
+
+def load_user_event_times(user_ids, start=None, end=None):
+    """Like load_user_events, but only the dates and times, as plain tuples.
+
+    Skips building ORM objects for callers that only do interval arithmetic:
+    slots are (date, start_time, end_time) and approved leave is
+    (start_date, end_date). Busy slots and leave are ordered by start;
+    availability is too, except that recurring occurrences follow their rule.
+    """
+    events = defaultdict(lambda: {'availability': [], 'busy': [], 'leave': []})
+    user_ids = list(user_ids)
+    if not user_ids:
+        return events
+
+    query = db.select(
+        AvailabilitySlot.user_id, AvailabilitySlot.date, AvailabilitySlot.start_time, AvailabilitySlot.end_time,
+        AvailabilitySlot.recurring, AvailabilitySlot.recurring_days, AvailabilitySlot.recurrence_interval,
+        AvailabilitySlot.recurrence_until, AvailabilitySlot.recurrence_count, AvailabilitySlot.recurrence_exceptions
+    ).where(
+        AvailabilitySlot.user_id.in_(user_ids), *_window_criteria(AvailabilitySlot, start, end, True)
+    ).order_by(AvailabilitySlot.user_id, AvailabilitySlot.date, AvailabilitySlot.start_time)
+    for row in db.session.execute(query):
+        user_id, day, start_time, end_time, recurring = row[:5]
+        if recurring:
+            events[user_id]['availability'].extend(
+                (occurrence, start_time, end_time) for occurrence in rule_occurrence_dates(row, start, end))
+        else:
+            events[user_id]['availability'].append((day, start_time, end_time))
+
+    query = db.select(BusySlot.user_id, BusySlot.date, BusySlot.start_time, BusySlot.end_time).where(
+        BusySlot.user_id.in_(user_ids), *_window_criteria(BusySlot, start, end, True)
+    ).order_by(BusySlot.user_id, BusySlot.date, BusySlot.start_time)
+    for user_id, day, start_time, end_time in db.session.execute(query):
+        events[user_id]['busy'].append((day, start_time, end_time))
+
+    query = db.select(LeaveDay.user_id, LeaveDay.start_date, LeaveDay.end_date).where(
+        LeaveDay.user_id.in_(user_ids), *_window_criteria(LeaveDay, start, end, True)
+    ).order_by(LeaveDay.user_id, LeaveDay.start_date)
+    for user_id, start_date, end_date in db.session.execute(query):
+        events[user_id]['leave'].append((start_date, end_date))
+
+    return events
+
+
+def _window_criteria(model, start, end, approved_leave_only):
+    """Filters restricting an event model to a half-open date window"""
+    criteria = []
+    if model is AvailabilitySlot:
+        criteria.extend(availability_window_criteria(start, end))
+    elif model is LeaveDay:
+        if start:
+            criteria.append(LeaveDay.end_date >= start)
+        if end:
+            criteria.append(LeaveDay.start_date < end)
+        if approved_leave_only:
+            criteria.append(LeaveDay.approved_status == 'approved')
+    else:
+        if start:
+            criteria.append(model.date >= start)
+        if end:
+            criteria.append(model.date < end)
+    return criteria
+
+
+def calendar_user_scope(filter_type, user_filter, department_filter):
+    """Filter on User matching select_calendar_users, or None for everyone"""
+    if filter_type == 'individual' and user_filter and user_filter != 'all':
+        return User.id == int(user_filter)
+    if filter_type == 'department' and department_filter and department_filter != 'all':
+        return User.department_id == int(department_filter)
+    return None
+
+
+def feed_change_markers(filter_type, user_filter=None, department_filter=None,
+                        start=None, end=None, approved_leave_only=True):
+    """Row counts and newest updated_at for everything a feed is built from.
+
+    Costs one aggregate query per table and never loads the rows, so it can be
+    used to answer If-None-Match before the feed itself is built.
+    """
+    user_scope = calendar_user_scope(filter_type, user_filter, department_filter)
+    user_criteria = [user_scope] if user_scope is not None else []
+    markers = [change_marker(User, *user_criteria)]
+    for model in (AvailabilitySlot, BusySlot, LeaveDay):
+        criteria = _window_criteria(model, start, end, approved_leave_only)
+        if user_scope is not None:
+            criteria.append(model.user_id.in_(db.select(User.id).where(user_scope)))
+        markers.append(change_marker(model, *criteria))
+    return markers
+
+
+def iter_scope_events(filter_type, user_filter=None, department_filter=None,
+                      start=None, end=None, approved_leave_only=True, batch_size=1000):
+    """Stream (event_type, row, user) for a calendar scope without materialising it.
+
+    Rows come type by type (availability, busy, leave), each ordered by
+    (user_id, id), fetched batch_size at a time with the owner joined in.
+    """
+    user_scope = calendar_user_scope(filter_type, user_filter, department_filter)
+    for model, event_type in ((AvailabilitySlot, 'availability'), (BusySlot, 'busy'), (LeaveDay, 'leave')):
+        query = db.select(model, User).join(User, model.user_id == User.id).where(
+            *_window_criteria(model, start, end, approved_leave_only)
+        )
+        if user_scope is not None:
+            query = query.where(user_scope)
+        for row, user in iter_rows(query.order_by(model.user_id, model.id), batch_size):
+            if model is AvailabilitySlot:
+                for occurrence in expand_availability(row, start, end):
+                    yield event_type, occurrence, user
+            else:
+                yield event_type, row, user
@@ -0,0 +1,144 @@
+"""
+Change tracking for calendar events (availability, busy and leave rows)
+"""
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from models import db, User, AvailabilitySlot, BusySlot, LeaveDay, CalendarChange
+
+TRACKED_MODELS = {
+    AvailabilitySlot: 'availability',
+    BusySlot: 'busy',
+    LeaveDay: 'leave'
+}
+
+# Deltas larger than this are cheaper to replace with a full refetch
+MAX_CHANGES_PER_SYNC = 1000
+CHANGE_SETTLE_SECONDS = int(os.environ.get('CHANGE_SETTLE_SECONDS', 30))  # Longest a transaction writing events may stay open
+CALENDAR_CHANGE_RETENTION = timedelta(days=int(os.environ.get('CALENDAR_CHANGE_RETENTION_DAYS', 30)))  # Clients further behind refetch
+CHANGE_LOG_PRUNE_SECONDS = int(os.environ.get('CHANGE_LOG_PRUNE_SECONDS', 3600))  # 0 disables the background pruner
+
+_pruner = None
+
+
+@event.listens_for(Session, 'after_flush')
+def record_calendar_changes(session, flush_context):
+    """Append a change row for every tracked event written in this flush"""
+    now = datetime.utcnow()
+    rows = []
+    modified = [obj for obj in session.dirty if session.is_modified(obj)]
+    for objects, operation in ((session.new, 'upsert'), (modified, 'upsert'), (session.deleted, 'delete')):
+        for obj in objects:
+            event_type = TRACKED_MODELS.get(type(obj))
+            if event_type is None:
+                continue
+            rows.append({
+                'event_type': event_type,
+                'event_id': obj.id,
+                'user_id': obj.user_id,
+                'operation': operation,
+                'changed_at': now
+            })
+    if rows:
+        session.connection().execute(CalendarChange.__table__.insert(), rows)
+
+
+def record_bulk_upserts(model, written):
+    """Log rows written with bulk statements, which bypass the flush listener.
+
+    written is a list of (event_id, user_id) pairs.
+    """
+    now = datetime.utcnow()
+    rows = [
+        {'event_type': TRACKED_MODELS[model], 'event_id': event_id, 'user_id': user_id,
+         'operation': 'upsert', 'changed_at': now}
+        for event_id, user_id in written
+    ]
+    if rows:
+        db.session.execute(CalendarChange.__table__.insert(), rows)
+
+
+def latest_change_cursor(now=None):
+    """Cursor clients can resume from: the newest change older than CHANGE_SETTLE_SECONDS.
+
+    Ids are drawn when a change is flushed, not when it commits, so on
+    Postgres a transaction can commit a lower id after a higher one is
+    already visible. Holding the cursor behind recent changes makes clients
+    re-read them until every transaction that could still commit below them
+    has finished; re-sent changes are harmless since upserts carry the
+    current row. Returns 0 when nothing has been recorded.
+    """
+    settled = (now or datetime.utcnow()) - timedelta(seconds=CHANGE_SETTLE_SECONDS)
+    return db.session.execute(
+        db.select(CalendarChange.id).where(CalendarChange.changed_at < settled)
+        .order_by(CalendarChange.id.desc()).limit(1)
+    ).scalar() or 0
+
+
+def changes_since(cursor, user_scope=None):
+    """Collapse changes after cursor to the final operation per event.
+
+    user_scope is an optional filter on User restricting which owners' events
+    are returned. Returns (upserts, deletes, truncated) where upserts and
+    deletes are sets of (event_type, event_id) and truncated means the delta
+    was too large, or the cursor older than the retained log, and the client
+    should refetch instead.
+    """
+    oldest = db.session.query(db.func.min(CalendarChange.id)).scalar()
+    if oldest is not None and cursor < oldest - 1:
+        # Changes after the cursor may have been pruned
+        return set(), set(), True
+
+    query = CalendarChange.query.filter(CalendarChange.id > cursor)
+    if user_scope is not None:
+        query = query.filter(CalendarChange.user_id.in_(db.select(User.id).where(user_scope)))
+    changes = query.order_by(CalendarChange.id).limit(MAX_CHANGES_PER_SYNC + 1).all()
+
+    truncated = len(changes) > MAX_CHANGES_PER_SYNC
+    final_operations = {}
+    for change in changes[:MAX_CHANGES_PER_SYNC]:
+        final_operations[(change.event_type, change.event_id)] = change.operation
+
+    upserts = {key for key, operation in final_operations.items() if operation == 'upsert'}
+    deletes = {key for key, operation in final_operations.items() if operation == 'delete'}
+    return upserts, deletes, truncated
+
+
+def prune_calendar_changes(now=None):
+    """Drop changes older than CALENDAR_CHANGE_RETENTION; returns how many were removed.
+
+    Changes at or after the current cursor are kept however old, so the
+    cursor never moves back and the retained range always starts at it.
+    """
+    cutoff = (now or datetime.utcnow()) - CALENDAR_CHANGE_RETENTION
+    result = db.session.execute(CalendarChange.__table__.delete().where(
+        CalendarChange.changed_at < cutoff,
+        CalendarChange.id < latest_change_cursor(now)
+    ))
+    db.session.commit()
+    return result.rowcount
+
+
+def start_change_log_pruner(app, interval=CHANGE_LOG_PRUNE_SECONDS):
+    """Run prune_calendar_changes every interval seconds in a daemon thread, once per process"""
+    global _pruner
+    if interval <= 0 or _pruner is not None:
+        return
+
+    def run():
+        while True:
+            time.sleep(interval)
+            with app.app_context():
+                try:
+                    prune_calendar_changes()
+                except Exception as e:
+                    db.session.rollback()
+                    print(f"Error pruning calendar changes: {str(e)}")
+                finally:
+                    db.session.remove()
+
+    _pruner = threading.Thread(target=run, name='change-log-pruner', daemon=True)
+    _pruner.start()
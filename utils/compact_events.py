@@ -0,0 +1,89 @@
+"""
+Dictionary-encoded compact payload for the calendar event feed
+"""
+from flask import current_app, jsonify, request
+from utils.timeline import MINUTES_PER_DAY, time_range_interval
+
+try:
+    import msgpack
+except ImportError:  # Optional: without it compact feeds are always sent as JSON
+    msgpack = None
+
+EVENT_TYPE_CODES = {'availability': 0, 'busy': 1, 'leave': 2}
+MSGPACK_MIMETYPES = ('application/msgpack', 'application/x-msgpack')
+
+
+def wants_msgpack():
+    """Whether the client prefers MessagePack over JSON (and it can be produced)"""
+    if msgpack is None:
+        return False
+    return request.accept_mimetypes.best_match(('application/json',) + MSGPACK_MIMETYPES) in MSGPACK_MIMETYPES
+
+
+def encode_compact_events(users, events_by_user, origin, color_for):
+    """Encode a feed as a user dictionary plus one short array per event.
+
+    Each event is [type code, user index, start, end, id] with start and end
+    in minutes from origin midnight (leave: the midnights of its first and
+    last day). Fields that differ from the defaults the client assumes (busy
+    title and description, leave type and notes, recurring) follow as a
+    sixth element.
+    """
+    user_table = []
+    events = []
+    for user in users:
+        user_events = events_by_user[user.id]
+        if not any(user_events.values()):
+            continue
+        index = len(user_table)
+        user_table.append([user.id, user.username, color_for(user)])
+
+        for slot in user_events['availability']:
+            start, end = time_range_interval(slot.date, slot.start_time, slot.end_time, origin)
+            event = [EVENT_TYPE_CODES['availability'], index, start, end, slot.id]
+            if slot.recurring:
+                event.append({'recurring': True})
+            events.append(event)
+
+        for slot in user_events['busy']:
+            start, end = time_range_interval(slot.date, slot.start_time, slot.end_time, origin)
+            event = [EVENT_TYPE_CODES['busy'], index, start, end, slot.id]
+            extra = {}
+            if slot.title != 'Busy':
+                extra['title'] = slot.title
+            if slot.description:
+                extra['description'] = slot.description
+            if extra:
+                event.append(extra)
+            events.append(event)
+
+        for leave in user_events['leave']:
+            start = (leave.start_date - origin).days * MINUTES_PER_DAY
+            end = (leave.end_date - origin).days * MINUTES_PER_DAY
+            event = [EVENT_TYPE_CODES['leave'], index, start, end, leave.id]
+            extra = {}
+            if leave.leave_type != 'Leave':
+                extra['leave_type'] = leave.leave_type
+            if leave.notes:
+                extra['notes'] = leave.notes
+            if extra:
+                event.append(extra)
+            events.append(event)
+
+    return {
+        'format': 'compact',
+        'origin': origin.isoformat(),
+        'types': list(EVENT_TYPE_CODES),
+        'users': user_table,
+        'events': events
+    }
+
+
+def compact_response(payload):
+    """Serialize a compact payload as MessagePack or JSON, following the Accept header"""
+    if wants_msgpack():
+        response = current_app.response_class(msgpack.packb(payload), mimetype='application/msgpack')
+    else:
+        response = jsonify(payload)
+    response.vary.add('Accept')
+    return response
@@ -0,0 +1,50 @@
+"""
+Conditional (ETag / If-None-Match) responses for JSON read endpoints
+"""
+import hashlib
+from datetime import timezone
+from flask import request, current_app
+from models import db
+
+
+def change_marker(model, *criteria, extra=()):
+    """Cheap change marker for a row scope: row count, newest updated_at and any extra aggregates"""
+    query = db.session.query(db.func.count(model.id), db.func.max(model.updated_at), *extra)
+    if criteria:
+        query = query.filter(*criteria)
+    return tuple(query.one())
+
+
+def compute_etag(*parts):
+    """Strong ETag for a response built from the given markers and parameters"""
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+
+def with_etag(response, etag):
+    """Attach the ETag and make clients revalidate before reusing their copy"""
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def not_modified(etag):
+    """Return a 304 response if the client already holds this ETag, else None"""
+    if etag and request.if_none_match.contains(etag):
+        return with_etag(current_app.response_class(status=304), etag)
+    return None
+
+
+def not_modified_since(etag, last_modified):
+    """Like not_modified, falling back to If-Modified-Since when no ETag was sent.
+
+    last_modified is a naive UTC datetime; If-None-Match takes precedence as
+    RFC 9110 requires.
+    """
+    if request.if_none_match:
+        return not_modified(etag)
+    since = request.if_modified_since
+    if last_modified and since and last_modified.replace(tzinfo=timezone.utc, microsecond=0) <= since:
+        response = with_etag(current_app.response_class(status=304), etag)
+        response.last_modified = last_modified
+        return response
+    return None
@@ -0,0 +1,46 @@
+"""
+Incremental CSV encoding (optionally gzip-compressed) for large exports
+"""
+import csv
+import io
+import zlib
+from flask import request
+
+CSV_ROWS_PER_CHUNK = 500  # Rows encoded per chunk written to the socket
+GZIP_LEVEL = 6
+
+
+def wants_gzip():
+    """Whether the client asked for a gzip-compressed file (?gzip=1)"""
+    return request.args.get('gzip', '').lower() in ('1', 'true', 'yes')
+
+
+def iter_csv(header, rows, rows_per_chunk=CSV_ROWS_PER_CHUNK):
+    """Yield a CSV document chunk by chunk; the header goes out before any row is read"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    count = 0
+    for row in rows:
+        writer.writerow(row)
+        count += 1
+        if count >= rows_per_chunk:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            count = 0
+    yield buffer.getvalue()
+
+
+def iter_gzip(chunks, level=GZIP_LEVEL, encoding='utf-8'):
+    """Compress text chunks into a gzip stream as they are produced.
+
+    Each chunk is flushed with Z_SYNC_FLUSH so the client receives data as
+    soon as it is encoded instead of when the compressor's window fills.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits 31: gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode(encoding)) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
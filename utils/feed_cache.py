@@ -0,0 +1,111 @@
+"""
+Versioned in-process cache for serialized calendar and Gantt feeds
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+FEED_CACHE_TTL = int(os.environ.get('FEED_CACHE_TTL', 60))  # Seconds; bounds staleness across workers
+FEED_CACHE_MAX_ENTRIES = int(os.environ.get('FEED_CACHE_MAX_ENTRIES', 512))
+
+
+class FeedCache:
+    """Cache of rendered feeds keyed by (feed, filter_type, scope, window).
+
+    Every entry remembers the version of the scope it was built from. Writes
+    bump the version of the affected user, their department and the whole team,
+    so stale entries simply stop matching instead of having to be found and
+    deleted. Versions live in this process only; the TTL bounds how long
+    another gunicorn worker can serve a feed after a write it did not see.
+    """
+
+    def __init__(self, ttl=FEED_CACHE_TTL, max_entries=FEED_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._user_versions = {}
+        self._department_versions = {}
+        self._team_version = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def scope_version(self, filter_type, user_id=None, department_id=None):
+        """Current version of the rows behind a feed scope"""
+        with self._lock:
+            if filter_type == 'individual' and user_id not in (None, 'all'):
+                return ('user', self._user_versions.get(int(user_id), 0))
+            if filter_type == 'department' and department_id not in (None, 'all'):
+                return ('department', self._department_versions.get(int(department_id), 0))
+            return ('team', self._team_version)
+
+    def get(self, key, version):
+        """Return the cached value for key if it was built from this version"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] == version and entry[1] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+            return None
+
+    def set(self, key, version, value):
+        """Store a rendered feed (body and ETag) built from the given scope version"""
+        with self._lock:
+            self._entries[key] = (version, time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate_user(self, user_id, department_id=None):
+        """Bump versions for a user, their department and the team-wide feeds"""
+        with self._lock:
+            self._user_versions[user_id] = self._user_versions.get(user_id, 0) + 1
+            if department_id is not None:
+                self._department_versions[department_id] = self._department_versions.get(department_id, 0) + 1
+            self._team_version += 1
+            self.invalidations += 1
+
+    def invalidate_department(self, department_id):
+        """Bump the version of a department feed (membership changes)"""
+        if department_id is None:
+            return
+        with self._lock:
+            self._department_versions[department_id] = self._department_versions.get(department_id, 0) + 1
+            self.invalidations += 1
+
+    def clear(self):
+        """Drop every cached feed"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Hit/miss counters for monitoring"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0,
+                'invalidations': self.invalidations,
+                'ttl_seconds': self.ttl
+            }
+
+
+feed_cache = FeedCache()
+
+
+def invalidate_user_feeds(user):
+    """Invalidate every cached feed that can contain rows belonging to user"""
+    feed_cache.invalidate_user(user.id, user.department_id)
+
+
+def invalidate_membership_feeds(user, old_department_id):
+    """Invalidate feeds after a user's department or display name changed"""
+    feed_cache.invalidate_user(user.id, user.department_id)
+    if old_department_id != user.department_id:
+        feed_cache.invalidate_department(old_department_id)
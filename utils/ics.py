@@ -0,0 +1,107 @@
+"""
+iCalendar (ICS) rendering for calendar subscription feeds
+"""
+import os
+from datetime import datetime, timedelta
+
+ICS_PAST_DAYS = int(os.environ.get('ICS_PAST_DAYS', 30))  # Days before today included in a feed
+ICS_FUTURE_DAYS = int(os.environ.get('ICS_FUTURE_DAYS', 180))  # Days after today included in a feed
+ICS_EVENTS_PER_CHUNK = 200  # VEVENTs encoded per chunk written to the socket
+ICS_CACHE_MAX_BYTES = int(os.environ.get('ICS_CACHE_MAX_BYTES', 2 * 1024 * 1024))  # Larger feeds are not cached
+ICS_UID_DOMAIN = 'teamcal'
+
+
+def ics_window(today=None):
+    """Half-open date window a subscription feed covers"""
+    today = today or datetime.utcnow().date()
+    return today - timedelta(days=ICS_PAST_DAYS), today + timedelta(days=ICS_FUTURE_DAYS)
+
+
+def escape_text(value):
+    """Escape a TEXT property value (RFC 5545 3.3.11)"""
+    return (str(value or '').replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,')
+            .replace('\r\n', '\\n').replace('\n', '\\n'))
+
+
+def fold_line(line):
+    """Fold a content line to 75 octets, continuation lines starting with a space"""
+    encoded = line.encode('utf-8')
+    if len(encoded) <= 75:
+        return line + '\r\n'
+    parts = []
+    while encoded:
+        limit = 75 if not parts else 74
+        cut = min(limit, len(encoded))
+        # Never split a multi-byte character
+        while cut < len(encoded) and (encoded[cut] & 0xC0) == 0x80:
+            cut -= 1
+        parts.append(encoded[:cut].decode('utf-8'))
+        encoded = encoded[cut:]
+    return '\r\n '.join(parts) + '\r\n'
+
+
+def _format_datetime(day, value):
+    return f'{day:%Y%m%d}T{value:%H%M%S}'
+
+
+def render_vevent(event_type, row, user, dtstamp):
+    """VEVENT for an availability, busy or leave row (slot times are floating local times)"""
+    if event_type == 'leave':
+        uid = f'leave-{row.id}'
+        lines = [
+            f'DTSTART;VALUE=DATE:{row.start_date:%Y%m%d}',
+            f'DTEND;VALUE=DATE:{row.end_date + timedelta(days=1):%Y%m%d}',
+            f'SUMMARY:{escape_text(f"{user.username} - {row.leave_type}")}',
+            'TRANSP:TRANSPARENT'
+        ]
+        if row.notes:
+            lines.append(f'DESCRIPTION:{escape_text(row.notes)}')
+    else:
+        end_day = row.date + timedelta(days=1) if row.end_time < row.start_time else row.date
+        if event_type == 'availability':
+            # Occurrences of a recurring slot share its id, so the date keeps their UIDs apart
+            uid = f'avail-{row.id}-{row.date:%Y%m%d}' if row.recurring else f'avail-{row.id}'
+            summary = f'{user.username} - Available'
+        else:
+            uid = f'busy-{row.id}'
+            summary = f'{user.username} - {row.title}'
+        lines = [
+            f'DTSTART:{_format_datetime(row.date, row.start_time)}',
+            f'DTEND:{_format_datetime(end_day, row.end_time)}',
+            f'SUMMARY:{escape_text(summary)}',
+            'TRANSP:TRANSPARENT' if event_type == 'availability' else 'TRANSP:OPAQUE'
+        ]
+        if event_type == 'busy' and row.description:
+            lines.append(f'DESCRIPTION:{escape_text(row.description)}')
+
+    lines = [
+        'BEGIN:VEVENT',
+        f'UID:{uid}@{ICS_UID_DOMAIN}',
+        f'DTSTAMP:{dtstamp:%Y%m%dT%H%M%SZ}',
+        *lines,
+        f'CATEGORIES:{event_type.upper()}',
+        'END:VEVENT'
+    ]
+    return ''.join(fold_line(line) for line in lines)
+
+
+def iter_ics_calendar(name, events, dtstamp=None):
+    """Yield a VCALENDAR chunk by chunk from (event_type, row, user) tuples"""
+    dtstamp = dtstamp or datetime.utcnow()
+    yield ''.join(fold_line(line) for line in (
+        'BEGIN:VCALENDAR',
+        'VERSION:2.0',
+        'PRODID:-//TeamCal//Calendar Feed//EN',
+        'CALSCALE:GREGORIAN',
+        'METHOD:PUBLISH',
+        f'X-WR-CALNAME:{escape_text(name)}'
+    ))
+    batch = []
+    for event_type, row, user in events:
+        batch.append(render_vevent(event_type, row, user, dtstamp))
+        if len(batch) >= ICS_EVENTS_PER_CHUNK:
+            yield ''.join(batch)
+            batch = []
+    if batch:
+        yield ''.join(batch)
+    yield 'END:VCALENDAR\r\n'
@@ -0,0 +1,66 @@
+"""
+Incremental JSON encoding for large list responses
+"""
+from flask import Response, current_app, request, stream_with_context
+from models import db
+
+STREAM_BATCH_SIZE = 500  # Elements encoded per chunk written to the socket
+STREAM_FETCH_SIZE = 1000  # Rows fetched per round trip (server-side cursor on PostgreSQL)
+
+
+def wants_stream():
+    """Whether the client asked for a streamed response (?stream=1)"""
+    return request.args.get('stream', '').lower() in ('1', 'true', 'yes')
+
+
+def _compact_dumps(obj):
+    """Encode like jsonify does outside debug mode"""
+    return current_app.json.dumps(obj, separators=(',', ':'))
+
+
+def iter_rows(statement, batch_size=STREAM_FETCH_SIZE):
+    """Execute a select lazily and yield its rows batch_size at a time.
+
+    The statement only runs once the response starts streaming, inside the
+    session stream_with_context keeps alive, not the one torn down when the
+    view returns.
+    """
+    yield from db.session.execute(statement.execution_options(yield_per=batch_size))
+
+
+def iter_json_array(items, batch_size=STREAM_BATCH_SIZE):
+    """Yield a JSON array chunk by chunk, encoding batch_size elements at a time"""
+    dumps = _compact_dumps
+    yield '['
+    separator = ''
+    batch = []
+    for item in items:
+        batch.append(dumps(item))
+        if len(batch) >= batch_size:
+            yield separator + ','.join(batch)
+            separator = ','
+            batch = []
+    if batch:
+        yield separator + ','.join(batch)
+    yield ']'
+
+
+def iter_json_object(fields, array_key, items, trailer=None):
+    """Yield a JSON object whose array_key member is streamed.
+
+    fields are written before the array; trailer, if given, is called after
+    the array has been exhausted and returns fields that depend on it (such as
+    totals accumulated while streaming).
+    """
+    dumps = _compact_dumps
+    yield '{' + ''.join(f'{dumps(key)}:{dumps(value)},' for key, value in fields.items()) + f'{dumps(array_key)}:'
+    yield from iter_json_array(items)
+    if trailer:
+        for key, value in trailer().items():
+            yield f',{dumps(key)}:{dumps(value)}'
+    yield '}'
+
+
+def streaming_json_response(chunks):
+    """Wrap a chunk generator in a response that keeps the request context alive"""
+    return Response(stream_with_context(chunks), mimetype='application/json')
@@ -0,0 +1,153 @@
+"""
+Batch payroll: regular and overtime hours and pay per employee and week
+"""
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal
+from models import db, User, DailyWorkRollup, PayrollRun, PayrollLine
+
+MAX_PAYROLL_DAYS = 93  # Longest pay period accepted in one run
+PAYROLL_INSERT_BATCH_SIZE = 1000
+DEFAULT_STANDARD_HOURS = 40
+CENTS = Decimal('0.01')
+
+
+def week_start_of(day):
+    """Monday of the week containing day"""
+    return day - timedelta(days=day.weekday())
+
+
+def split_overtime(worked, standard):
+    """(regular, overtime) split of a week's worked time at the standard allowance"""
+    return min(worked, standard), max(worked - standard, 0)
+
+
+def minutes_pay(minutes, rate):
+    """Pay for a number of minutes at an hourly rate, rounded to cents"""
+    return (Decimal(minutes) * rate / 60).quantize(CENTS)
+
+
+def load_weekly_minutes(period_start, period_end):
+    """{(user_id, week_start): {work_date: worked minutes}} for approved employees.
+
+    One grouped query over the daily work rollup (already one row per user,
+    local day and location however many entries a day had); days are
+    bucketed into weeks in a single pass. Weeks that straddle the period
+    boundary include their days outside the period, since overtime is owed
+    on the whole week's hours.
+    """
+    query = db.select(
+        DailyWorkRollup.user_id, DailyWorkRollup.work_date, db.func.sum(DailyWorkRollup.worked_minutes)
+    ).join(User, User.id == DailyWorkRollup.user_id).where(
+        User.approval_status == 'approved',
+        DailyWorkRollup.work_date.between(week_start_of(period_start), week_start_of(period_end) + timedelta(days=6))
+    ).group_by(DailyWorkRollup.user_id, DailyWorkRollup.work_date)
+
+    weekly = defaultdict(dict)
+    for user_id, work_date, minutes in db.session.execute(query):
+        weekly[(user_id, week_start_of(work_date))][work_date] = int(minutes or 0)
+    return weekly
+
+
+def split_week_in_period(days, standard, period_start, period_end):
+    """(regular, overtime) minutes of a week's days that fall within the period.
+
+    Overtime is computed on the whole week and accrues on the days worked
+    after the standard allowance ran out, so the runs covering either side
+    of a straddling week add up to the split of the full week.
+    """
+    regular = overtime = worked = 0
+    for work_date, minutes in sorted(days.items()):
+        regular_before, overtime_before = split_overtime(worked, standard)
+        worked += minutes
+        regular_after, overtime_after = split_overtime(worked, standard)
+        if period_start <= work_date <= period_end:
+            regular += regular_after - regular_before
+            overtime += overtime_after - overtime_before
+    return regular, overtime
+
+
+def compute_payroll_lines(period_start, period_end):
+    """Payroll lines (dicts ready for insert) for every employee and week with worked time"""
+    weekly = load_weekly_minutes(period_start, period_end)
+    if not weekly:
+        return []
+    employees = {
+        row.id: row for row in db.session.execute(
+            db.select(User.id, User.standard_hours, User.hourly_rate, User.overtime_rate).where(
+                User.id.in_({user_id for user_id, _ in weekly})
+            )
+        )
+    }
+
+    lines = []
+    for (user_id, week_start), days in sorted(weekly.items()):
+        employee = employees[user_id]
+        hourly_rate = Decimal(employee.hourly_rate or 0)
+        overtime_rate = Decimal(employee.overtime_rate or 0)
+        standard_hours = DEFAULT_STANDARD_HOURS if employee.standard_hours is None else employee.standard_hours
+        regular_minutes, overtime_minutes = split_week_in_period(days, standard_hours * 60, period_start, period_end)
+        if not regular_minutes and not overtime_minutes:
+            continue  # Only worked outside the period
+        regular_pay = minutes_pay(regular_minutes, hourly_rate)
+        overtime_pay = minutes_pay(overtime_minutes, overtime_rate)
+        lines.append({
+            'user_id': user_id,
+            'week_start': week_start,
+            'regular_minutes': regular_minutes,
+            'overtime_minutes': overtime_minutes,
+            'hourly_rate': hourly_rate,
+            'overtime_rate': overtime_rate,
+            'regular_pay': regular_pay,
+            'overtime_pay': overtime_pay,
+            'gross_pay': regular_pay + overtime_pay
+        })
+    return lines
+
+
+def run_payroll(period_start, period_end, created_by=None, batch_size=PAYROLL_INSERT_BATCH_SIZE):
+    """Compute and persist a payroll snapshot for the period; returns the PayrollRun. The caller commits."""
+    lines = compute_payroll_lines(period_start, period_end)
+    run = PayrollRun(
+        period_start=period_start,
+        period_end=period_end,
+        employee_count=len({line['user_id'] for line in lines}),
+        total_gross_pay=sum((line['gross_pay'] for line in lines), Decimal('0.00')),
+        created_by=created_by
+    )
+    db.session.add(run)
+    db.session.flush()
+
+    for offset in range(0, len(lines), batch_size):
+        db.session.execute(
+            PayrollLine.__table__.insert(),
+            [dict(line, run_id=run.id) for line in lines[offset:offset + batch_size]]
+        )
+    return run
+
+
+def serialize_payroll_run(run):
+    return {
+        'id': run.id,
+        'period_start': run.period_start.isoformat(),
+        'period_end': run.period_end.isoformat(),
+        'employee_count': run.employee_count,
+        'total_gross_pay': float(run.total_gross_pay or 0),
+        'created_by': run.created_by,
+        'created_at': run.created_at.isoformat() if run.created_at else None
+    }
+
+
+def serialize_payroll_line(line, username):
+    return {
+        'user_id': line.user_id,
+        'username': username,
+        'week_start': line.week_start.isoformat(),
+        'regular_hours': round(line.regular_minutes / 60, 2),
+        'overtime_hours': round(line.overtime_minutes / 60, 2),
+        'hourly_rate': float(line.hourly_rate or 0),
+        'overtime_rate': float(line.overtime_rate or 0),
+        'regular_pay': float(line.regular_pay or 0),
+        'overtime_pay': float(line.overtime_pay or 0),
+        'gross_pay': float(line.gross_pay or 0)
+    }
@@ -0,0 +1,210 @@
+"""
+Write-behind presence: status and task changes held in a local SQLite sidecar and flushed to UserStatus in batches
+"""
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from flask import current_app
+from sqlalchemy import case
+from models import db, UserStatus
+
+PRESENCE_FLUSH_SECONDS = float(os.environ.get('PRESENCE_FLUSH_SECONDS', 5))  # 0 disables the background flusher
+PRESENCE_DB_PATH = os.environ.get('PRESENCE_DB_PATH')  # Defaults to presence.db in the instance folder; shared by the workers of one host
+
+_local = threading.local()
+_flusher = None
+
+PRESENCE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS presence (
+    user_id INTEGER PRIMARY KEY,
+    status_message TEXT,
+    current_task TEXT,
+    has_status INTEGER NOT NULL DEFAULT 0,
+    has_task INTEGER NOT NULL DEFAULT 0,
+    last_activity TEXT NOT NULL,
+    pending INTEGER NOT NULL DEFAULT 1
+)
+'''
+
+# Later writes win field by field, so a status-only change keeps a pending task
+UPSERT_PRESENCE = '''
+INSERT INTO presence (user_id, status_message, current_task, has_status, has_task, last_activity, pending)
+VALUES (:user_id, :status_message, :current_task, :has_status, :has_task, :last_activity, 1)
+ON CONFLICT (user_id) DO UPDATE SET
+    status_message = CASE WHEN excluded.has_status THEN excluded.status_message ELSE presence.status_message END,
+    current_task = CASE WHEN excluded.has_task THEN excluded.current_task ELSE presence.current_task END,
+    has_status = presence.has_status OR excluded.has_status,
+    has_task = presence.has_task OR excluded.has_task,
+    last_activity = MAX(presence.last_activity, excluded.last_activity),
+    pending = 1
+'''
+
+
+def _connection():
+    """This thread's connection to the sidecar, opened on first use"""
+    path = PRESENCE_DB_PATH or os.path.join(current_app.instance_path, 'presence.db')
+    connection = getattr(_local, 'connection', None)
+    if connection is None or _local.path != path:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        # Autocommit; the flusher opens its own IMMEDIATE transaction to claim rows
+        connection = sqlite3.connect(path, timeout=5, isolation_level=None)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.execute(PRESENCE_SCHEMA)
+        _local.connection, _local.path = connection, path
+    return connection
+
+
+def _timestamp(value):
+    return value.isoformat(timespec='microseconds')
+
+
+def record_presence(user_id, last_activity, **fields):
+    """Queue a status_message and/or current_task change for a user; the flusher writes it to UserStatus"""
+    _connection().execute(UPSERT_PRESENCE, {
+        'user_id': user_id,
+        'status_message': fields.get('status_message'),
+        'current_task': fields.get('current_task'),
+        'has_status': 'status_message' in fields,
+        'has_task': 'current_task' in fields,
+        'last_activity': _timestamp(last_activity)
+    })
+
+
+def _pending_row(user_id, status_message, current_task, has_status, has_task, last_activity):
+    pending = {'user_id': user_id, 'last_activity': datetime.fromisoformat(last_activity)}
+    if has_status:
+        pending['status_message'] = status_message
+    if has_task:
+        pending['current_task'] = current_task
+    return pending
+
+
+def pending_presence(user_ids=None):
+    """{user_id: pending fields} of the changes not flushed yet, for all users or the given ones"""
+    query = 'SELECT user_id, status_message, current_task, has_status, has_task, last_activity FROM presence WHERE pending'
+    rows = _connection().execute(query).fetchall()
+    if user_ids is not None:
+        user_ids = set(user_ids)
+        rows = [row for row in rows if row[0] in user_ids]
+    return {row[0]: _pending_row(*row) for row in rows}
+
+
+def effective_presence(status, pending):
+    """(status_message, current_task, last_activity) of a UserStatus row with its pending change applied.
+
+    The newer last_activity wins: a punch or sync status write made after the
+    pending change overrides it, and the flusher skips it the same way.
+    """
+    values = (status.status_message, status.current_task, status.last_activity)
+    if pending is None or (status.last_activity and pending['last_activity'] <= status.last_activity):
+        return values
+    return (
+        pending.get('status_message', values[0]),
+        pending.get('current_task', values[1]),
+        pending['last_activity']
+    )
+
+
+def _claim():
+    connection = _connection()
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        rows = connection.execute(
+            'SELECT user_id, status_message, current_task, has_status, has_task, last_activity FROM presence WHERE pending'
+        ).fetchall()
+        connection.execute('UPDATE presence SET pending = 0, has_status = 0, has_task = 0 WHERE pending')
+        connection.execute('COMMIT')
+    except Exception:
+        connection.execute('ROLLBACK')
+        raise
+    return [_pending_row(*row) for row in rows]
+
+
+def _release(claimed):
+    """Mark claimed changes pending again after a failed flush, under any newer ones"""
+    _connection().executemany('''
+        UPDATE presence SET
+            status_message = CASE WHEN has_status THEN status_message ELSE :status_message END,
+            current_task = CASE WHEN has_task THEN current_task ELSE :current_task END,
+            has_status = has_status OR :has_status,
+            has_task = has_task OR :has_task,
+            last_activity = MAX(last_activity, :last_activity),
+            pending = 1
+        WHERE user_id = :user_id
+    ''', [{
+        'user_id': pending['user_id'],
+        'status_message': pending.get('status_message'),
+        'current_task': pending.get('current_task'),
+        'has_status': 'status_message' in pending,
+        'has_task': 'current_task' in pending,
+        'last_activity': _timestamp(pending['last_activity'])
+    } for pending in claimed])
+
+
+def flush_presence():
+    """Write every pending presence change to UserStatus in one transaction; returns the number of users flushed.
+
+    Changes are claimed atomically from the sidecar, so the flushers of
+    several workers never write the same change twice. All of them go out
+    as one executemany UPDATE, skipping rows a newer write (a punch, the
+    auto-checkout sweep) already moved past. If the commit fails the changes
+    are put back for the next flush.
+    """
+    # Imported here: the status stream itself reads pending presence
+    from utils.status_stream import record_bulk_status_changes
+    claimed = _claim()
+    if not claimed:
+        return 0
+    table = UserStatus.__table__
+    try:
+        db.session.execute(
+            table.update().where(
+                table.c.user_id == db.bindparam('target_user_id'),
+                db.or_(table.c.last_activity.is_(None), table.c.last_activity <= db.bindparam('activity'))
+            ).values(
+                status_message=case((db.bindparam('has_status', type_=db.Boolean), db.bindparam('new_status')),
+                                    else_=table.c.status_message),
+                current_task=case((db.bindparam('has_task', type_=db.Boolean), db.bindparam('new_task')),
+                                  else_=table.c.current_task),
+                last_activity=db.bindparam('activity')
+            ),
+            [{
+                'target_user_id': pending['user_id'],
+                'has_status': 'status_message' in pending,
+                'new_status': pending.get('status_message'),
+                'has_task': 'current_task' in pending,
+                'new_task': pending.get('current_task'),
+                'activity': pending['last_activity']
+            } for pending in claimed]
+        )
+        record_bulk_status_changes({pending['user_id'] for pending in claimed})
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        _release(claimed)
+        raise
+    return len(claimed)
+
+
+def start_presence_flusher(app, interval=PRESENCE_FLUSH_SECONDS):
+    """Run flush_presence every interval seconds in a daemon thread, once per process"""
+    global _flusher
+    if interval <= 0 or _flusher is not None:
+        return
+
+    def run():
+        while True:
+            time.sleep(interval)
+            with app.app_context():
+                try:
+                    flush_presence()
+                except Exception as e:
+                    print(f"Error flushing presence: {str(e)}")
+                finally:
+                    db.session.remove()
+
+    _flusher = threading.Thread(target=run, name='presence-flusher', daemon=True)
+    _flusher.start()
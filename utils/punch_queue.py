@@ -0,0 +1,410 @@
+"""
+Write-ahead punch queue: punches are acknowledged once logged and folded into timesheets in batches
+"""
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from sqlalchemy.exc import IntegrityError
+from models import db, User, TimesheetEntry, BreakEntry, UserStatus, PunchEvent
+from utils.timesheet import end_breaks
+from utils.timezone_helper import convert_utc_to_user_timezone
+from utils.work_rollup import refresh_entries_rollup
+
+PUNCH_KINDS = ('clock_in', 'clock_out', 'break_start', 'break_end')
+PUNCH_APPLY_BATCH_SIZE = int(os.environ.get('PUNCH_APPLY_BATCH_SIZE', 500))  # Punches folded per transaction
+PUNCH_APPLY_INTERVAL_SECONDS = float(os.environ.get('PUNCH_APPLY_INTERVAL_SECONDS', 1))  # 0 disables the background applier
+MAX_PUNCH_BATCH_SIZE = 5000  # Punches accepted in one synced batch
+MAX_DEVICE_CLOCK_SKEW = timedelta(minutes=5)  # How far ahead of the server a device timestamp may be
+PUNCH_CLAIM_TIMEOUT = timedelta(minutes=5)  # A claim this old is taken to have died with its worker
+
+_applier = None
+
+
+class PunchRejected(Exception):
+    """A punch that does not fit the user's timesheet state (e.g. clocking in twice)"""
+
+
+def record_punch(user_id, kind, idempotency_key=None, **details):
+    """Append a punch to the log and commit; returns (punch, created).
+
+    A punch whose idempotency key the user already sent is not logged again:
+    the original is returned with created False, so a retried request gets
+    the same answer.
+    """
+    punch = PunchEvent(
+        user_id=user_id,
+        kind=kind,
+        idempotency_key=idempotency_key or uuid.uuid4().hex,
+        occurred_at=datetime.utcnow(),
+        **details
+    )
+    db.session.add(punch)
+    try:
+        db.session.commit()
+        return punch, True
+    except IntegrityError:
+        db.session.rollback()
+        existing = PunchEvent.query.filter_by(user_id=user_id, idempotency_key=idempotency_key).first()
+        if existing is None:
+            raise
+        return existing, False
+
+
+def parse_punch_batch(raw_punches, device_id=None):
+    """Validate synced punches; returns one (punch fields, None) or (None, error) per raw punch, in order.
+
+    Each punch names its user by user_id or by staff_number (what a badge
+    reader knows); all of them are looked up with a single query.
+    occurred_at is the device's ISO 8601 timestamp; one without an offset
+    is taken as UTC.
+    """
+    punch_dicts = [raw for raw in raw_punches if isinstance(raw, dict)]
+    user_ids = {raw['user_id'] for raw in punch_dicts if isinstance(raw.get('user_id'), int)}
+    staff_numbers = {raw['staff_number'] for raw in punch_dicts if isinstance(raw.get('staff_number'), str)}
+    known_ids, staff_ids = set(), {}
+    if user_ids or staff_numbers:
+        for user_id, staff_number in db.session.execute(db.select(User.id, User.staff_number).where(
+            db.or_(User.id.in_(user_ids), User.staff_number.in_(staff_numbers)),
+            User.approval_status == 'approved'
+        )):
+            known_ids.add(user_id)
+            if staff_number:
+                staff_ids[staff_number] = user_id
+    latest = datetime.utcnow() + MAX_DEVICE_CLOCK_SKEW
+
+    parsed = []
+    for raw in raw_punches:
+        if not isinstance(raw, dict):
+            parsed.append((None, 'Punch must be an object'))
+            continue
+        if 'user_id' in raw:
+            user_id = raw['user_id']
+        else:
+            user_id = staff_ids.get(raw['staff_number']) if isinstance(raw.get('staff_number'), str) else None
+        if not isinstance(user_id, int) or user_id not in known_ids:
+            parsed.append((None, 'Unknown user'))
+            continue
+        if raw.get('kind') not in PUNCH_KINDS:
+            parsed.append((None, f"kind must be one of: {', '.join(PUNCH_KINDS)}"))
+            continue
+        key = raw.get('idempotency_key')
+        if not isinstance(key, str) or not 0 < len(key) <= 64:
+            parsed.append((None, 'idempotency_key must be a string of 1 to 64 characters'))
+            continue
+        try:
+            occurred_at = datetime.fromisoformat(raw.get('occurred_at'))
+        except (TypeError, ValueError):
+            parsed.append((None, 'occurred_at must be an ISO 8601 timestamp'))
+            continue
+        if occurred_at.tzinfo is not None:
+            occurred_at = occurred_at.astimezone(timezone.utc).replace(tzinfo=None)
+        if occurred_at > latest:
+            parsed.append((None, 'occurred_at is in the future'))
+            continue
+        parsed.append(({
+            'user_id': user_id,
+            'kind': raw['kind'],
+            'idempotency_key': key,
+            'occurred_at': occurred_at,
+            'location': raw.get('location'),
+            'notes': raw.get('notes'),
+            'task': raw.get('task'),
+            'break_type': raw.get('break_type'),
+            'device_id': device_id
+        }, None))
+    return parsed
+
+
+def record_punch_batch(items):
+    """Append many punches in one transaction; returns (punch, created) per item, in order.
+
+    Keys already logged (by an earlier sync of the same punches, or earlier
+    in this batch) map to the existing punch instead of a new row, so a
+    device can resend a whole batch after a dropped response.
+    """
+    keys = list({(item['user_id'], item['idempotency_key']) for item in items})
+    logged = {
+        (punch.user_id, punch.idempotency_key): punch
+        for punch in PunchEvent.query.filter(db.tuple_(PunchEvent.user_id, PunchEvent.idempotency_key).in_(keys))
+    } if keys else {}
+    recorded = []
+    for item in items:
+        key = (item['user_id'], item['idempotency_key'])
+        if key in logged:
+            recorded.append((logged[key], False))
+            continue
+        punch = logged[key] = PunchEvent(**item)
+        db.session.add(punch)
+        recorded.append((punch, True))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Another sync logged some of the same keys meanwhile; the retry finds them
+        db.session.rollback()
+        return record_punch_batch(items)
+    return recorded
+
+
+def _claim(*criteria, limit=None):
+    """Claim queued punches for this applier run and return them, oldest first.
+
+    One UPDATE stamps a fresh token on punches no live claim holds and is
+    committed at once, so the appliers of several workers never fold the
+    same punch, on SQLite as on Postgres. Users with punches under another
+    live claim are skipped, so each user's punches are folded by one run at
+    a time and stay in order.
+    """
+    now = datetime.utcnow()
+    stale = now - PUNCH_CLAIM_TIMEOUT
+    unclaimed = db.or_(PunchEvent.claimed_at.is_(None), PunchEvent.claimed_at < stale)
+    busy_users = db.select(PunchEvent.user_id).where(PunchEvent.applied_at.is_(None), PunchEvent.claimed_at >= stale)
+    candidates = db.select(PunchEvent.id).where(
+        PunchEvent.applied_at.is_(None), unclaimed, PunchEvent.user_id.notin_(busy_users), *criteria
+    ).order_by(PunchEvent.id)
+    if limit:
+        candidates = candidates.limit(limit)
+    token = uuid.uuid4().hex
+    db.session.execute(PunchEvent.__table__.update().where(
+        # Re-checked on the row itself, so a concurrent claim of the same punch finds nothing to take
+        PunchEvent.id.in_(candidates), PunchEvent.applied_at.is_(None), unclaimed
+    ).values(claim_token=token, claimed_at=now))
+    db.session.commit()
+    return PunchEvent.query.filter_by(claim_token=token).order_by(PunchEvent.id).all()
+
+
+def _by_user(punches):
+    # Device punches can arrive out of order, so each user's punches are replayed by punch time
+    grouped = defaultdict(list)
+    for punch in sorted(punches, key=lambda punch: (punch.occurred_at, punch.id)):
+        grouped[punch.user_id].append(punch)
+    return grouped
+
+
+def _fold(punches_by_user, now):
+    """Apply punches (grouped per user, in log order) to entries, breaks and statuses"""
+    user_ids = list(punches_by_user)
+    statuses = {status.user_id: status for status in UserStatus.query.filter(UserStatus.user_id.in_(user_ids))}
+    open_entries = {entry.user_id: entry for entry in TimesheetEntry.query.filter(
+        TimesheetEntry.user_id.in_(user_ids), TimesheetEntry.clock_out.is_(None))}
+    # Only a break on the open entry is in progress; one left open on an older entry is ignored
+    open_breaks = {break_entry.user_id: break_entry for break_entry in BreakEntry.query.join(
+        TimesheetEntry, BreakEntry.timesheet_entry_id == TimesheetEntry.id
+    ).filter(
+        TimesheetEntry.user_id.in_(user_ids),
+        TimesheetEntry.clock_out.is_(None),
+        BreakEntry.break_end.is_(None)
+    )}
+    entry_of_punch = {}
+    closed = []
+
+    def entry_id(entry):
+        if entry.id is None:
+            db.session.flush()  # A break on an entry opened earlier in this batch
+        return entry.id
+
+    def end_break(break_entry, entry, at):
+        # Running total instead of re-summing the entry's breaks per punch
+        end_breaks([break_entry], at)
+        entry.break_duration = (entry.break_duration or 0) + break_entry.duration_minutes
+
+    # Punch state lives in the dicts above, so nothing needs flushing until the end
+    with db.session.no_autoflush:
+        for user_id, punches in punches_by_user.items():
+            for punch in punches:
+                at = punch.occurred_at
+                status = statuses.get(user_id)
+                try:
+                    if punch.kind == 'clock_in':
+                        if user_id in open_entries:
+                            raise PunchRejected('Already clocked in')
+                        entry = TimesheetEntry(
+                            user_id=user_id,
+                            date=at.date(),
+                            clock_in=at,
+                            location=punch.location or 'Office',
+                            notes=punch.notes or ''
+                        )
+                        db.session.add(entry)
+                        open_entries[user_id] = entry
+                        if status is None:
+                            status = statuses[user_id] = UserStatus(user_id=user_id)
+                            db.session.add(status)
+                        status.is_working = True
+                        status.status_message = 'Available'
+                        status.current_task = punch.task or ''
+                        status.last_activity = at
+
+                    elif punch.kind == 'clock_out':
+                        entry = open_entries.get(user_id)
+                        if entry is None:
+                            raise PunchRejected('Not clocked in')
+                        if at < entry.clock_in:
+                            raise PunchRejected('Clock-out is earlier than the clock-in')
+                        break_entry = open_breaks.get(user_id)
+                        if break_entry is not None and at < break_entry.break_start:
+                            raise PunchRejected('Clock-out is earlier than the break start')
+                        del open_entries[user_id]
+                        open_breaks.pop(user_id, None)
+                        if break_entry is not None:
+                            end_break(break_entry, entry, at)
+                        entry.clock_out = at
+                        entry.duration_minutes = entry.compute_duration()
+                        if punch.notes:
+                            entry.notes = punch.notes
+                        closed.append((user_id, entry.clock_in))
+                        if status is not None:
+                            status.is_working = False
+                            status.current_timesheet_id = None
+                            status.status_message = 'Offline'
+                            status.current_task = ''
+                            status.last_activity = at
+
+                    elif punch.kind == 'break_start':
+                        entry = open_entries.get(user_id)
+                        if entry is None:
+                            raise PunchRejected('You must be clocked in to start a break')
+                        if user_id in open_breaks:
+                            raise PunchRejected('Break is already in progress')
+                        if at < entry.clock_in:
+                            raise PunchRejected('Break starts before the clock-in')
+                        break_entry = BreakEntry(
+                            user_id=user_id,
+                            timesheet_entry_id=entry_id(entry),
+                            break_start=at,
+                            break_type=punch.break_type or 'Break'
+                        )
+                        db.session.add(break_entry)
+                        open_breaks[user_id] = break_entry
+                        if status is not None:
+                            status.status_message = 'On Break'
+                            status.current_task = f"On {break_entry.break_type}"
+                            status.last_activity = at
+
+                    else:  # break_end
+                        break_entry = open_breaks.get(user_id)
+                        if break_entry is None:
+                            raise PunchRejected('No active break found')
+                        if at < break_entry.break_start:
+                            raise PunchRejected('Break ends before it started')
+                        del open_breaks[user_id]
+                        # open_breaks only holds breaks of open entries, which clock-outs pop
+                        entry = open_entries[user_id]
+                        end_break(break_entry, entry, at)
+                        if status is not None:
+                            status.status_message = 'Available'
+                            status.current_task = punch.task or ''
+                            status.last_activity = at
+
+                    entry_of_punch[punch] = entry
+                except PunchRejected as e:
+                    punch.error = str(e)
+                punch.applied_at = now
+
+    # One flush inserts every entry opened by the batch; then the ids can be recorded
+    db.session.flush()
+    for user_id, entry in open_entries.items():
+        if user_id in statuses and entry.clock_out is None:
+            statuses[user_id].current_timesheet_id = entry.id
+    for punch, entry in entry_of_punch.items():
+        punch.timesheet_entry_id = entry.id
+    refresh_entries_rollup(closed)
+
+
+def _apply(punches):
+    """Fold claimed punches in one transaction, falling back to one transaction per user.
+
+    Punches of one user are applied in order against the state left by the
+    previous ones, so a batch can open an entry, break and close it again.
+    A punch that does not fit is kept with its error instead of failing the
+    batch. If the batch fails anyway (e.g. a clock-in through the
+    synchronous endpoint raced it), it is retried one user at a time so a
+    single user's punches cannot hold up the rest of the queue.
+    """
+    punches_by_user = _by_user(punches)
+    punch_ids = {user_id: [punch.id for punch in user_punches] for user_id, user_punches in punches_by_user.items()}
+    try:
+        _fold(punches_by_user, datetime.utcnow())
+        db.session.commit()
+        return
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error applying punch batch, retrying per user: {str(e)}")
+
+    for user_id, ids in punch_ids.items():
+        try:
+            # Still claimed by this run; the rollback only undid the fold
+            user_punches = PunchEvent.query.filter(
+                PunchEvent.id.in_(ids), PunchEvent.applied_at.is_(None)
+            ).order_by(PunchEvent.id).all()
+            if user_punches:
+                _fold(_by_user(user_punches), datetime.utcnow())
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error applying punches of user {user_id}: {str(e)}")
+            db.session.execute(PunchEvent.__table__.update().where(
+                PunchEvent.id.in_(ids), PunchEvent.applied_at.is_(None)
+            ).values(applied_at=datetime.utcnow(), error=str(e)[:200]))
+            db.session.commit()
+
+
+def apply_pending_punches(batch_size=PUNCH_APPLY_BATCH_SIZE):
+    """Fold the oldest queued punches into timesheets; returns how many were handled"""
+    punches = _claim(limit=batch_size)
+    if not punches:
+        return 0
+    _apply(punches)
+    return len(punches)
+
+
+def apply_user_punches(user_ids):
+    """Fold every queued punch of the given users right away (a synced batch and anything queued before it)"""
+    punches = _claim(PunchEvent.user_id.in_(user_ids))
+    if punches:
+        _apply(punches)
+
+
+def drain_punch_queue(batch_size=PUNCH_APPLY_BATCH_SIZE):
+    """Apply batches until the queue is empty; returns the number of punches handled"""
+    handled = 0
+    while True:
+        count = apply_pending_punches(batch_size)
+        handled += count
+        if count < batch_size:
+            return handled
+
+
+def start_punch_applier(app, interval=PUNCH_APPLY_INTERVAL_SECONDS):
+    """Drain the punch queue every interval seconds in a daemon thread, once per process"""
+    global _applier
+    if interval <= 0 or _applier is not None:
+        return
+
+    def run():
+        while True:
+            time.sleep(interval)
+            with app.app_context():
+                try:
+                    drain_punch_queue()
+                except Exception as e:
+                    db.session.rollback()
+                    print(f"Error in punch applier: {str(e)}")
+                finally:
+                    db.session.remove()
+
+    _applier = threading.Thread(target=run, name='punch-applier', daemon=True)
+    _applier.start()
+
+
+def serialize_punch(punch):
+    return {
+        'id': punch.id,
+        'kind': punch.kind,
+        'status': punch.status,
+        'error': punch.error,
+        'occurred_at': convert_utc_to_user_timezone(punch.occurred_at).isoformat(),
+        'entry_id': punch.timesheet_entry_id
+    }
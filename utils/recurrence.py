@@ -0,0 +1,166 @@
+"""
+Weekly recurrence rules for availability slots, expanded lazily per window
+"""
+import json
+from collections import namedtuple
+from datetime import datetime, timedelta
+from functools import lru_cache
+from itertools import islice
+from models import db, AvailabilitySlot
+
+RECURRENCE_HORIZON_DAYS = 366  # How far past today an open-ended window is expanded
+OCCURRENCE_CACHE_SIZE = 4096  # (rule, window) expansions kept in memory
+
+# One dated occurrence of a recurring slot; quacks like an AvailabilitySlot for the feeds
+AvailabilityOccurrence = namedtuple(
+    'AvailabilityOccurrence', ['id', 'user_id', 'date', 'start_time', 'end_time', 'recurring']
+)
+
+
+def _weekday_set(days, first_date):
+    """Sorted, de-duplicated weekdays (0=Monday), defaulting to the first date's weekday"""
+    days = tuple(sorted({int(day) for day in days if 0 <= int(day) <= 6}))
+    return days or (first_date.weekday(),)
+
+
+def parse_weekdays(value, first_date):
+    """Weekdays stored in recurring_days"""
+    return _weekday_set(json.loads(value) if value else [], first_date)
+
+
+def parse_exceptions(value):
+    """Skipped dates stored in recurrence_exceptions"""
+    if not value:
+        return frozenset()
+    return frozenset(datetime.strptime(day, '%Y-%m-%d').date() for day in json.loads(value))
+
+
+def _iter_occurrences(first_date, weekdays, interval, count, start):
+    """Rule dates from start onwards, exceptions included (they still use up the count).
+
+    Jumps straight to the repeat period containing start, so the cost depends
+    on the window, not on how long ago the rule began.
+    """
+    week_zero = first_date - timedelta(days=first_date.weekday())
+    first_period = [day for day in weekdays if day >= first_date.weekday()]
+    period = max((start - week_zero).days // 7 // interval, 0) if start > first_date else 0
+    seen = 0 if period == 0 else len(first_period) + (period - 1) * len(weekdays)
+
+    while True:
+        week = week_zero + timedelta(weeks=period * interval)
+        for day in (first_period if period == 0 else weekdays):
+            seen += 1
+            if count and seen > count:
+                return
+            occurrence = week + timedelta(days=day)
+            if occurrence >= start:
+                yield occurrence
+        period += 1
+
+
+@lru_cache(maxsize=OCCURRENCE_CACHE_SIZE)
+def occurrence_dates(first_date, weekdays, interval, until, count, exceptions, start, end):
+    """Dates a rule occurs on in the half-open window [start, end)"""
+    last = end - timedelta(days=1)
+    if until and until < last:
+        last = until
+    dates = []
+    for occurrence in _iter_occurrences(first_date, weekdays, interval, count, max(start, first_date)):
+        if occurrence > last:
+            break
+        if occurrence not in exceptions:
+            dates.append(occurrence)
+    return tuple(dates)
+
+
+def rule_occurrence_dates(rule, start=None, end=None):
+    """Occurrence dates of a recurring slot (model or row) within an optional window.
+
+    Without a window the rule is expanded from its first date up to
+    RECURRENCE_HORIZON_DAYS past today.
+    """
+    if end is None:
+        end = datetime.utcnow().date() + timedelta(days=RECURRENCE_HORIZON_DAYS)
+    return occurrence_dates(
+        rule.date,
+        parse_weekdays(rule.recurring_days, rule.date),
+        max(rule.recurrence_interval or 1, 1),
+        rule.recurrence_until,
+        rule.recurrence_count,
+        parse_exceptions(rule.recurrence_exceptions),
+        start or rule.date,
+        end
+    )
+
+
+def expand_availability(slot, start=None, end=None):
+    """The slot itself, or one AvailabilityOccurrence per date if it is a recurring rule"""
+    if not slot.recurring:
+        return [slot]
+    return [
+        AvailabilityOccurrence(slot.id, slot.user_id, day, slot.start_time, slot.end_time, True)
+        for day in rule_occurrence_dates(slot, start, end)
+    ]
+
+
+def availability_window_criteria(start=None, end=None):
+    """Slots dated in [start, end) plus recurring rules whose span overlaps it"""
+    if not start and not end:
+        return []
+    single = [db.or_(AvailabilitySlot.recurring.is_(None), AvailabilitySlot.recurring.is_(False))]
+    rule = [AvailabilitySlot.recurring.is_(True)]
+    if start:
+        single.append(AvailabilitySlot.date >= start)
+        rule.append(db.or_(AvailabilitySlot.recurrence_until.is_(None), AvailabilitySlot.recurrence_until >= start))
+    if end:
+        single.append(AvailabilitySlot.date < end)
+        rule.append(AvailabilitySlot.date < end)
+    return [db.or_(db.and_(*single), db.and_(*rule))]
+
+
+def apply_recurrence(slot, data):
+    """Turn slot into a weekly rule from request data; raises ValueError on bad input.
+
+    Accepts recurring_days (weekdays, 0=Monday), interval (weeks), until
+    (YYYY-MM-DD), count and exceptions (list of YYYY-MM-DD). With a count
+    the date of the last occurrence is stored as recurrence_until, so
+    window queries can skip finished rules.
+    """
+    weekdays = _weekday_set(data.get('recurring_days') or [], slot.date)
+    interval = int(data.get('interval') or 1)
+    count = int(data['count']) if data.get('count') else None
+    until = datetime.strptime(data['until'], '%Y-%m-%d').date() if data.get('until') else None
+    exceptions = sorted({datetime.strptime(day, '%Y-%m-%d').date() for day in data.get('exceptions') or []})
+    if interval < 1 or (count is not None and count < 1):
+        raise ValueError('interval and count must be positive')
+    if until and until < slot.date:
+        raise ValueError('until must not be before the first date')
+
+    if count:
+        last = next(islice(_iter_occurrences(slot.date, weekdays, interval, count, slot.date), count - 1, None))
+        until = min(until, last) if until else last
+
+    slot.recurring = True
+    slot.recurring_days = json.dumps(list(weekdays))
+    slot.recurrence_interval = interval
+    slot.recurrence_until = until
+    slot.recurrence_count = count
+    slot.recurrence_exceptions = json.dumps([day.isoformat() for day in exceptions]) if exceptions else None
+
+
+def add_recurrence_exception(slot, day):
+    """Skip a single occurrence of a recurring slot"""
+    exceptions = parse_exceptions(slot.recurrence_exceptions) | {day}
+    slot.recurrence_exceptions = json.dumps(sorted(exception.isoformat() for exception in exceptions))
+
+
+def occurrence_cache_stats():
+    """Hit/miss counters of the expansion cache for monitoring"""
+    info = occurrence_dates.cache_info()
+    lookups = info.hits + info.misses
+    return {
+        'entries': info.currsize,
+        'hits': info.hits,
+        'misses': info.misses,
+        'hit_rate': round(info.hits / lookups, 3) if lookups else 0
+    }
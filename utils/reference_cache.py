@@ -0,0 +1,134 @@
+"""
+In-process cache of reference data (user directory and department list)
+"""
+import os
+import threading
+import time
+from collections import namedtuple
+from models import db, User, Department
+from utils.conditional import compute_etag
+
+REFERENCE_CACHE_TTL = int(os.environ.get('REFERENCE_CACHE_TTL', 300))  # Seconds; bounds staleness across workers
+
+DepartmentRef = namedtuple('DepartmentRef', 'id name description')
+UserRef = namedtuple('UserRef', 'id username email is_admin approval_status department_id department_name')
+
+
+def load_departments():
+    """Every department ordered by name"""
+    query = db.select(Department.id, Department.name, Department.description).order_by(Department.name)
+    return tuple(DepartmentRef(*row) for row in db.session.execute(query))
+
+
+def load_users():
+    """Every user (any approval status) with their department name, ordered by id"""
+    query = db.select(
+        User.id, User.username, User.email, User.is_admin, User.approval_status,
+        User.department_id, Department.name
+    ).outerjoin(Department, User.department_id == Department.id).order_by(User.id)
+    return tuple(UserRef(*row) for row in db.session.execute(query))
+
+
+class ReferenceCache:
+    """Cache of small, rarely written tables that most pages read in full.
+
+    Each dataset is loaded with one query into immutable tuples, so entries
+    can be shared between requests without holding ORM instances. Admin
+    write paths invalidate the affected datasets; the TTL bounds how long
+    another gunicorn worker can serve data after a write it did not see.
+    Every hit is a query avoided, which the stats report per dataset.
+    """
+
+    def __init__(self, loaders, ttl=REFERENCE_CACHE_TTL):
+        self.ttl = ttl
+        self._loaders = loaders
+        self._lock = threading.Lock()
+        self._entries = {}  # name -> (expires, value, etag)
+        self._generations = dict.fromkeys(loaders, 0)
+        self._hits = dict.fromkeys(loaders, 0)
+        self._loads = dict.fromkeys(loaders, 0)
+        self.invalidations = 0
+
+    def _entry(self, name):
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry and entry[0] > time.monotonic():
+                self._hits[name] += 1
+                return entry
+            generation = self._generations[name]
+
+        # Load outside the lock so a slow query does not block other datasets
+        value = self._loaders[name]()
+        entry = (time.monotonic() + self.ttl, value, compute_etag(name, value))
+        with self._lock:
+            self._loads[name] += 1
+            # An invalidation during the load means value may already be stale
+            if self._generations[name] == generation:
+                self._entries[name] = entry
+        return entry
+
+    def get(self, name):
+        """Cached rows of a dataset, loading them on a miss"""
+        return self._entry(name)[1]
+
+    def etag(self, name):
+        """ETag of the cached rows of a dataset"""
+        return self._entry(name)[2]
+
+    def invalidate(self, *names):
+        """Drop the given datasets (all of them when none are named)"""
+        with self._lock:
+            for name in names or tuple(self._loaders):
+                self._entries.pop(name, None)
+                self._generations[name] += 1
+            self.invalidations += 1
+
+    def stats(self):
+        """Hit/load counters for monitoring; each hit is one query avoided"""
+        with self._lock:
+            datasets = {}
+            for name in self._loaders:
+                lookups = self._hits[name] + self._loads[name]
+                datasets[name] = {
+                    'cached': name in self._entries,
+                    'hits': self._hits[name],
+                    'loads': self._loads[name],
+                    'hit_rate': round(self._hits[name] / lookups, 3) if lookups else 0
+                }
+            return {
+                'datasets': datasets,
+                'queries_avoided': sum(self._hits.values()),
+                'invalidations': self.invalidations,
+                'ttl_seconds': self.ttl
+            }
+
+
+reference_cache = ReferenceCache({'departments': load_departments, 'users': load_users})
+
+
+def cached_departments():
+    """Every department ordered by name"""
+    return reference_cache.get('departments')
+
+
+def cached_users(approval_status=None):
+    """Every user ordered by id, optionally only those with the given approval status"""
+    users = reference_cache.get('users')
+    if approval_status is None:
+        return users
+    return tuple(user for user in users if user.approval_status == approval_status)
+
+
+def department_choices():
+    """(id, name) choices for department select fields"""
+    return [(department.id, department.name) for department in cached_departments()]
+
+
+def invalidate_users():
+    """Call after a user is added, approved, renamed or moved between departments"""
+    reference_cache.invalidate('users')
+
+
+def invalidate_departments():
+    """Call after a department is added, renamed or deleted (users carry its name)"""
+    reference_cache.invalidate('departments', 'users')
@@ -0,0 +1,89 @@
+"""
+Common free-slot search across several users' calendars
+"""
+from datetime import datetime, timedelta
+from itertools import groupby
+from operator import itemgetter
+from utils.calendar_events import load_user_event_times
+from utils.timeline import MINUTES_PER_DAY, merge_intervals, time_range_interval, date_range_interval
+
+MAX_FREE_SLOT_DAYS = 366  # Longest date range a single search may cover
+
+
+def working_hours_intervals(days, work_start, work_end):
+    """Working-hours window of each day as minute offsets from the first day"""
+    start = work_start.hour * 60 + work_start.minute
+    end = work_end.hour * 60 + work_end.minute
+    if end <= start:
+        end += MINUTES_PER_DAY  # Night shift running into the next day
+    return merge_intervals(
+        (day * MINUTES_PER_DAY + start, day * MINUTES_PER_DAY + end) for day in range(days)
+    )
+
+
+def sweep_free_windows(available_streams, blocked, min_duration):
+    """Sweep interval boundaries in order and return windows free in every stream.
+
+    available_streams holds one merged interval list per participant (working
+    hours count as a participant); a window is free where all of them are open
+    and nothing in blocked is. Each boundary is (offset, available delta,
+    blocked delta), so one sort puts every stream in sweep order.
+    """
+    required = len(available_streams)
+    boundaries = []
+    for intervals in available_streams:
+        for start, end in intervals:
+            boundaries.append((start, 1, 0))
+            boundaries.append((end, -1, 0))
+    for start, end in blocked:
+        boundaries.append((start, 0, 1))
+        boundaries.append((end, 0, -1))
+    boundaries.sort()
+
+    open_count = blocked_count = 0
+    windows = []
+    free_since = None
+    for offset, group in groupby(boundaries, key=itemgetter(0)):
+        for _, open_delta, blocked_delta in group:
+            open_count += open_delta
+            blocked_count += blocked_delta
+        is_free = open_count == required and blocked_count == 0
+        if is_free and free_since is None:
+            free_since = offset
+        elif not is_free and free_since is not None:
+            if offset - free_since >= min_duration:
+                windows.append((free_since, offset))
+            free_since = None
+    return windows
+
+
+def find_common_free_slots(user_ids, start_date, end_date, min_duration, work_start, work_end):
+    """Windows between start_date and end_date (inclusive) when every user is free.
+
+    A user is free while inside one of their availability slots and outside
+    their busy slots and approved leave; windows are clipped to working hours
+    and shorter than min_duration minutes are dropped. Returns (start, end)
+    datetimes in ascending order.
+    """
+    days = (end_date - start_date).days + 1
+    # Load from the day before so overnight slots running into start_date count
+    events_by_user = load_user_event_times(
+        user_ids, start=start_date - timedelta(days=1), end=end_date + timedelta(days=1)
+    )
+
+    available_streams = [working_hours_intervals(days, work_start, work_end)]
+    blocked = []
+    for user_id in user_ids:
+        events = events_by_user[user_id]
+        if not events['availability']:
+            return []  # Someone with no availability at all rules out every window
+        available_streams.append(merge_intervals(
+            time_range_interval(*slot, start_date) for slot in events['availability']))
+        blocked.extend(time_range_interval(*slot, start_date) for slot in events['busy'])
+        blocked.extend(date_range_interval(*leave, start_date) for leave in events['leave'])
+
+    origin = datetime.combine(start_date, datetime.min.time())
+    return [
+        (origin + timedelta(minutes=start), origin + timedelta(minutes=end))
+        for start, end in sweep_free_windows(available_streams, merge_intervals(blocked), min_duration)
+    ]
@@ -0,0 +1,297 @@
+"""
+Live team status: the change log, a per-process fan-out and the Server-Sent Events stream
+"""
+import json
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+from models import db, User, UserStatus, TimesheetEntry, StatusChange
+from utils.presence import pending_presence, effective_presence
+
+STATUS_POLL_SECONDS = float(os.environ.get('STATUS_POLL_SECONDS', 1))  # How soon changes committed by other workers reach this one
+STATUS_STREAM_MAX_SECONDS = int(os.environ.get('STATUS_STREAM_MAX_SECONDS', 300))  # Streams then end; EventSource reconnects for a fresh snapshot
+STATUS_STREAM_KEEPALIVE_SECONDS = 15
+STATUS_STREAM_RETRY_MS = 3000  # Reconnect delay suggested to EventSource
+STATUS_STREAM_ENABLED = os.environ.get('STATUS_STREAM_ENABLED', '0') == '1'  # Each open stream holds a worker; only enable with threaded or async workers
+STATUS_SETTLE_SECONDS = int(os.environ.get('STATUS_SETTLE_SECONDS', 30))  # Longest a transaction writing status may stay open
+STATUS_CHANGE_RETENTION = timedelta(hours=1)
+STATUS_CHANGE_PRUNE_SECONDS = 600
+
+# Attributes whose change alters what a team status row shows
+TRACKED_ENTRY_ATTRIBUTES = ('clock_in', 'clock_out')
+TRACKED_USER_ATTRIBUTES = ('username',)
+
+
+def _changed(obj, attributes):
+    state = inspect(obj)
+    return any(state.attrs[name].history.has_changes() for name in attributes)
+
+
+@event.listens_for(Session, 'after_flush')
+def record_status_changes(session, flush_context):
+    """Append a change row for every user whose status, open entry or name was written in this flush"""
+    user_ids = set()
+    for objects in (session.new, session.deleted):
+        for obj in objects:
+            if isinstance(obj, (UserStatus, TimesheetEntry)):
+                user_ids.add(obj.user_id)
+            elif isinstance(obj, User):
+                user_ids.add(obj.id)
+    for obj in session.dirty:
+        if isinstance(obj, UserStatus) and session.is_modified(obj):
+            user_ids.add(obj.user_id)
+        elif isinstance(obj, TimesheetEntry) and _changed(obj, TRACKED_ENTRY_ATTRIBUTES):
+            user_ids.add(obj.user_id)
+        elif isinstance(obj, User) and _changed(obj, TRACKED_USER_ATTRIBUTES):
+            user_ids.add(obj.id)
+    if user_ids:
+        _insert_changes(session, user_ids)
+
+
+def record_bulk_status_changes(user_ids):
+    """Log status changes written with bulk statements, which bypass the flush listener"""
+    if user_ids:
+        _insert_changes(db.session, user_ids)
+
+
+def _insert_changes(session, user_ids):
+    now = datetime.utcnow()
+    session.connection().execute(StatusChange.__table__.insert(), [{'user_id': user_id, 'changed_at': now} for user_id in user_ids])
+    session.info['status_changed'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _wake_broker(session):
+    # Streams in this process hear about the change at once, without waiting for the next poll
+    if session.info.pop('status_changed', False):
+        status_broker.wake()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_changes(session):
+    session.info.pop('status_changed', None)
+
+
+def latest_status_cursor():
+    """Cursor of the newest recorded status change (0 when nothing has been recorded)"""
+    return db.session.query(db.func.max(StatusChange.id)).scalar() or 0
+
+
+def settled_status_cursor():
+    """Cursor of the newest status change older than STATUS_SETTLE_SECONDS, below which no late commit can land"""
+    settled = datetime.utcnow() - timedelta(seconds=STATUS_SETTLE_SECONDS)
+    return db.session.execute(
+        db.select(StatusChange.id).where(StatusChange.changed_at < settled)
+        .order_by(StatusChange.id.desc()).limit(1)
+    ).scalar() or 0
+
+
+def load_team_status(user_ids=None):
+    """Status rows of all users, or of the given ones, as served by /api/team/status"""
+    users_query = db.session.query(User, UserStatus).outerjoin(UserStatus)
+    if user_ids is not None:
+        users_query = users_query.filter(User.id.in_(user_ids))
+    users_query = users_query.all()
+
+    # Bulk fetch active timesheet entries to avoid N+1 queries
+    active_entries = db.session.query(TimesheetEntry).filter(
+        TimesheetEntry.user_id.in_([user.id for user, _ in users_query]),
+        TimesheetEntry.clock_out.is_(None)
+    ).all()
+    active_entries_by_user = {entry.user_id: entry for entry in active_entries}
+    # Status and task changes still waiting in the presence store take precedence
+    pending = pending_presence(user_ids)
+
+    team_status = []
+    for user, status in users_query:
+        active_entry = active_entries_by_user.get(user.id)
+        if status:
+            status_message, current_task, last_activity = effective_presence(status, pending.get(user.id))
+        else:
+            status_message, current_task, last_activity = None, '', None
+
+        # Determine status message safely
+        if active_entry:
+            status_msg = status_message or 'Working'
+        else:
+            status_msg = status_message or 'Offline'
+
+        team_status.append({
+            'user_id': user.id,
+            'username': user.username,
+            'is_working': status.is_working if status else False,
+            'is_clocked_in': active_entry is not None,
+            'status_message': status_msg,
+            'current_task': current_task,
+            'last_activity': last_activity.isoformat() if last_activity else None,
+            'clock_in_time': active_entry.clock_in.isoformat() if active_entry else None,
+            'current_duration': (datetime.utcnow() - active_entry.clock_in).total_seconds() / 60 if active_entry else 0
+        })
+    return team_status
+
+
+def public_team_status(team_status):
+    """The rows non-admins see: clocked-in users only, with a generic message unless they report as working"""
+    return [{
+        'user_id': row['user_id'],
+        'username': row['username'],
+        'is_working': True,
+        'is_clocked_in': True,
+        'status_message': row['status_message'] if row['is_working'] else 'Working',
+        'current_task': (row['current_task'] or '') if row['is_working'] else '',
+        'current_duration': row['current_duration']
+    } for row in team_status if row['is_clocked_in']]
+
+
+class StatusBroker:
+    """Hands team status deltas to the open streams of this process.
+
+    One thread per process reads the shared status_change log, so changes
+    committed by any gunicorn worker reach the streams of every worker. Each
+    delta's rows are loaded once and the same delta is queued for every
+    subscriber, so the query load follows the rate of changes rather than
+    the number of open browsers. The thread idles while nobody subscribes.
+
+    Ids are drawn when a change is flushed, not when it commits, so on
+    Postgres a lower id can become visible after higher ones. The cursor
+    therefore only advances past changes older than STATUS_SETTLE_SECONDS;
+    newer ones are re-read each poll and the ids already delivered are
+    remembered, so a late change is still sent, and only once.
+    """
+
+    def __init__(self, poll_seconds=STATUS_POLL_SECONDS):
+        self.poll_seconds = poll_seconds
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._subscribers = set()
+        self._cursor = None
+        self._delivered = set()  # Ids after the cursor already sent
+        self._thread = None
+
+    def subscribe(self, app):
+        """Queue receiving every delta from now on; call inside an app context"""
+        subscriber = queue.Queue()
+        with self._lock:
+            if self._cursor is None:
+                # Start behind the caller's snapshot so nothing between the two is missed
+                self._cursor = settled_status_cursor()
+                self._delivered = set()
+            self._subscribers.add(subscriber)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, args=(app,), name='status-broker', daemon=True)
+                self._thread.start()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def wake(self):
+        self._wakeup.set()
+
+    def _run(self, app):
+        last_prune = 0
+        while True:
+            self._wakeup.wait(self.poll_seconds)
+            self._wakeup.clear()
+            with self._lock:
+                if not self._subscribers:
+                    self._cursor = None
+                    continue
+                cursor, delivered = self._cursor, self._delivered
+            with app.app_context():
+                try:
+                    delta, cursor, delivered = self._load_delta(cursor, delivered)
+                    if time.monotonic() - last_prune > STATUS_CHANGE_PRUNE_SECONDS:
+                        prune_status_changes()
+                        last_prune = time.monotonic()
+                except Exception as e:
+                    db.session.rollback()
+                    print(f"Error loading team status changes: {str(e)}")
+                    continue
+                finally:
+                    db.session.remove()
+            with self._lock:
+                if self._cursor is None:
+                    continue  # Everyone left meanwhile; the next subscriber starts afresh
+                self._cursor, self._delivered = cursor, delivered
+                subscribers = list(self._subscribers)
+            if delta is None:
+                continue
+            for subscriber in subscribers:
+                subscriber.put(delta)
+
+    def _load_delta(self, cursor, delivered):
+        """(delta or None, new cursor, ids after it already delivered)"""
+        settled = datetime.utcnow() - timedelta(seconds=STATUS_SETTLE_SECONDS)
+        changes = db.session.execute(
+            db.select(StatusChange.id, StatusChange.user_id, StatusChange.changed_at)
+            .where(StatusChange.id > cursor)
+        ).all()
+        new_cursor = max((change_id for change_id, _, changed_at in changes if changed_at < settled), default=cursor)
+        fresh = [(change_id, user_id) for change_id, user_id, _ in changes if change_id not in delivered]
+        delivered = {change_id for change_id, _, _ in changes if change_id > new_cursor}
+        if not fresh:
+            return None, new_cursor, delivered
+        user_ids = {user_id for _, user_id in fresh}
+        return {
+            'cursor': max(change_id for change_id, _ in fresh),
+            'user_ids': user_ids,
+            'team_status': load_team_status(user_ids)
+        }, new_cursor, delivered
+
+
+status_broker = StatusBroker()
+
+
+def prune_status_changes(now=None):
+    """Drop change rows no stream can still be behind on"""
+    cutoff = (now or datetime.utcnow()) - STATUS_CHANGE_RETENTION
+    db.session.execute(StatusChange.__table__.delete().where(StatusChange.changed_at < cutoff))
+    db.session.commit()
+
+
+def _sse(event_name, payload):
+    return f"event: {event_name}\ndata: {json.dumps(payload, separators=(',', ':'))}\n\n"
+
+
+def iter_status_events(app, public):
+    """Server-Sent Events: one snapshot of the team, then a delta per batch of changes.
+
+    A delta carries the changed users' full rows plus the ids of users to
+    drop (deleted, or no longer clocked in for the public view). The first
+    deltas may repeat rows the snapshot already has, which is harmless as
+    rows are replaced whole. Iterate under stream_with_context.
+    """
+    subscriber = status_broker.subscribe(app)
+    try:
+        cursor = latest_status_cursor()
+        team_status = load_team_status()
+        # Give the connection back to the pool; the stream only reads its queue from here on
+        db.session.close()
+        yield f"retry: {STATUS_STREAM_RETRY_MS}\n\n"
+        yield _sse('snapshot', {
+            'cursor': cursor,
+            'team_status': public_team_status(team_status) if public else team_status
+        })
+
+        deadline = time.monotonic() + STATUS_STREAM_MAX_SECONDS
+        while (remaining := deadline - time.monotonic()) > 0:
+            try:
+                delta = subscriber.get(timeout=min(STATUS_STREAM_KEEPALIVE_SECONDS, remaining))
+            except queue.Empty:
+                yield ': keepalive\n\n'
+                continue
+            cursor = max(cursor, delta['cursor'])
+            rows = public_team_status(delta['team_status']) if public else delta['team_status']
+            yield _sse('delta', {
+                'cursor': cursor,
+                'team_status': rows,
+                'removed': sorted(delta['user_ids'] - {row['user_id'] for row in rows})
+            })
+    finally:
+        status_broker.unsubscribe(subscriber)
@@ -0,0 +1,81 @@
+"""
+Interval merging and compact columnar encoding for the Gantt timeline
+"""
+from datetime import datetime
+
+MINUTES_PER_DAY = 24 * 60
+
+
+def merge_intervals(intervals):
+    """Merge overlapping and adjacent (start, end) intervals with a sorted sweep"""
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1][1] = end
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def encode_columns(intervals):
+    """Columnar form of merged intervals: one array of start offsets, one of durations"""
+    return {
+        'start': [start for start, _ in intervals],
+        'duration': [end - start for start, end in intervals]
+    }
+
+
+def time_range_interval(day, start_time, end_time, origin):
+    """Minutes from origin midnight covered by start_time-end_time on day (overnight ranges end next day)"""
+    day_offset = (day - origin).days * MINUTES_PER_DAY
+    start = day_offset + start_time.hour * 60 + start_time.minute
+    end = day_offset + end_time.hour * 60 + end_time.minute
+    if end < start:
+        end += MINUTES_PER_DAY
+    return start, end
+
+
+def slot_interval(slot, origin):
+    """Minutes from origin midnight covered by a timed slot"""
+    return time_range_interval(slot.date, slot.start_time, slot.end_time, origin)
+
+
+def date_range_interval(start_date, end_date, origin):
+    """Minutes from origin midnight covered by whole days start_date..end_date (inclusive)"""
+    return (start_date - origin).days * MINUTES_PER_DAY, ((end_date - origin).days + 1) * MINUTES_PER_DAY
+
+
+def leave_interval(leave, origin):
+    """Minutes from origin midnight covered by an all-day leave range"""
+    return date_range_interval(leave.start_date, leave.end_date, origin)
+
+
+def timeline_origin(events_by_user, window_start=None):
+    """Day the offsets are counted from: the window start, else the earliest loaded row"""
+    if window_start:
+        return window_start
+    days = [
+        row.start_date if event_type == 'leave' else row.date
+        for events in events_by_user.values()
+        for event_type, rows in events.items()
+        for row in rows
+    ]
+    return min(days) if days else datetime.utcnow().date()
+
+
+def build_user_timeline(events, origin):
+    """Merge one user's availability, busy and leave rows into columnar intervals.
+
+    Timed slots become minute offsets from origin; because no slot can end at
+    24:00, merging on absolute offsets only joins intervals within a day
+    (plus overnight slots that run into the next one).
+    """
+    return {
+        'availability': encode_columns(merge_intervals(
+            slot_interval(slot, origin) for slot in events['availability'])),
+        'busy': encode_columns(merge_intervals(
+            slot_interval(slot, origin) for slot in events['busy'])),
+        'leave': encode_columns(merge_intervals(
+            leave_interval(leave, origin) for leave in events['leave']))
+    }
@@ -0,0 +1,128 @@
+"""
+Lookups and bookkeeping shared by the timesheet punch endpoints
+"""
+import base64
+from datetime import date, datetime
+from models import db, TimesheetEntry, BreakEntry
+
+DURATION_BACKFILL_CHUNK_SIZE = 1000  # Rows per committed backfill chunk
+ENTRY_PAGE_SIZE = 100  # Entries per page when a page is requested without a limit
+MAX_ENTRY_PAGE_SIZE = 500
+
+
+def active_timesheet_entry(user_id, user_status=None):
+    """The user's open timesheet entry, or None.
+
+    Follows UserStatus.current_timesheet_id when the caller already holds the
+    status row (a primary-key get, usually answered from the identity map).
+    Otherwise, or when the pointer is stale, it looks the entry up through the
+    partial unique index of open entries, which holds at most one row per
+    user however long their history is.
+    """
+    if user_status is not None and user_status.current_timesheet_id:
+        entry = db.session.get(TimesheetEntry, user_status.current_timesheet_id)
+        if entry is not None and entry.user_id == user_id and entry.clock_out is None:
+            return entry
+    return TimesheetEntry.query.filter(
+        TimesheetEntry.user_id == user_id,
+        TimesheetEntry.clock_out.is_(None)
+    ).first()
+
+
+def end_breaks(breaks, end):
+    """End breaks at the given time, storing their durations"""
+    for break_entry in breaks:
+        break_entry.break_end = end
+        break_entry.duration_minutes = int((end - break_entry.break_start).total_seconds() / 60)
+
+
+def update_break_total(entry):
+    """Re-sum an entry's ended breaks from their stored durations (plain SQL SUM, any backend).
+
+    A closed entry also gets its stored work duration recomputed.
+    """
+    entry.break_duration = db.session.query(
+        db.func.coalesce(db.func.sum(BreakEntry.duration_minutes), 0)
+    ).filter(
+        BreakEntry.timesheet_entry_id == entry.id,
+        BreakEntry.break_end.isnot(None)
+    ).scalar()
+    if entry.clock_out is not None:
+        entry.duration_minutes = entry.compute_duration()
+
+
+def close_timesheet_entry(entry, clock_out):
+    """Clock an entry out: end its open breaks, then store its break and work minutes"""
+    end_breaks(BreakEntry.query.filter_by(timesheet_entry_id=entry.id, break_end=None).all(), clock_out)
+    entry.clock_out = clock_out
+    update_break_total(entry)
+
+
+def _backfill_column(model, closed_column, columns, compute, chunk_size):
+    updated = 0
+    last_id = 0
+    statement = model.__table__.update().where(
+        model.__table__.c.id == db.bindparam('row_id')
+    ).values(duration_minutes=db.bindparam('minutes'))
+    while True:
+        rows = db.session.execute(
+            db.select(model.id, *columns).where(
+                model.duration_minutes.is_(None),
+                closed_column.isnot(None),
+                model.id > last_id
+            ).order_by(model.id).limit(chunk_size)
+        ).all()
+        if not rows:
+            return updated
+        db.session.execute(statement, [{'row_id': row[0], 'minutes': compute(*row[1:])} for row in rows])
+        db.session.commit()
+        updated += len(rows)
+        last_id = rows[-1][0]
+
+
+def backfill_durations(chunk_size=DURATION_BACKFILL_CHUNK_SIZE):
+    """Store the durations of closed breaks and entries written before the columns existed.
+
+    Rows are handled in id order and every chunk is committed, so an
+    interrupted run resumes where it stopped. Returns (breaks, entries)
+    updated.
+    """
+    breaks = _backfill_column(
+        BreakEntry, BreakEntry.break_end, (BreakEntry.break_start, BreakEntry.break_end),
+        lambda start, end: int((end - start).total_seconds() / 60),
+        chunk_size
+    )
+    entries = _backfill_column(
+        TimesheetEntry, TimesheetEntry.clock_out,
+        (TimesheetEntry.clock_in, TimesheetEntry.clock_out, TimesheetEntry.break_duration),
+        lambda clock_in, clock_out, break_duration: max(
+            0, int((clock_out - clock_in).total_seconds() / 60 - (break_duration or 0))),
+        chunk_size
+    )
+    return breaks, entries
+
+
+# Newest first; id breaks ties so every entry has a unique position for keyset paging
+ENTRY_ORDER = (TimesheetEntry.date.desc(), TimesheetEntry.clock_in.desc(), TimesheetEntry.id.desc())
+
+
+def encode_entry_cursor(entry):
+    """Opaque cursor pointing just past an entry in ENTRY_ORDER"""
+    position = f"{entry.date.isoformat()}|{entry.clock_in.isoformat()}|{entry.id}"
+    return base64.urlsafe_b64encode(position.encode()).decode().rstrip('=')
+
+
+def entries_after(cursor):
+    """Criterion selecting the entries that follow a cursor in ENTRY_ORDER; raises ValueError when malformed.
+
+    A row-value comparison on (date, clock_in, id), so each page is an index
+    range scan that starts where the previous one stopped, however deep into
+    the history it is.
+    """
+    try:
+        position = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        day, clock_in, entry_id = position.split('|')
+        position = (date.fromisoformat(day), datetime.fromisoformat(clock_in), int(entry_id))
+    except ValueError:
+        raise ValueError('Invalid cursor')
+    return db.tuple_(TimesheetEntry.date, TimesheetEntry.clock_in, TimesheetEntry.id) < position
@@ -1,8 +1,13 @@
-import pytz
-from datetime import datetime
+from datetime import datetime, timezone
+from functools import lru_cache
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError, available_timezones
+from flask import g, has_request_context
 from flask_login import current_user
 
-# Supported timezones mapping
+UTC = timezone.utc
+TIMEZONE_CACHE_SIZE = 128  # Distinct zones kept resolved
+
+# Timezones listed first, with display names; any other IANA zone is accepted too
 SUPPORTED_TIMEZONES = {
     'UTC': 'UTC',
     'Asia/Kolkata': 'India Standard Time (IST)',
@@ -10,14 +15,47 @@ SUPPORTED_TIMEZONES = {
     'Europe/London': 'Greenwich Mean Time (GMT)'
 }
 
+@lru_cache(maxsize=TIMEZONE_CACHE_SIZE)
+def resolve_timezone(timezone_name):
+    """tzinfo for an IANA zone name, falling back to UTC for unknown names"""
+    try:
+        return ZoneInfo(timezone_name or 'UTC')
+    except (ZoneInfoNotFoundError, ValueError):
+        return ZoneInfo('UTC')
+
+@lru_cache(maxsize=1)
+def timezone_choices():
+    """(value, label) pairs for a timezone select: the supported zones, then every other IANA zone"""
+    labels = dict(SUPPORTED_TIMEZONES, UTC='UTC (Coordinated Universal Time)')
+    return tuple(labels.items()) + tuple((name, name) for name in sorted(available_timezones()) if name not in labels)
+
 def get_user_timezone():
-    """Get the current user's timezone, defaulting to Asia/Kolkata for Indian users"""
+    """Get the current user's timezone, defaulting to Asia/Kolkata for Indian users.
+    
+    Resolved once per request and user.
+    """
+    user_id = getattr(current_user, 'id', None)
+    if has_request_context():
+        cached = g.get('_user_timezone')
+        if cached and cached[0] == user_id:
+            return cached[1]
     if hasattr(current_user, 'timezone') and current_user.timezone:
         # If user explicitly set UTC, respect it, otherwise default to IST
         if current_user.timezone == 'UTC':
-            return 'Asia/Kolkata'  # Override UTC default to IST
-        return current_user.timezone
-    return 'Asia/Kolkata'  # Default to IST instead of UTC
+            user_timezone = 'Asia/Kolkata'  # Override UTC default to IST
+        else:
+            user_timezone = current_user.timezone
+    else:
+        user_timezone = 'Asia/Kolkata'  # Default to IST instead of UTC
+    if has_request_context():
+        g._user_timezone = (user_id, user_timezone)
+    return user_timezone
+
+def utc_to_local(utc_datetime, zone):
+    """Convert a UTC datetime (naive or aware) to the given tzinfo"""
+    if utc_datetime.tzinfo is None:
+        utc_datetime = utc_datetime.replace(tzinfo=UTC)
+    return utc_datetime.astimezone(zone)
 
 def convert_utc_to_user_timezone(utc_datetime, user_timezone=None):
     """Convert UTC datetime to user's timezone"""
@@ -27,13 +65,18 @@ def convert_utc_to_user_timezone(utc_datetime, user_timezone=None):
     if user_timezone is None:
         user_timezone = get_user_timezone()
     
-    # Ensure datetime is timezone-aware (UTC)
-    if utc_datetime.tzinfo is None:
-        utc_datetime = pytz.UTC.localize(utc_datetime)
+    return utc_to_local(utc_datetime, resolve_timezone(user_timezone))
+
+def convert_utc_column(utc_datetimes, user_timezone=None):
+    """Convert a sequence of UTC datetimes to one timezone in a single call; None stays None.
     
-    # Convert to user's timezone
-    user_tz = pytz.timezone(user_timezone)
-    return utc_datetime.astimezone(user_tz)
+    The zone is resolved once for the whole column; zoneinfo then finds each
+    value's offset by bisecting the zone's precomputed UTC transitions.
+    """
+    if user_timezone is None:
+        user_timezone = get_user_timezone()
+    zone = resolve_timezone(user_timezone)
+    return [utc_to_local(value, zone) if value else None for value in utc_datetimes]
 
 def convert_user_timezone_to_utc(local_datetime, user_timezone=None):
     """Convert user's local datetime to UTC"""
@@ -44,12 +87,11 @@ def convert_user_timezone_to_utc(local_datetime, user_timezone=None):
         user_timezone = get_user_timezone()
     
     # Localize the datetime to user's timezone
-    user_tz = pytz.timezone(user_timezone)
     if local_datetime.tzinfo is None:
-        local_datetime = user_tz.localize(local_datetime)
+        local_datetime = local_datetime.replace(tzinfo=resolve_timezone(user_timezone))
     
     # Convert to UTC
-    return local_datetime.astimezone(pytz.UTC)
+    return local_datetime.astimezone(UTC)
 
 def get_current_time_in_user_timezone(user_timezone=None):
     """Get current time in user's timezone"""
@@ -83,4 +125,4 @@ def detect_timezone_from_offset(offset_minutes):
         5.5: 'Asia/Kolkata' # IST
     }
     
-    return timezone_map.get(offset_hours, 'UTC')
\ No newline at end of file
+    return timezone_map.get(offset_hours, 'UTC')
@@ -0,0 +1,119 @@
+"""
+Daily work rollup: closed timesheet entries summed per user, local date and location
+"""
+from collections import defaultdict
+from datetime import timedelta
+from models import db, User, TimesheetEntry, DailyWorkRollup
+from utils.timezone_helper import convert_utc_to_user_timezone
+
+BACKFILL_USERS_PER_COMMIT = 50
+
+
+def local_work_date(clock_in, timezone_name):
+    """Date of a UTC clock-in in the user's timezone"""
+    return convert_utc_to_user_timezone(clock_in, timezone_name or 'UTC').date()
+
+
+def aggregate_entries(rows, timezones):
+    """Sum (user_id, clock_in, clock_out, break_duration, duration_minutes, location) rows per rollup key.
+
+    Returns {(user_id, work_date, location): [worked_minutes, break_minutes, sessions]}.
+    Worked minutes are the stored entry durations, computed as in
+    TimesheetEntry.compute_duration for rows not yet backfilled.
+    """
+    totals = defaultdict(lambda: [0, 0, 0])
+    for user_id, clock_in, clock_out, break_duration, duration_minutes, location in rows:
+        break_minutes = break_duration or 0
+        if duration_minutes is None:
+            duration_minutes = max(0, int((clock_out - clock_in).total_seconds() / 60 - break_minutes))
+        total = totals[(user_id, local_work_date(clock_in, timezones.get(user_id)), location or 'Office')]
+        total[0] += duration_minutes
+        total[1] += break_minutes
+        total[2] += 1
+    return totals
+
+
+def _closed_entry_rows(*criteria):
+    return db.session.execute(
+        db.select(
+            TimesheetEntry.user_id, TimesheetEntry.clock_in, TimesheetEntry.clock_out,
+            TimesheetEntry.break_duration, TimesheetEntry.duration_minutes, TimesheetEntry.location
+        ).where(TimesheetEntry.clock_out.isnot(None), *criteria)
+    )
+
+
+def _insert_totals(totals):
+    if totals:
+        db.session.execute(DailyWorkRollup.__table__.insert(), [
+            {'user_id': user_id, 'work_date': work_date, 'location': location,
+             'worked_minutes': worked, 'break_minutes': break_minutes, 'sessions': sessions}
+            for (user_id, work_date, location), (worked, break_minutes, sessions) in totals.items()
+        ])
+
+
+def _user_timezones(user_ids):
+    return dict(db.session.execute(db.select(User.id, User.timezone).where(User.id.in_(user_ids))).all())
+
+
+def refresh_work_rollup(user_days, timezones=None):
+    """Recompute the rollup rows of the given (user_id, work_date) days. The caller commits.
+
+    Only the entries of those users within a day of the touched dates are
+    read (TimesheetEntry.date is the UTC clock-in date, at most a day away
+    from the local one), so the cost follows the touched days rather than
+    the punch history.
+    """
+    user_days = set(user_days)
+    if not user_days:
+        return
+    user_ids = {user_id for user_id, _ in user_days}
+    first_day = min(day for _, day in user_days)
+    last_day = max(day for _, day in user_days)
+    if timezones is None:
+        timezones = _user_timezones(user_ids)
+
+    rows = _closed_entry_rows(
+        TimesheetEntry.user_id.in_(user_ids),
+        TimesheetEntry.date.between(first_day - timedelta(days=1), last_day + timedelta(days=1))
+    )
+    totals = {key: total for key, total in aggregate_entries(rows, timezones).items() if key[:2] in user_days}
+
+    db.session.execute(DailyWorkRollup.__table__.delete().where(
+        DailyWorkRollup.user_id.in_(user_ids),
+        DailyWorkRollup.work_date.between(first_day, last_day),
+        db.tuple_(DailyWorkRollup.user_id, DailyWorkRollup.work_date).in_(list(user_days))
+    ))
+    _insert_totals(totals)
+
+
+def refresh_entries_rollup(entries):
+    """Recompute the rollup days of closed or edited entries given as (user_id, clock_in) pairs"""
+    entries = list(entries)
+    if not entries:
+        return
+    timezones = _user_timezones({user_id for user_id, _ in entries})
+    refresh_work_rollup(
+        {(user_id, local_work_date(clock_in, timezones.get(user_id))) for user_id, clock_in in entries},
+        timezones
+    )
+
+
+def backfill_work_rollup(users_per_commit=BACKFILL_USERS_PER_COMMIT):
+    """Rebuild the whole rollup from the timesheet history; returns the number of rows written"""
+    written = 0
+    users = db.session.execute(db.select(User.id, User.timezone).order_by(User.id)).all()
+    for offset in range(0, len(users), users_per_commit):
+        batch = dict(users[offset:offset + users_per_commit])
+        db.session.execute(DailyWorkRollup.__table__.delete().where(DailyWorkRollup.user_id.in_(batch)))
+        totals = aggregate_entries(_closed_entry_rows(TimesheetEntry.user_id.in_(batch)), batch)
+        _insert_totals(totals)
+        db.session.commit()
+        written += len(totals)
+    return written
+
+
+def total_timesheet_entries():
+    """Closed sessions from the rollup plus open entries (one per clocked-in user)"""
+    closed = db.session.query(db.func.sum(DailyWorkRollup.sessions)).scalar() or 0
+    open_entries = TimesheetEntry.query.filter(TimesheetEntry.clock_out.is_(None)).count()
+    return int(closed) + open_entries